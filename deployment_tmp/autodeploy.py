@@ -103,6 +103,13 @@ with open(config_path, "r") as f:
     os.system('cp ' + config["WSKPROPSPATH"] + ".wskprops" + deployment.name + " ~/.wskprops")
 
 
+# modules from this directory, which are shipped with every action
+# modules only some actions need (like backfill.py and migrate.py) go into the "includes" of those actions instead
+shared_modules = ["osnapi.py", "secretmanager.py", "workqueue.py", "intervals.py", "mongodb.py", "dwdftp.py", "metrics.py", "zipview.py"]
+# secretmanager.py is generated from secret_manager.py on every run, so the template is hashed instead
+shared_sources = ["secret_manager.py" if module == "secretmanager.py" else module for module in shared_modules]
+
+
 def substring_maker(inputstring, start, end, index=0):
     return (inputstring.split(start))[-1].split(end)[index]
 
@@ -122,6 +129,19 @@ def get_digest(file_path):
     return h.hexdigest()
 
 
+def get_includes(actionfile):
+    return config["ACTIONMAPPINGS"][all_files.index(actionfile)].get("includes", [])
+
+
+# hash an action together with everything shipped in its zip, so a change to an include or a shared module redeploys it
+def get_action_digest(actionfile):
+    h = hashlib.sha256()
+    files = [actionfile] + [get_root_dir() + "/" + include for include in get_includes(actionfile)] + shared_sources
+    for file_path in files:
+        h.update(get_digest(file_path).encode())
+    return h.hexdigest()
+
+
 # create urlstart for noweb actions
 def getURL(web=False):
     if web:
@@ -149,7 +169,7 @@ all_files = [get_root_dir() + "/" + obj["filename"] for obj in config["ACTIONMAP
 
 if fresh_start:
     for file in all_files:
-        config["FILEHASHES"][file] = get_digest(file)
+        config["FILEHASHES"][file] = get_action_digest(file)
 
 # init secretmanager module
 os.system("cp secret_manager.py secretmanager.py")
@@ -164,7 +184,7 @@ for line in fileinput.input("secretmanager.py", inplace=True):
     sys.stdout.write(line)
 
 for actionfile in all_files:
-    if get_digest(actionfile) != config["FILEHASHES"][actionfile] or fresh_start:
+    if get_action_digest(actionfile) != config["FILEHASHES"].get(actionfile) or fresh_start:
         actionname = substring_maker(actionfile, "/", ".py")
         print("start process for {}".format(actionname))
 
@@ -173,10 +193,21 @@ for actionfile in all_files:
         timeout = config["ACTIONMAPPINGS"][all_files.index(actionfile)]["timeout"]
         memory = config["ACTIONMAPPINGS"][all_files.index(actionfile)]["memory"]
 
+        # other action modules, which this action imports and runs in-process
+        includes = get_includes(actionfile)
+        include_names = [os.path.basename(include) for include in includes]
+        # includes from this directory are already in place, they must neither be copied nor removed afterwards
+        copied_names = [os.path.basename(include) for include in includes
+                        if os.path.dirname(os.path.abspath(get_root_dir() + "/" + include)) != os.getcwd()]
+
         os.system("cp {} __main__.py".format(actionfile))
+        for include in includes:
+            if os.path.basename(include) in copied_names:
+                os.system("cp {} .".format(get_root_dir() + "/" + include))
 
         os.system("{}action delete {}".format(clistart, actionname))
-        os.system("zip -r {}.zip virtualenv __main__.py osnapi.py secretmanager.py > /dev/null".format(actionname))
+        os.system("zip -r {}.zip virtualenv __main__.py {} {} > /dev/null".format(
+            actionname, " ".join(shared_modules), " ".join(include_names)))
         os.system(
             "{}action create {} --kind python:3 {}.zip --timeout {} --memory {} --web {}".format(clistart,
                                                                                                  actionname,
@@ -185,6 +216,8 @@ for actionfile in all_files:
                                                                                                  memory,
                                                                                                  web_state))
         os.system("rm {}.zip".format(actionname))
+        for include_name in copied_names:
+            os.system("rm {}".format(include_name))
 
 os.system("rm __main__.py")
 
@@ -203,7 +236,7 @@ if fresh_start:
         "{}action create completesequenceaction --sequence metasequenceaction,valuesequenceaction".format(clistart))
 
 for file in all_files:
-    config["FILEHASHES"][file] = get_digest(file)
+    config["FILEHASHES"][file] = get_action_digest(file)
 
 with open(config_path, 'w') as outfile:
     json.dump(config, outfile)
@@ -0,0 +1,86 @@
+"""backfill.py: Splits the archives of the dwd's `historical` directories, which span decades, into time windows that
+can be imported independently, and remembers per station which windows are done"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import calendar
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+from pymongo.collection import Collection
+
+try: from mongodb import mongo_conn
+except: from deployment_tmp.mongodb import mongo_conn
+
+HISTORICAL_FTP_PATH = "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/historical/"
+WINDOW_YEARS = 1 # a year of hourly values is ~8760 rows per measurand, which comfortably fits into one invocation
+
+Window = Tuple[int, int] # [start, end) in hours since the epoch, like the timestamps of the content handler
+
+# e.g. stundenwerte_TU_00003_19500401_20110331_hist.zip
+_HIST_NAME = re.compile(r'_(\d+)_(\d{4})\d{4}_(\d{4})\d{4}_hist\.zip$')
+
+
+#######################################
+#               WINDOWS               #
+#######################################
+def year_to_hour(year:int) -> int:
+    """Hours since the epoch at the start of January 1st of the year."""
+    return calendar.timegm((year, 1, 1, 0, 0, 0)) // 3600
+
+def parse_hist_name(file_name:str) -> Optional[Tuple[str, int, int]]:
+    """The station id (without leading zeros, like in local ids), and the first and last year of a historical archive.
+    Returns None for files whose name doesn't follow the naming scheme, e.g. those of the `recent` directories."""
+    match = _HIST_NAME.search(file_name)
+    if match is None: return None
+    station, first_year, last_year = match.groups()
+    return str(int(station)), int(first_year), int(last_year)
+
+def year_windows(first_year:int, last_year:int, years:int=WINDOW_YEARS) -> List[Window]:
+    """Windows of `years` calendar years each, that together cover first_year to last_year (inclusive)."""
+    assert years >= 1, f'a window has to span at least one year, not {years}'
+    return [(year_to_hour(y), year_to_hour(min(y + years, last_year + 1))) for y in range(first_year, last_year + 1, years)]
+
+def file_windows(file_name:str, years:int=WINDOW_YEARS) -> List[Optional[Window]]:
+    """The windows of an archive, as told by its name. A file without dates in its name is a single window (None)."""
+    parsed = parse_hist_name(file_name)
+    return [None] if parsed is None else year_windows(*parsed[1:], years=years)
+
+
+#######################################
+#             CHECKPOINTS             #
+#######################################
+# NOTE(florian): One document per station and measurand: {'_id': '3-temperature', 'done': [[start, end], ...]}.
+# Windows are only ever added with $addToSet, so workers that finish windows of the same station at the same time
+# don't overwrite each others progress.
+def checkpoint_conn(db_url:str) -> Collection: return mongo_conn(db_url, name='backfill', check_available=False)
+
+def _checkpoint_id(station:str, measurand:str) -> str: return f'{station}-{measurand}'
+
+def done_windows(collection:Collection, file_names:List[str], measurand:str) -> Dict[str, Set[Window]]:
+    """The windows that were already imported, per station, with a single query."""
+    ids = {_checkpoint_id(parsed[0], measurand) for parsed in map(parse_hist_name, file_names) if parsed is not None}
+    if not ids: return {}
+    return {d['_id']: {tuple(w) for w in d.get('done', [])} for d in collection.find({'_id': {'$in': list(ids)}})}
+
+def pending_windows(collection:Collection, file_names:List[str], measurand:str,
+                    years:int=WINDOW_YEARS) -> Dict[str, List[Optional[Window]]]:
+    """The windows of every file that still have to be imported. Files that are done entirely are left out."""
+    done, pending = done_windows(collection, file_names, measurand), {}
+    for name in file_names:
+        parsed = parse_hist_name(name)
+        skip = set() if parsed is None else done.get(_checkpoint_id(parsed[0], measurand), set())
+        windows = [w for w in file_windows(name, years) if w not in skip]
+        if windows: pending[name] = windows
+    return pending
+
+def is_done(collection:Collection, file_name:str, measurand:str, window:Window) -> bool:
+    parsed = parse_hist_name(file_name)
+    if parsed is None: return False
+    return collection.find_one({'_id': _checkpoint_id(parsed[0], measurand), 'done': list(window)}, {'_id': 1}) is not None
+
+def mark_done(collection:Collection, file_name:str, measurand:str, window:Window) -> None:
+    parsed = parse_hist_name(file_name)
+    if parsed is None: return
+    collection.update_one({'_id': _checkpoint_id(parsed[0], measurand)},
+                          {'$addToSet': {'done': list(window)}, '$set': {'file': file_name}}, upsert=True)
@@ -31,7 +31,8 @@ __CONFIGTEMPLATE__ = '''{"ACTIONMAPPINGS": [
                                   "actionname": "getcsvaction",
                                   "memory": 128,
                                   "timeout": 300000,
-                                  "web": true
+                                  "web": true,
+                                  "includes": ["src/value_handling/handle_content_data_action.py"]
                                 },
                                 {
                                   "filename": "src/sensor_handling/handle_meta_data_action.py",
@@ -47,19 +48,46 @@ __CONFIGTEMPLATE__ = '''{"ACTIONMAPPINGS": [
                                   "timeout": 300000,
                                   "web": true
                                 },
+                                {
+                                  "filename": "src/station_action.py",
+                                  "actionname": "stationaction",
+                                  "memory": 128,
+                                  "timeout": 300000,
+                                  "web": false,
+                                  "includes": ["deployment_tmp/backfill.py",
+                                               "src/sensor_handling/get_meta_data_action.py",
+                                               "src/sensor_handling/handle_meta_data_action.py",
+                                               "src/value_handling/get_csv_action.py",
+                                               "src/value_handling/handle_content_data_action.py"]
+                                },
+                                {
+                                  "filename": "src/worker_action.py",
+                                  "actionname": "workeraction",
+                                  "memory": 128,
+                                  "timeout": 300000,
+                                  "web": false,
+                                  "includes": ["deployment_tmp/backfill.py",
+                                               "src/station_action.py",
+                                               "src/sensor_handling/get_meta_data_action.py",
+                                               "src/sensor_handling/handle_meta_data_action.py",
+                                               "src/value_handling/get_csv_action.py",
+                                               "src/value_handling/handle_content_data_action.py"]
+                                },
                                 {
                                   "filename": "src/filenamesplitter_action.py",
                                   "actionname": "filenamesplitteraction",
                                   "memory": 128,
                                   "timeout": 300000,
-                                  "web": true
+                                  "web": true,
+                                  "includes": ["deployment_tmp/backfill.py"]
                                 },
                                 {
                                   "filename": "src/handle_config.py",
                                   "actionname": "handleconfig",
                                   "memory": 128,
                                   "timeout": 300000,
-                                  "web": true
+                                  "web": true,
+                                  "includes": ["deployment_tmp/migrate.py"]
                                 }
                               ],
                               "WSKPROPSPATH": "",
@@ -0,0 +1,325 @@
+"""dwdftp.py: Helpers for the DWD open data FTP server"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import hashlib
+import io
+import mmap
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from ftplib import FTP, error_perm, error_reply, error_temp
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+try: from mongodb import mongo_conn
+except: from deployment_tmp.mongodb import mongo_conn
+
+try: import metrics
+except: import deployment_tmp.metrics as metrics
+
+FTP_HOST    = 'ftp-cdc.dwd.de'
+FTP_PORT    = 21
+FTP_TIMEOUT = 30 # seconds, for connecting and for every read on the control and data connection
+POOL_SIZE   = 4 # max nr of idle connections that are kept, and of parallel downloads
+RETRIES     = 3 # per download, after the first attempt
+IDLE_CHECK_SEC = 10 # connections that were idle for longer are checked with a NOOP before they are reused
+
+# NOTE(florian): A fingerprint is (size, modify) of a file, where modify is the YYYYMMDDHHMMSS time of its last change.
+# DWD replaces the zips of `recent` data in place, so a changed fingerprint means the file has to be imported again.
+Fingerprint = Tuple[int, str]
+
+
+#######################################
+#             CONNECTIONS             #
+#######################################
+# NOTE(florian): Logging in takes a few round trips, so connections are kept in a module level pool and reused for
+# many RETRs, also across invocations of a warm container. Every thread uses its own connection.
+class Connection():
+    """A logged in control connection in binary mode, that reconnects when the server drops it."""
+    def __init__(self, host:str=None, port:int=None):
+        # NOTE(florian): The module level defaults are looked up here, so that they can be pointed at another server,
+        # e.g. a local one for benchmarks.
+        self.host, self.port = host or FTP_HOST, port or FTP_PORT
+        self.ftp, self.last_used = None, 0.
+
+    def open(self) -> FTP:
+        self.close()
+        with metrics.timed('ftp_login'):
+            self.ftp = FTP(timeout=FTP_TIMEOUT)
+            self.ftp.connect(self.host, self.port)
+            self.ftp.login()
+            self.ftp.voidcmd('TYPE I')
+        self.last_used = time.time()
+        return self.ftp
+
+    def close(self) -> None:
+        if self.ftp is None: return
+        try: self.ftp.quit()
+        except Exception: self.ftp.close()
+        self.ftp = None
+
+    def alive(self) -> bool:
+        if self.ftp is None: return False
+        if time.time() - self.last_used < IDLE_CHECK_SEC: return True
+        try: self.ftp.voidcmd('NOOP'); return True
+        except Exception: return False
+
+    def fingerprint(self, path:str) -> Fingerprint:
+        """(size, modify) of a single file, with one MLST, or SIZE and MDTM if the server doesn't support it."""
+        if self.ftp is None: self.open()
+        try:
+            facts = self.ftp.sendcmd(f'MLST {path}').splitlines()[1].strip().split(' ', 1)[0]
+            facts = dict(fact.split('=', 1) for fact in facts.lower().split(';') if '=' in fact)
+            return int(facts['size']), facts['modify']
+        except (error_perm, IndexError, KeyError):
+            self.ftp.voidcmd('TYPE I') # SIZE isn't allowed in ascii mode
+            return self.ftp.size(path), self.ftp.voidcmd(f'MDTM {path}')[4:].strip()
+
+    def retrieve(self, path:str, out:BinaryIO, retries:int=RETRIES) -> int:
+        """RETR path into out. A broken transfer is resumed with REST at the nr of bytes that already arrived.
+        Returns the size of the file."""
+        start = out.tell()
+        for attempt in range(retries + 1):
+            received = out.tell() - start
+            try:
+                if self.ftp is None: self.open()
+                with metrics.timed('ftp_download'): self.ftp.retrbinary(f'RETR {path}', out.write, rest=received or None)
+                self.last_used = time.time()
+                metrics.inc('ftp_bytes', out.tell() - start)
+                return out.tell() - start
+            except error_perm: raise # e.g. the file doesn't exist, retrying won't help
+            except (OSError, EOFError, error_temp, error_reply) as e:
+                print(f'Download of {path} broke after {out.tell() - start} bytes (attempt {attempt + 1}): {e}')
+                metrics.inc('ftp_retries')
+                self.close()
+                if attempt == retries: raise
+
+_idle:List[Connection] = []
+_idle_lock = threading.Lock()
+
+@contextmanager
+def connection() -> Iterator[Connection]:
+    """A connection from the pool, that is given back afterwards. It is thrown away if the block raised, since
+    its state is unknown then."""
+    conn = None
+    with _idle_lock:
+        while _idle and conn is None:
+            conn = _idle.pop()
+            if not conn.alive(): conn.close(); conn = None
+    if conn is None: conn = Connection(); conn.open()
+    try: yield conn
+    except:
+        conn.close()
+        raise
+    with _idle_lock:
+        if len(_idle) < POOL_SIZE: _idle.append(conn); conn = None
+    if conn is not None: conn.close()
+
+def close_all() -> None:
+    with _idle_lock:
+        while _idle: _idle.pop().close()
+
+
+#######################################
+#              DOWNLOADS              #
+#######################################
+def download(path:str, out:BinaryIO) -> int:
+    """Write the file at path on the ftp server into out, using a pooled connection."""
+    with connection() as conn: return conn.retrieve(path, out)
+
+# NOTE(florian): A real temporary file, not a SpooledTemporaryFile. The latter isn't seekable() before python 3.11,
+# which ZipFile.open() needs, and hides the file it rolled over to. This one can be memory mapped by zipview instead.
+def _tempfile(path:str=None) -> BinaryIO: return tempfile.TemporaryFile()
+
+def fetch(path:str) -> BinaryIO:
+    """Download a file into a temporary file, so that memory usage stays bounded for large archives.
+    If a download cache is configured, the file is served from / added to it instead. The caller has to close it."""
+    cache = download_cache()
+    if cache is not None: return cache.fetch(path)
+    out = _tempfile(path)
+    try: download(path, out)
+    except:
+        out.close()
+        raise
+    out.seek(0)
+    return out
+
+def download_many(paths:List[str], open_out:Callable[[str], BinaryIO]=_tempfile, workers:int=POOL_SIZE) -> Dict[str, BinaryIO]:
+    """Download files in parallel, each thread with its own connection. open_out(path) returns the file to write to,
+    a temporary file by default. The returned files are rewound. A failed download raises after the others
+    have finished."""
+    def _download(path:str) -> BinaryIO:
+        out = open_out(path)
+        download(path, out)
+        out.seek(0)
+        return out
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dwdftp') as executor:
+        futures = {path: executor.submit(_download, path) for path in paths}
+    return {path: future.result() for path, future in futures.items()}
+
+
+#######################################
+#            DOWNLOAD CACHE           #
+#######################################
+# NOTE(florian): Optional, for development and reprocessing runs that import the same archives over and over.
+# It is enabled by setting DWD_CACHE_DIR (and optionally DWD_CACHE_MAX_BYTES), or with configure_cache().
+class MappedFile(io.RawIOBase):
+    """A read only, memory mapped file. Reads are served from the page cache, without a read() syscall per chunk."""
+    def __init__(self, path:str):
+        with open(path, 'rb') as f: self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pos = 0
+
+    def readable(self) -> bool: return True
+    def seekable(self) -> bool: return True
+    def tell(self) -> int: return self._pos
+
+    def seek(self, offset:int, whence:int=io.SEEK_SET) -> int:
+        self._pos = max(0, {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._map)}[whence] + offset)
+        return self._pos
+
+    def read(self, size:int=-1) -> bytes:
+        end = len(self._map) if size is None or size < 0 else min(len(self._map), self._pos + size)
+        data = self._map[self._pos:end]
+        self._pos = max(self._pos, end)
+        return data
+
+    def view(self) -> memoryview:
+        """The whole file, without copying it. The view has to be released before the file is closed."""
+        return memoryview(self._map)
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed: self._map.close()
+        super().close()
+
+class DownloadCache():
+    """Downloaded files on disk, addressed by a hash of their path and fingerprint, so a file that changed on the
+    server is a miss. The least recently used files are evicted once the cache grows beyond max_bytes."""
+    def __init__(self, directory:str, max_bytes:int):
+        self.directory, self.max_bytes = directory, max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _file(self, path:str, fingerprint:Fingerprint) -> str:
+        key = hashlib.sha1(f'{path}|{fingerprint[0]}|{fingerprint[1]}'.encode()).hexdigest()
+        return os.path.join(self.directory, f'{key}.zip')
+
+    def _open(self, file:str) -> BinaryIO:
+        os.utime(file) # the mtime of an entry is the time it was last used
+        return MappedFile(file) if os.path.getsize(file) else io.BytesIO() # empty files can't be mapped
+
+    def fetch(self, path:str) -> BinaryIO:
+        with connection() as conn:
+            fingerprint = conn.fingerprint(path)
+            file = self._file(path, fingerprint)
+            if os.path.exists(file):
+                metrics.inc('download_cache_hits')
+                return self._open(file)
+            metrics.inc('download_cache_misses')
+            # NOTE(florian): Written to a temporary file first, so that a broken download never ends up in the cache.
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.part', delete=False) as tmp:
+                try: conn.retrieve(path, tmp)
+                except:
+                    os.remove(tmp.name)
+                    raise
+            os.replace(tmp.name, file)
+        self.evict(keep=file)
+        return self._open(file)
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        """(last used, size, file) of all cached files, least recently used first"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.zip'): continue
+            try: stat = entry.stat()
+            except FileNotFoundError: continue # evicted by another process in the meantime
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self, keep:str=None) -> int:
+        """Remove the least recently used files until the cache fits into max_bytes. Returns the nr of freed bytes."""
+        entries = self.entries()
+        total, freed = sum(size for _, size, _ in entries), 0
+        for _, size, file in entries:
+            if total - freed <= self.max_bytes: break
+            if file == keep: continue
+            try: os.remove(file); freed += size
+            except FileNotFoundError: pass
+        return freed
+
+_cache:Optional[DownloadCache] = None
+
+def configure_cache(directory:Optional[str], max_bytes:int=2 * 1024**3) -> Optional[DownloadCache]:
+    """Enable the download cache in directory, or disable it with None."""
+    global _cache
+    _cache = DownloadCache(directory, max_bytes) if directory else None
+    return _cache
+
+def download_cache() -> Optional[DownloadCache]:
+    if _cache is None and os.environ.get('DWD_CACHE_DIR'):
+        configure_cache(os.environ['DWD_CACHE_DIR'], int(os.environ.get('DWD_CACHE_MAX_BYTES', 2 * 1024**3)))
+    return _cache
+
+
+#######################################
+#               LISTING               #
+#######################################
+def _list_mlsd(ftp:FTP, path:str) -> Dict[str, Fingerprint]:
+    return {name: (int(facts['size']), facts['modify'])
+            for name, facts in ftp.mlsd(path, facts=['type', 'size', 'modify'])
+            if facts.get('type') == 'file' and name.endswith('.zip')}
+
+def _list_nlst(ftp:FTP, path:str) -> Dict[str, Fingerprint]:
+    """Fallback for servers without MLSD, one SIZE and MDTM per file."""
+    names = ftp.nlst(path)
+    ftp.voidcmd('TYPE I') # SIZE isn't allowed in ascii mode, which nlst switches to
+    files = {}
+    for f in names:
+        name = f.split('/')[-1]
+        if not name.endswith('.zip'): continue
+        target = f'{path.rstrip("/")}/{name}'
+        files[name] = (ftp.size(target), ftp.voidcmd(f'MDTM {target}')[4:].strip())
+    return files
+
+def list_dir(ftp:FTP, path:str) -> Dict[str, Fingerprint]:
+    """The zip files of a directory with their fingerprints. Uses a single MLSD if the server supports it."""
+    try: return _list_mlsd(ftp, path)
+    except error_perm: return _list_nlst(ftp, path)
+
+
+#######################################
+#          CHANGE DETECTION           #
+#######################################
+# NOTE(florian): Every file has one document in opensense.ftp_files. `listed` is the fingerprint of the last listing,
+# `imported` the one of the last successful import. A file is emitted as long as the two differ, so that files whose
+# import failed are retried by the next incremental import.
+def files_conn(db_url:str) -> Collection: return mongo_conn(db_url, name='ftp_files')
+
+def _file_id(path:str, name:str) -> str: return f'{path.strip("/")}/{name}'
+
+def changed_files(files:Dict[str, Fingerprint], path:str, collection:Collection) -> List[str]:
+    """Records the fingerprints of a listing and returns the names of the files that are new or have changed."""
+    ids = {_file_id(path, name): name for name in files}
+    imported = {d['_id']: d.get('imported') for d in collection.find({'_id': {'$in': list(ids)}}, {'imported': 1})}
+    changed = [name for _id, name in ids.items() if imported.get(_id) != list(files[name])]
+    if ids:
+        collection.bulk_write([UpdateOne({'_id': _id}, {'$set': {'path': path, 'name': name, 'listed': list(files[name])}},
+                                         upsert=True)
+                               for _id, name in ids.items()], ordered=False)
+    return sorted(changed)
+
+def mark_imported(collection:Collection, path:str, name:str) -> None:
+    """Remembers the listed fingerprint of a file as imported. The listing happened before the download, so at worst
+    a file that changed in between is imported once more."""
+    doc = collection.find_one({'_id': _file_id(path, name)}, {'listed': 1})
+    if doc is not None and doc.get('listed') is not None:
+        collection.update_one({'_id': doc['_id']}, {'$set': {'imported': doc['listed']}})
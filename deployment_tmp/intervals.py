@@ -0,0 +1,51 @@
+"""intervals.py: A set of integer intervals, used to keep track of which timestamps have already been sent"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+from bisect import bisect_left, bisect_right
+from typing import List, Tuple, Iterable, Iterator
+
+Interval = Tuple[int, int]
+
+
+class IntervalSet():
+    """Sorted, non-overlapping, closed intervals [start, end] of ints.
+    Intervals that overlap, or lie at most `gap` apart (e.g. one hour, for hourly data), are coalesced into one."""
+
+    def __init__(self, intervals:Iterable[Interval]=(), gap:int=0):
+        assert gap >= 0, 'can\'t have a negative gap'
+        self.gap = gap
+        self.starts, self.ends = [], []
+        for start, end in sorted(intervals): self.add(start, end)
+
+    def add(self, start:int, end:int) -> Tuple[List[Interval], Interval]:
+        """Insert [start, end] and coalesce it with its neighbours in O(log n) + the nr of merged intervals.
+        Returns the delta: the intervals that were replaced, and the interval that replaced them."""
+        assert start <= end, f'invalid interval: ({start}, {end})'
+        lo = bisect_left(self.ends, start - self.gap) # first interval that ends close enough to, or after, start
+        hi = bisect_right(self.starts, end + self.gap) # intervals from here on start too far after end
+        removed = list(zip(self.starts[lo:hi], self.ends[lo:hi]))
+        if removed: start, end = min(start, removed[0][0]), max(end, removed[-1][1])
+        self.starts[lo:hi], self.ends[lo:hi] = [start], [end]
+        return removed, (start, end)
+
+    def missing(self, start:int, end:int) -> List[Interval]:
+        """The sub-ranges of [start, end] that are not covered by this set."""
+        out, cur = [], start
+        for k in range(bisect_left(self.ends, start), len(self.starts)):
+            s, e = self.starts[k], self.ends[k]
+            if s > end: break
+            if s > cur: out.append((cur, s - 1))
+            cur = max(cur, e + 1)
+            if cur > end: break
+        if cur <= end: out.append((cur, end))
+        return out
+
+    def __contains__(self, x:int) -> bool:
+        k = bisect_right(self.starts, x) - 1
+        return k >= 0 and x <= self.ends[k]
+
+    def __iter__(self) -> Iterator[Interval]: return zip(self.starts, self.ends)
+    def __len__(self) -> int: return len(self.starts)
+    def __eq__(self, other) -> bool: return list(self) == list(other)
+    def __repr__(self) -> str: return f'IntervalSet({list(self)}, gap={self.gap})'
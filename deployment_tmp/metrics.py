@@ -0,0 +1,99 @@
+"""metrics.py: Counters and timings of one action invocation, which are emitted as a single JSON summary at its end"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Iterable, Iterator
+
+
+class Settings():
+    store      = False # add every summary to the aggregates in mongodb, see start() to enable it per invocation
+    bucket_sec = 3600 # aggregates are kept per action and hour
+
+
+#######################################
+#               METRICS               #
+#######################################
+class Metrics():
+    """Counters, and observations like durations or batch sizes, of which the count, sum and max are kept, so that
+    the summaries of many invocations can be added up. Safe to use from several threads."""
+    def __init__(self, action:str='unknown', store:bool=False):
+        self.action, self.started, self.store = action, time.time(), store
+        self.counters:Dict[str, int] = defaultdict(int)
+        self.observations:Dict[str, List[float]] = {} # name -> [count, sum, max]
+        self.lock = threading.Lock()
+
+    def inc(self, name:str, n:int=1) -> None:
+        with self.lock: self.counters[name] += n
+
+    def observe(self, name:str, value:float) -> None:
+        with self.lock:
+            o = self.observations.setdefault(name, [0, 0., value])
+            o[0], o[1], o[2] = o[0] + 1, o[1] + value, max(o[2], value)
+
+    @contextmanager
+    def timed(self, name:str):
+        """Observes the seconds the block took as `name`_sec, also if it raised."""
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(f'{name}_sec', time.perf_counter() - t0)
+
+    def timed_iter(self, name:str, iterable:Iterable) -> Iterator:
+        """Observes the seconds spent producing the items of a lazy iterable, e.g. decompressing lines, in total."""
+        it, seconds = iter(iterable), 0.
+        try:
+            while True:
+                t0 = time.perf_counter()
+                try: item = next(it)
+                except StopIteration: return
+                finally: seconds += time.perf_counter() - t0
+                yield item
+        finally: self.observe(f'{name}_sec', seconds)
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {'action': self.action, 'started': round(self.started, 3),
+                    'seconds': round(time.time() - self.started, 3),
+                    'counters': dict(self.counters),
+                    'observations': {name: {'count': c, 'sum': round(s, 6), 'max': round(m, 6)}
+                                     for name, (c, s, m) in self.observations.items()}}
+
+
+#######################################
+#             INVOCATION              #
+#######################################
+# NOTE(florian): The metrics of the running invocation live on the module, so that the shared modules (ftp, mongodb,
+# osnapi) can record into them without passing anything around. An action calls start() first and finish() last.
+_current = Metrics()
+
+def start(action:str, store=None) -> Metrics:
+    """store overrides Settings.store for this invocation, e.g. with the "storemetrics" param of an action. Params
+    from the cli arrive as strings, so "false" doesn't count as set."""
+    global _current
+    store = Settings.store if store is None else str(store).lower() in ('1', 'true', 'yes')
+    _current = Metrics(action, store)
+    return _current
+
+def current() -> Metrics: return _current
+def inc(name:str, n:int=1) -> None: _current.inc(name, n)
+def observe(name:str, value:float) -> None: _current.observe(name, value)
+def timed(name:str): return _current.timed(name)
+def timed_iter(name:str, iterable:Iterable) -> Iterator: return _current.timed_iter(name, iterable)
+
+def finish(db_url:str=None) -> dict:
+    """Prints the summary of the invocation as one line of JSON, and adds it to the aggregates in mongodb, if db_url
+    is given and storing was enabled in start(). Never raises, metrics must not break an import."""
+    summary = _current.summary()
+    print('METRICS ' + json.dumps(summary, separators=(',', ':')))
+    if db_url is not None and _current.store:
+        try:
+            try: from mongodb import mongo_conn, MetricsStore
+            except: from deployment_tmp.mongodb import mongo_conn, MetricsStore
+            with mongo_conn(db_url, name='metrics', check_available=False) as collection:
+                MetricsStore(collection).save(summary, Settings.bucket_sec)
+        except Exception as e: print(f'Could not store metrics: {e}')
+    return summary
@@ -0,0 +1,73 @@
+"""migrate.py: Moves the contents of the old single `opensense.vals` collection into the mappings, sent and counters
+collections (see the SCHEMA section of mongodb.py), and creates their indexes.
+
+Usage: python deployment_tmp/migrate.py <MONGO_URL>, or handleconfig with `--param migrate yes`"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import sys
+from typing import Dict, List, Tuple
+
+import numpy as np
+from pymongo import UpdateOne, ReplaceOne
+
+try: from intervals import IntervalSet
+except: from deployment_tmp.intervals import IntervalSet
+
+try: from mongodb import WriteBuffer, mongo_conn, mappings_conn, sent_conn, counters_conn, sent_range_id
+except: from deployment_tmp.mongodb import WriteBuffer, mongo_conn, mappings_conn, sent_conn, counters_conn, sent_range_id
+
+LEGACY, BACKUP = 'vals', 'vals_legacy'
+BATCH_SIZE     = 500 # mappings per bulk_write
+# the documents that held the value and action counters, before they got a collection of their own
+LEGACY_COUNTERS = {2: ('values', ('valueCount', 'aimedValueCount')), 5: ('actions', ('actionCount',))}
+
+
+def iso_to_hour(iso_date:str) -> int: return int(np.datetime64(iso_date).astype('datetime64[h]').astype(np.int64))
+
+def sent_ranges(sent_values:List[Tuple[str]]) -> IntervalSet:
+    """The old [from, to] iso date pairs of a sensor as coalesced intervals of hours. Ranges that are merely adjacent
+    are left to the content handler, which knows the gap of the time class."""
+    return IntervalSet([(iso_to_hour(f), iso_to_hour(t)) for f, t in sent_values])
+
+def migrate(db_url:str, batch_size:int=BATCH_SIZE, keep_backup:bool=True) -> Dict[str, int]:
+    """Copies every mapping without its sent_values, every sent range as a document of its own, and the legacy
+    counters as an extra shard of their counter. All writes are upserts, so an interrupted run can simply be repeated.
+    Afterwards `vals` is renamed to `vals_legacy` (or dropped), which makes a second run a no-op."""
+    report = {'mappings': 0, 'sensors': 0, 'ranges': 0, 'counters': 0, 'skipped': 0}
+    with mongo_conn(db_url, name=LEGACY) as legacy, mappings_conn(db_url) as mappings, sent_conn(db_url) as sent, \
+         counters_conn(db_url) as counters, \
+         WriteBuffer(mappings) as mapping_writes, WriteBuffer(sent) as sent_writes, WriteBuffer(counters) as counter_writes:
+        if LEGACY not in legacy.database.list_collection_names(): return report
+        for doc in legacy.find():
+            if doc['_id'] in LEGACY_COUNTERS:
+                # NOTE(florian): A shard with a fixed id is set, not incremented, so a repeated run doesn't count twice.
+                name, fields = LEGACY_COUNTERS[doc['_id']]
+                counter_writes.add(ReplaceOne({'_id': f'{name}:legacy'}, {f: doc.get(f, 0) for f in fields}, upsert=True))
+                report['counters'] += 1
+                continue
+            if 'local_id' not in doc or 'sensors' not in doc:
+                report['skipped'] += 1
+                continue
+            local_id, sensors = doc['local_id'], doc['sensors']
+            for sensor in sensors:
+                for start, end in sent_ranges(sensor.pop('sent_values', [])):
+                    sent_writes.add(UpdateOne({'_id': sent_range_id(local_id, sensor['idx'], start)},
+                                              {'$setOnInsert': {'local_id': local_id, 'idx': sensor['idx'], 'start': start},
+                                               '$max': {'end': end}}, upsert=True))
+                    report['ranges'] += 1
+            # NOTE(florian): Replaced by local_id, so that duplicated mappings of the old collection end up as one.
+            mapping_writes.add(ReplaceOne({'local_id': local_id}, {'local_id': local_id, 'sensors': sensors}, upsert=True))
+            report['mappings'] += 1
+            report['sensors'] += len(sensors)
+            if len(mapping_writes) >= batch_size: mapping_writes.flush(); sent_writes.flush()
+        mapping_writes.flush(); sent_writes.flush(); counter_writes.flush()
+        if keep_backup: legacy.rename(BACKUP)
+        else: legacy.drop()
+    print(f'Migrated {LEGACY}: {report}')
+    return report
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2: sys.exit(__doc__)
+    migrate(sys.argv[1])
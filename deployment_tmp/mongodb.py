@@ -0,0 +1,238 @@
+"""mongodb.py: Helpers to keep the number of round trips to MongoDB low"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import os
+import random
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Hashable, List, Union
+
+from pymongo import MongoClient, InsertOne, UpdateOne, ReplaceOne, DeleteOne, ASCENDING
+from pymongo.collection import Collection
+from pymongo.errors import ConnectionFailure
+
+try: import metrics
+except: import deployment_tmp.metrics as metrics
+
+WriteOp = Union[InsertOne, UpdateOne, ReplaceOne, DeleteOne]
+
+
+class Settings():
+    pool_size        = 10 # max nr of open connections per server
+    min_pool_size    = 0
+    max_idle_ms      = 60_000 # close pooled connections that weren't used for this long
+    timeout_ms       = 10_000 # socket, connect and server selection timeout
+    health_check_sec = 60 # ping the server before handing out the client, if it wasn't checked for this long
+    appname          = 'dwd_agent' # displayed in mongodb server logs
+    counter_shards   = 16 # documents per counter, see Counters
+
+
+#######################################
+#               CLIENT                #
+#######################################
+# NOTE(florian): The client lives on the module, so warm OpenWhisk containers keep its connection pool and
+# server discovery across invocations, instead of paying for both on every mongo_conn().
+_client:MongoClient = None
+_client_key         = None # (db_url, pid) the client was made for. A forked process must not reuse the parents sockets.
+_last_check:float   = 0.
+
+def configure_client(db_url:str, pool_size:int=None, timeout_ms:int=None) -> MongoClient:
+    """(Re)create the shared client, e.g. to change the pool size. Connections of the old client are closed."""
+    global _client, _client_key, _last_check
+    if pool_size  is not None: Settings.pool_size  = pool_size
+    if timeout_ms is not None: Settings.timeout_ms = timeout_ms
+    close_client()
+    _client = MongoClient(db_url,
+                          maxPoolSize=Settings.pool_size, # default 100
+                          minPoolSize=Settings.min_pool_size,
+                          maxIdleTimeMS=Settings.max_idle_ms, # default no limit
+                          socketTimeoutMS=Settings.timeout_ms, # default no limit
+                          connectTimeoutMS=Settings.timeout_ms, # default 20 sec
+                          serverSelectionTimeoutMS=Settings.timeout_ms, # default 30 sec
+                          heartbeatFrequencyMS=10000, # default 10 sec
+                          appname=Settings.appname,
+                          retryWrites=True, # retry once after network failure
+                          uuidRepresentation='standard', # default 'pythonLegacy'
+                         )
+    _client_key, _last_check = (db_url, os.getpid()), 0.
+    return _client
+
+def use_client(db_url:str, client:MongoClient) -> MongoClient:
+    """Make an already created client the shared one for db_url, e.g. a mongomock client in the offline benchmark.
+    It is never health checked."""
+    global _client, _client_key, _last_check
+    close_client()
+    _client, _client_key, _last_check = client, (db_url, os.getpid()), float('inf')
+    return _client
+
+def close_client() -> None:
+    global _client, _client_key
+    if _client is not None: _client.close()
+    _client, _client_key = None, None
+
+def available_check(client:MongoClient) -> None:
+    try: client.admin.command('ismaster')
+    except ConnectionFailure as e:
+        print('MongoDB Server not available.')
+        raise e
+
+def client(db_url:str, check_available:bool=True) -> MongoClient:
+    """The shared client for db_url. The health check only pings the server if it wasn't checked recently.
+    A client that fails it is replaced once, to get rid of connections that died while the container was paused."""
+    global _last_check
+    if _client is None or _client_key != (db_url, os.getpid()): configure_client(db_url)
+    if check_available and time.time() - _last_check > Settings.health_check_sec:
+        try: available_check(_client)
+        except ConnectionFailure: available_check(configure_client(db_url))
+        _last_check = time.time()
+    return _client
+
+@contextmanager
+def mongo_conn(db_url:str, name:str='vals', check_available:bool=True) -> Collection:
+    """A collection of the opensense db on the shared client. Unlike a fresh MongoClient, it stays open afterwards."""
+    yield client(db_url, check_available)['opensense'][name]
+
+
+#######################################
+#               WRITES                #
+#######################################
+class WriteBuffer():
+    """Collects writes to a collection in memory and sends them as a single unordered bulk_write on flush().
+    A keyed write replaces an earlier one with the same key, so that e.g. a document that changes a hundred times
+    during an invocation is only written once.
+    NOTE: The ops of one flush may be applied in any order, so no two of them should touch the same field."""
+
+    def __init__(self, collection:Collection):
+        self.collection = collection
+        self.ops:Dict[Hashable, WriteOp] = {}
+
+    def add(self, op:WriteOp, key:Hashable=None) -> None:
+        self.ops[key if key is not None else ('op', len(self.ops))] = op
+
+    def __len__(self) -> int: return len(self.ops)
+
+    def flush(self) -> int:
+        """Writes everything that was collected since the last flush. Returns the nr of ops that were sent."""
+        ops = list(self.ops.values())
+        self.ops = {}
+        if not ops: return 0
+        with metrics.timed('mongo_bulk_write'): resp = self.collection.bulk_write(ops, ordered=False)
+        metrics.inc('mongo_ops', len(ops))
+        assert resp.acknowledged, f'bulk_write of {len(ops)} ops was not acknowledged'
+        return len(ops)
+
+    def __enter__(self): return self
+    def __exit__(self, *exc) -> None: self.flush() # NOTE: also on errors, so that already sent values are recorded
+
+
+#######################################
+#               SCHEMA                #
+#######################################
+# NOTE(florian): Sensor mappings {'local_id': '3-temperature', 'sensors': [{'idx': 0, 'osn_id': .., ..}, ..]} and the
+# ranges that were sent to osn are kept in collections of their own. A sent range is one document per coalesced
+# interval {'_id': '<local_id>:<idx>:<start>', 'local_id', 'idx', 'start', 'end'} with [start, end] in hours since the
+# epoch, so a sensor with a long history doesn't grow its mapping towards the 16 MB document limit.
+# The documents of the old single `vals` collection are moved over by migrate.py.
+MAPPINGS, SENT, COUNTERS = 'mappings', 'sent', 'counters'
+
+INDEXES = {MAPPINGS: [([('local_id', ASCENDING)], {'unique': True})],
+           SENT    : [([('local_id', ASCENDING), ('idx', ASCENDING), ('start', ASCENDING)], {})]}
+_indexed = set() # (client key, collection name) whose indexes were already ensured by this process
+
+def ensure_indexes(collection:Collection) -> None:
+    """Creates the indexes of the collection once per process. create_index is a no-op for existing indexes,
+    but still a round trip."""
+    key = (_client_key, collection.name)
+    if key in _indexed: return
+    for keys, options in INDEXES.get(collection.name, []): collection.create_index(keys, **options)
+    _indexed.add(key)
+
+@contextmanager
+def indexed_conn(db_url:str, name:str, check_available:bool=True) -> Collection:
+    with mongo_conn(db_url, name=name, check_available=check_available) as collection:
+        ensure_indexes(collection)
+        yield collection
+
+def mappings_conn(db_url:str) -> Collection: return indexed_conn(db_url, MAPPINGS)
+def sent_conn(db_url:str) -> Collection: return indexed_conn(db_url, SENT, check_available=False)
+
+def sent_range_id(local_id:str, idx:int, start:int) -> str: return f'{local_id}:{idx}:{start}'
+
+
+#######################################
+#              COUNTERS               #
+#######################################
+# NOTE(florian): A counter that every worker increments, e.g. the nr of pushed values, would make all of them wait for
+# the lock of the same document. Instead, each counter is spread over Settings.counter_shards documents
+# {'_id': '<name>:<shard>', <field>: <count>, ...} in their own collection, and is summed up when it is read.
+def counters_conn(db_url:str) -> Collection: return mongo_conn(db_url, name=COUNTERS, check_available=False)
+
+class Counters():
+    """Buffers counter increments in memory. flush() adds them with a single unordered bulk_write, one $inc per
+    counter, to a shard that is picked at random, so that parallel invocations rarely write to the same document."""
+
+    def __init__(self, collection:Collection, shards:int=None):
+        self.collection, self.shards = collection, shards or Settings.counter_shards
+        self.counts:Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def inc(self, name:str, field:str, n:int=1) -> None: self.counts[name][field] += n
+
+    def flush(self) -> int:
+        """Returns the nr of counters that were written."""
+        ops = [UpdateOne({'_id': f'{name}:{random.randrange(self.shards)}'}, {'$inc': dict(fields)}, upsert=True)
+               for name, fields in self.counts.items() if any(fields.values())]
+        self.counts = defaultdict(lambda: defaultdict(int))
+        if not ops: return 0
+        with metrics.timed('mongo_bulk_write'): self.collection.bulk_write(ops, ordered=False)
+        metrics.inc('mongo_ops', len(ops))
+        return len(ops)
+
+    def __enter__(self): return self
+    def __exit__(self, *exc) -> None: self.flush() # NOTE: also on errors, the values were pushed anyway
+
+def read_counter(collection:Collection, name:str) -> Dict[str, int]:
+    """The fields of a counter, summed up over all of its shards."""
+    totals = defaultdict(int)
+    for shard in collection.find({'_id': {'$regex': f'^{re.escape(name)}:'}}):
+        for field, n in shard.items():
+            if field != '_id': totals[field] += n
+    return dict(totals)
+
+
+#######################################
+#               STORES                #
+#######################################
+class CacheStore():
+    """Persists the osnapi lookup cache (see osnapi.load_cache/save_cache), one document per entry,
+    so that cold containers can warm their cache without asking the api."""
+    def __init__(self, collection:Collection): self.collection = collection
+
+    def load(self) -> Dict[str, list]:
+        return {d['_id']: [d['expires'], d['value']] for d in self.collection.find({'expires': {'$gt': time.time()}})}
+
+    def save(self, entries:Dict[str, list]) -> None:
+        if not entries: return
+        self.collection.bulk_write([ReplaceOne({'_id': key}, {'expires': expires, 'value': value}, upsert=True)
+                                    for key, (expires, value) in entries.items()], ordered=False)
+
+class MetricsStore():
+    """Adds up the summaries of metrics.finish() per action and time bucket, with a single upsert per invocation,
+    so that the monitorapp can show where the time goes, without reading the logs of every invocation."""
+    def __init__(self, collection:Collection): self.collection = collection
+
+    def save(self, summary:dict, bucket_sec:int=3600) -> None:
+        bucket = int(summary['started'] // bucket_sec * bucket_sec)
+        inc = {'invocations': 1, 'seconds': summary['seconds']}
+        inc.update({f'counters.{name}': n for name, n in summary['counters'].items()})
+        inc.update({f'observations.{name}.{k}': o[k] for name, o in summary['observations'].items() for k in ('count', 'sum')})
+        maxima = {f'observations.{name}.max': o['max'] for name, o in summary['observations'].items()}
+        update = {'$set': {'action': summary['action'], 'bucket': bucket}, '$inc': inc}
+        if maxima: update['$max'] = maxima
+        self.collection.update_one({'_id': f'{summary["action"]}@{bucket}'}, update, upsert=True)
+
+    def load(self, since:float) -> List[dict]:
+        """The aggregates of all buckets that started at or after since (seconds since the epoch)."""
+        return list(self.collection.find({'bucket': {'$gte': since}}))
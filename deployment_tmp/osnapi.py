@@ -4,12 +4,26 @@
 
 __author__ = "Florian Peters https://github.com/flpeters"
 
-__all__ = ['Settings', 'retry_on', 'login', 'getSensors', 'getSensor', 'addSensor', 'deleteSensor', 'mySensors',
+__all__ = ['Settings', 'Overloaded', 'retry_on', 'login', 'getSensors', 'getSensor', 'addSensor', 'deleteSensor', 'mySensors',
            'mySensorIds', 'getFirstLastValueForSensor', 'getValues', 'getValuesForSensor', 'addValue',
            'addMultipleValues', 'profile', 'getMeasurands', 'getMeasurand', 'getLicenses', 'getLicense', 'getUnits',
-           'getUnit']
-
+           'getUnit', 'session', 'configure_session', 'loginAsync', 'addSensorAsync', 'addMultipleValuesAsync', 'cached',
+           'clear_cache', 'load_cache', 'save_cache']
+
+import asyncio
+import functools
+import gzip
+import inspect
+import json
+import threading
+import time
 import requests
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+try: import metrics
+except: import deployment_tmp.metrics as metrics
 
 from typing import List, Tuple, Dict, Union, Optional, Callable
 Sensor                   = Dict[str, Union[int, str, Dict[str, float]]]
@@ -22,10 +36,19 @@ class Settings():
     username     = None
     password     = None
     auth_token   = None
+    pool_size    = 10 # max nr of kept-alive connections to the api
+    timeout      = 30 # seconds per request, well below the 300 sec action timeout. A request that hangs is Overloaded
+    gzip_bodies  = False # compress request bodies, if the server accepts 'content-encoding: gzip'
+    gzip_min_size = 64 * 1024 # bytes, smaller bodies are sent as they are
+    cache_ttl    = 24 * 3600 # seconds that results of @cached lookups stay valid
+    cache_maxsize = 256 # nr of cached results, the least recently used one is dropped first
 
     def __repr__(self):
         return f'api_endpoint:\t{self.api_endpoint}\nusername:\t{self.username}\npassword:\t{self.password}\nauth_token:\t{self.auth_token}'
 
+class Overloaded(Exception):
+    """The server closed the connection (408) or didn't answer in time, probably because the request was too large."""
+
 #######################################
 #               HELPERS               #
 #######################################
@@ -39,19 +62,125 @@ def retry_on(EX:Exception, retries:int=1, on_failure:Callable=None):
                 retry, _tries = False, _tries - 1
                 try: return func(*args, **kwargs)
                 except EX as e: _e, retry = e, on_failure(e)
+                if retry and _tries > 0: metrics.inc('osn_retries')
             else: raise _e
         return _wrapper
     return _retry_on
 
+#######################################
+#                CACHE                #
+#######################################
+# NOTE(florian): Measurands, units and licenses practically never change, so their lookups are memoized per
+# function and arguments. Entries are plain json, so that they can be persisted by a store and used to warm the cache
+# of a cold container without asking the api. A store is anything with load() -> {key: [expires, value]} and save(entries),
+# like mongodb.CacheStore, which handlemetadataaction uses.
+_cache = OrderedDict() # key -> [expires, value], in the order they were last used
+_cache_lock = threading.Lock()
+_cache_dirty = False # whether there are entries that weren't saved to a store yet
+_cache_loaded = False
+
+def _cache_key(func_name:str, signature:inspect.Signature, args:tuple, kwargs:Dict) -> str:
+    """The same key for every way of passing the same arguments, e.g. getMeasurands('x') and getMeasurands(name='x'),
+    so that neither the cache nor its persisted entries miss on a different call style."""
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    return json.dumps([func_name, dict(bound.arguments)], sort_keys=True)
+
+def _cache_put(key:str, expires:float, value) -> None:
+    _cache[key] = [expires, value]
+    _cache.move_to_end(key)
+    while len(_cache) > Settings.cache_maxsize: _cache.popitem(last=False)
+
+def cached(func):
+    """Memoize the results of func by its arguments, for Settings.cache_ttl seconds."""
+    signature = inspect.signature(func)
+    @functools.wraps(func)
+    def _wrapper(*args, **kwargs):
+        global _cache_dirty
+        key = _cache_key(func.__name__, signature, args, kwargs)
+        with _cache_lock:
+            entry = _cache.get(key)
+            if entry is not None and entry[0] > time.time():
+                _cache.move_to_end(key)
+                return entry[1]
+        value = func(*args, **kwargs)
+        with _cache_lock:
+            _cache_put(key, time.time() + Settings.cache_ttl, value)
+            _cache_dirty = True
+        return value
+    return _wrapper
+
+def clear_cache() -> None:
+    global _cache_dirty
+    with _cache_lock: _cache.clear(); _cache_dirty = False
+
+def load_cache(store, force:bool=False) -> int:
+    """Fill the cache with the still valid entries of a store. Only done once per process, unless forced.
+    Returns the nr of loaded entries."""
+    global _cache_loaded
+    if _cache_loaded and not force: return 0
+    now, loaded = time.time(), 0
+    entries = store.load()
+    with _cache_lock:
+        for key, (expires, value) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if expires > now and key not in _cache: _cache_put(key, expires, value); loaded += 1
+        _cache_loaded = True
+    return loaded
+
+def save_cache(store) -> bool:
+    """Write the cache to a store, if it has entries that weren't saved yet."""
+    global _cache_dirty
+    with _cache_lock:
+        if not _cache_dirty: return False
+        entries, _cache_dirty = {key: list(entry) for key, entry in _cache.items()}, False
+    store.save(entries)
+    return True
+
+#######################################
+#               SESSION               #
+#######################################
+# NOTE(florian): The session lives on the module, so warm OpenWhisk containers keep reusing its open connections,
+# instead of doing a new TCP + TLS handshake for every request.
+_session = None
+
+def configure_session(pool_size:int=None) -> requests.Session:
+    """(Re)create the shared session, e.g. to change the pool size. Open connections of the old session are closed."""
+    global _session
+    if pool_size is not None: Settings.pool_size = pool_size
+    if _session is not None: _session.close()
+    _session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=Settings.pool_size)
+    _session.mount('https://', adapter)
+    _session.mount('http://', adapter)
+    _session.headers.update({'accept'         : 'application/json',
+                             'accept-encoding': 'gzip, deflate',
+                             'content-type'   : 'application/json',
+                             'cache-control'  : 'no-cache'})
+    return _session
+
+def session() -> requests.Session:
+    return _session if _session is not None else configure_session()
+
 # Internal
 def generate_headers(requires_auth:bool) -> Dict:
-    headers = {'accept'         : 'application/json',
-               'accept-encoding': 'gzip, deflate',
-               'content-type'   : 'application/json',
-               'cache-control'  : 'no-cache'}
-    if requires_auth:
-        headers['Authorization'] = Settings.auth_token
-    return headers
+    """Headers that differ per request. Everything else is set on the session."""
+    return {'Authorization': Settings.auth_token} if requires_auth else {}
+
+# Internal
+def encode_body(body:Dict, headers:Dict) -> bytes:
+    data = json.dumps(body).encode('utf-8')
+    if Settings.gzip_bodies and len(data) >= Settings.gzip_min_size:
+        data = gzip.compress(data, compresslevel=5)
+        headers['content-encoding'] = 'gzip'
+    return data
+
+# Internal
+def _request(method:str, query:str, **kwargs) -> requests.Response:
+    try:
+        with metrics.timed('osn_request'): return session().request(method, url=query, timeout=Settings.timeout, **kwargs)
+    except requests.Timeout as e:
+        metrics.inc('osn_timeouts')
+        raise Overloaded(f'The Server did not answer within {Settings.timeout} sec.\n--Request to    : {query}') from e
 
 # Internal
 def handle_response(query:str, response:requests.Response) -> Union[Dict, str]:
@@ -66,7 +195,8 @@ def handle_response(query:str, response:requests.Response) -> Union[Dict, str]:
         Try logging in and repeating the Request.{info}')
 
     if response.status_code == 408:
-        raise Exception(f'The Server has closed this connection, probably due to the request being too large,\
+        metrics.inc('osn_overloaded')
+        raise Overloaded(f'The Server has closed this connection, probably due to the request being too large,\
         or the server being under heavy load. Try sending less data at once.{info}')
 
     raise Exception(f'Something went wrong with your request.{info}')
@@ -82,19 +212,20 @@ def _try_login(_):
 @retry_on(PermissionError, retries=1, on_failure=_try_login)
 def send_get(query:str, requires_auth:bool=False) -> Dict:
     headers = generate_headers(requires_auth)
-    response = requests.get(url=query,headers=headers)
+    response = _request('GET', query, headers=headers)
     return handle_response(query, response)
 
 @retry_on(PermissionError, retries=1, on_failure=_try_login)
 def send_post(query:str, body:Dict, requires_auth:bool=False) -> Dict:
     headers = generate_headers(requires_auth)
-    response = requests.post(url=query, json=body, headers=headers)
+    data = encode_body(body, headers)
+    response = _request('POST', query, data=data, headers=headers)
     return handle_response(query, response)
 
 @retry_on(PermissionError, retries=1, on_failure=_try_login)
 def send_delete(query:str, requires_auth:bool=False) -> Dict:
     headers = generate_headers(requires_auth)
-    response = requests.delete(url=query, headers=headers)
+    response = _request('DELETE', query, headers=headers)
     return handle_response(query, response)
 
 # Internal
@@ -222,11 +353,13 @@ def profile() -> List[Dict[str, Union[str, int]]]:
 #######################################
 #              MEASURANDS             #
 #######################################
+@cached
 def getMeasurands(name:str=None) -> List[Measurand]:
     args = locals()
     query = build_query(target='/measurands', **args)
     return send_get(query)
 
+@cached
 def getMeasurand(id:int) -> Measurand:
     query = build_query(target=f'/measurands/{id}')
     return send_get(query)
@@ -234,6 +367,7 @@ def getMeasurand(id:int) -> Measurand:
 #######################################
 #               LICENSES              #
 #######################################
+@cached
 def getLicenses(shortName:str=None,
                 allowsDerivatives:bool=None,
                 allowsRedistribution:bool=None,
@@ -245,6 +379,7 @@ def getLicenses(shortName:str=None,
     query = build_query(target='/licenses', **args)
     return send_get(query)
 
+@cached
 def getLicense(id:int) -> License:
     query = build_query(target=f'/licenses/{id}')
     return send_get(query)
@@ -252,12 +387,38 @@ def getLicense(id:int) -> License:
 #######################################
 #                UNITS                #
 #######################################
+@cached
 def getUnits(name:str=None,
              measurandId:int=None) -> List[Unit]:
     args = locals()
     query = build_query(target='/units', **args)
     return send_get(query)
 
+@cached
 def getUnit(id:int) -> Unit:
     query = build_query(target=f'/units/{id}')
-    return send_get(query)
\ No newline at end of file
+    return send_get(query)
+
+#######################################
+#                ASYNC                #
+#######################################
+# NOTE(florian): The async variants don't do non-blocking I/O. Each one runs the blocking `requests` call on a thread
+# pool of Settings.pool_size threads, which share the pooled session, and only the wait for that thread is awaited.
+# So at most pool_size calls are in flight at once, whatever concurrency a caller asks for. The variants refer to the
+# module level functions from their body, which resolves them when called, so retry wrappers that callers monkey
+# patch onto this module (e.g. api.addMultipleValues = retry(api.addMultipleValues)) are applied as well.
+_executor = None
+
+def _run_async(func:Callable, *args, **kwargs):
+    global _executor
+    if _executor is None: _executor = ThreadPoolExecutor(max_workers=Settings.pool_size, thread_name_prefix='osnapi')
+    return asyncio.get_running_loop().run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+async def loginAsync(username:str, password:str) -> str:
+    return await _run_async(login, username, password)
+
+async def addSensorAsync(body:Sensor) -> Sensor:
+    return await _run_async(addSensor, body)
+
+async def addMultipleValuesAsync(body:Dict[str, List[Value]]) -> str:
+    return await _run_async(addMultipleValues, body)
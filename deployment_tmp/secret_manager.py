@@ -19,15 +19,23 @@ __MONGOURL__ = '"MONGOURL"'
 import requests
 
 
-def complete_sequence(rest_filenames):
+def complete_sequence(rest_filenames, action="completesequenceaction", ftp_url=None):
+    """
+    starts the sequence for the next file. the ftp_url of the listing is handed on, so that every file of a run is
+    downloaded from the directory it was listed in
+    """
     filename = rest_filenames[0]
     rest_names = rest_filenames[1:]
+    response = None
     if not rest_names[0].startswith("end"):
+        params = {"filename": filename,
+                  "restfilenames": rest_names}
+        if ftp_url is not None:
+            params["ftp_url"] = ftp_url
         try:
-            response = requests.post(__URLAPINOWEB__ + "completesequenceaction",
+            response = requests.post(__URLAPINOWEB__ + action,
                                      auth=(__OPENWHISKUSERNAME__, __OPENWHISKPWD__),
-                                     json={"filename": filename,
-                                           "restfilenames": rest_names},
+                                     json=params,
                                      verify=False)
             print(response)
         except Exception as e:
@@ -38,9 +46,28 @@ def complete_sequence(rest_filenames):
     return response
 
 
-def get_filename_list_action(path="climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/"):
+def start_worker(budget=None, lease=None):
+    """invokes a workeraction without waiting for it, workers claim their files from the work queue themselves"""
+    params = {key: value for key, value in (("budget", budget), ("lease", lease)) if value is not None}
+    response = None
+    try:
+        response = requests.post(__URLAPINOWEB__ + "workeraction",
+                                 auth=(__OPENWHISKUSERNAME__, __OPENWHISKPWD__),
+                                 json=params,
+                                 verify=False)
+        print(response)
+    except Exception as e:
+        print("could not start worker Exception is {}".format(e))
+    return response
+
+
+def get_filename_list_action(path="climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/",
+                             incremental=False):
+    data = {"path": path}
+    if incremental:
+        # only sent when set, since a form encoded False would arrive as the truthy string "False"
+        data["incremental"] = True
     namelist = requests.get(__URLAPI__ + "getfilenamesaction.json",
-                            data={
-                                "path": path},
+                            data=data,
                             verify=False).json()
     return namelist
@@ -0,0 +1,123 @@
+"""workqueue.py: A MongoDB backed queue of station files, which workers lease one at a time"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import time
+from typing import List, Optional, Dict, Tuple
+
+from pymongo import ReturnDocument, UpdateOne, ASCENDING
+from pymongo.collection import Collection
+
+try: from mongodb import mongo_conn
+except: from deployment_tmp.mongodb import mongo_conn
+
+# NOTE(florian): A job is one station file. Its state goes pending -> leased -> done, or back to pending on failure.
+# A leased job whose lease_until has passed is treated like a pending one, so files of crashed workers are retried.
+# Backfill jobs are time windows of a file. Only the first window of a file starts out pending, the others are blocked
+# by it (blocked_by is its id) until it is done, so that the sensors of the file are created by a single worker.
+PENDING, LEASED, DONE, FAILED, BLOCKED = 'pending', 'leased', 'done', 'failed', 'blocked'
+LEASE_SEC    = 300 # the default OpenWhisk action timeout
+MAX_ATTEMPTS = 3
+
+Job = Dict[str, object]
+
+
+def queue_conn(db_url:str) -> Collection: return mongo_conn(db_url, name='queue', check_available=False)
+
+def _claimable(now:float, max_attempts:int) -> dict:
+    return {'attempts': {'$lt': max_attempts},
+            '$or': [{'state': PENDING},
+                    {'state': LEASED, 'lease_until': {'$lt': now}}]}
+
+def _requeue(filter:dict, fields:dict) -> List[UpdateOne]:
+    """Creates a job, or resets an existing one, unless a worker currently holds a lease on it. Resetting a running job
+    would let a second worker import the same file, and the first one's complete() would then not match anymore."""
+    now = time.time()
+    return [UpdateOne(filter=filter, update={'$setOnInsert': fields}, upsert=True),
+            UpdateOne(filter={**filter, '$or': [{'state': {'$ne': LEASED}}, {'lease_until': {'$lt': now}}]},
+                      update={'$set': fields})]
+
+def enqueue(queue:Collection, filenames:List[str], ftp_url:str, measurand:str) -> int:
+    """Add files to the queue. Files that are already queued are reset to pending, so a new import retries them,
+    except for those that are leased right now."""
+    queue.create_index([('state', ASCENDING), ('lease_until', ASCENDING)])
+    if not filenames: return 0
+    requests = [op for name in filenames
+                for op in _requeue({'_id': name}, {'state': PENDING, 'ftp_url': ftp_url, 'measurand': measurand,
+                                                   'lease_until': 0, 'attempts': 0, 'worker': None, 'error': None})]
+    result = queue.bulk_write(requests, ordered=False)
+    return result.upserted_count + result.modified_count
+
+def _window_id(filename:str, window:Optional[Tuple[int, int]]) -> str:
+    return filename if window is None else f'{filename}@{window[0]}-{window[1]}'
+
+def enqueue_windows(queue:Collection, windows:Dict[str, List[Optional[Tuple[int, int]]]], ftp_url:str, measurand:str) -> int:
+    """Add one job per time window of each file (see backfill.py). The first window of a file is pending,
+    the others are blocked until it is done."""
+    queue.create_index([('state', ASCENDING), ('lease_until', ASCENDING)])
+    queue.create_index([('blocked_by', ASCENDING), ('state', ASCENDING)])
+    requests = [op for name, file_windows in windows.items() for k, window in enumerate(file_windows)
+                for op in _requeue({'_id': _window_id(name, window)},
+                                   {'state': PENDING if k == 0 else BLOCKED, 'filename': name,
+                                    'blocked_by': None if k == 0 else _window_id(name, file_windows[0]),
+                                    'window': None if window is None else list(window),
+                                    'ftp_url': ftp_url, 'measurand': measurand,
+                                    'lease_until': 0, 'attempts': 0, 'worker': None, 'error': None})]
+    if not requests: return 0
+    result = queue.bulk_write(requests, ordered=False)
+    return result.upserted_count + result.modified_count
+
+def _fail_blocked(queue:Collection, first_windows:List[str]) -> int:
+    """The windows that are blocked by a failed first window would never be unblocked, so they fail along with it.
+    Only the windows of the run that queued the first window are blocked by its id, not those of earlier runs."""
+    if not first_windows: return 0
+    result = queue.update_many(filter={'blocked_by': {'$in': first_windows}, 'state': BLOCKED},
+                               update={'$set': {'state': FAILED, 'error': 'the first window of the file failed'}})
+    return result.modified_count
+
+def expire(queue:Collection, max_attempts:int=MAX_ATTEMPTS) -> int:
+    """Gives up on jobs whose worker crashed or timed out during their last attempt. claim() counts an attempt when
+    the lease is taken, so such a job would otherwise stay leased forever. Returns the nr of jobs that failed."""
+    expired = {'state': LEASED, 'lease_until': {'$lt': time.time()}, 'attempts': {'$gte': max_attempts}}
+    jobs = list(queue.find(filter=expired, projection={'_id': 1}))
+    if not jobs: return 0
+    result = queue.update_many(filter={**expired, '_id': {'$in': [job['_id'] for job in jobs]}},
+                               update={'$set': {'state': FAILED, 'lease_until': 0,
+                                                'error': f'lease expired in attempt {max_attempts}'}})
+    _fail_blocked(queue, [job['_id'] for job in jobs])
+    return result.modified_count
+
+def claim(queue:Collection, worker:str, lease_sec:float=LEASE_SEC, max_attempts:int=MAX_ATTEMPTS) -> Optional[Job]:
+    """Atomically lease the next claimable file to a worker. Returns None if there is nothing to claim right now."""
+    expire(queue, max_attempts)
+    now = time.time()
+    return queue.find_one_and_update(filter=_claimable(now, max_attempts),
+                                     update={'$set': {'state': LEASED, 'lease_until': now + lease_sec, 'worker': worker},
+                                             '$inc': {'attempts': 1}},
+                                     sort=[('lease_until', ASCENDING)],
+                                     return_document=ReturnDocument.AFTER)
+
+def complete(queue:Collection, job:Job) -> None:
+    queue.update_one(filter={'_id': job['_id'], 'worker': job['worker']}, update={'$set': {'state': DONE}})
+    if job.get('filename') is not None: # the remaining windows of the file can now be imported in parallel
+        queue.update_many(filter={'blocked_by': job['_id'], 'state': BLOCKED}, update={'$set': {'state': PENDING}})
+
+def release(queue:Collection, job:Job, error:str, max_attempts:int=MAX_ATTEMPTS) -> None:
+    """Give a failed file back to the queue, or give up on it after max_attempts."""
+    state = FAILED if job['attempts'] >= max_attempts else PENDING
+    result = queue.update_one(filter={'_id': job['_id'], 'worker': job['worker']},
+                              update={'$set': {'state': state, 'lease_until': 0, 'error': error}})
+    if state == FAILED and result.modified_count: _fail_blocked(queue, [job['_id']])
+
+def has_claimable(queue:Collection, max_attempts:int=MAX_ATTEMPTS) -> bool:
+    return queue.find_one(filter=_claimable(time.time(), max_attempts)) is not None
+
+def counts(queue:Collection, max_attempts:int=MAX_ATTEMPTS) -> Dict[str, int]:
+    """The nr of jobs per state. Jobs that can never run anymore are marked failed first, so they show up as such,
+    instead of as leased or blocked."""
+    expire(queue, max_attempts)
+    # NOTE(florian): Only the first windows that still block something are looked at, not every failed job. Failures
+    # of earlier runs, e.g. with other window sizes, have other ids, and mustn't fail the blocked windows of this one.
+    first_windows = queue.distinct('blocked_by', {'state': BLOCKED})
+    _fail_blocked(queue, queue.distinct('_id', {'_id': {'$in': first_windows}, 'state': FAILED}))
+    return {d['_id']: d['count'] for d in queue.aggregate([{'$group': {'_id': '$state', 'count': {'$sum': 1}}}])}
@@ -0,0 +1,143 @@
+"""zipview.py: Reads the members of station zips straight out of the memory mapped (or in memory) archive, without
+copying the archive or a whole member into intermediate bytes objects"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import codecs
+import io
+import mmap
+import struct
+import weakref
+import zlib
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
+from zipfile import ZipFile, ZipInfo, BadZipFile, ZIP_STORED, ZIP_DEFLATED
+
+try: import dwdftp
+except: import deployment_tmp.dwdftp as dwdftp
+
+CHUNK_SIZE = 64 * 1024 # compressed bytes that are read from the view at once, and max uncompressed bytes per chunk
+
+_LOCAL_HEADER = struct.Struct('<4s22xHH') # signature, (version .. uncompressed size), name length, extra length
+_LOCAL_SIGNATURE = b'PK\003\004'
+
+
+#######################################
+#               BUFFERS               #
+#######################################
+def _buffer(file:BinaryIO) -> Tuple[Optional[memoryview], Optional[mmap.mmap]]:
+    """A read only view of the whole file, and the map that was created for it, if any.
+    (None, None) for files that can neither be mapped nor viewed, e.g. pipes or empty files."""
+    if isinstance(file, dwdftp.MappedFile): return file.view(), None
+    if isinstance(file, io.BytesIO): return file.getbuffer(), None
+    try: fileno = file.fileno()
+    except (AttributeError, OSError): return None, None
+    try: file.flush()
+    except (AttributeError, OSError): pass
+    try: own_map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError): return None, None
+    return memoryview(own_map), own_map
+
+
+#######################################
+#             MAPPED ZIP              #
+#######################################
+class MappedZip(ZipFile):
+    """A ZipFile whose members can also be read as a stream of chunks that are inflated straight from a view of the
+    archive, see iter_chunks(). The central directory is still parsed by ZipFile, which only reads a few KB.
+    Archives that can't be viewed, and members that aren't stored or deflated, fall back to ZipFile.open().
+    NOTE: The view has to be released before the underlying file is closed, so close this first, e.g. with
+    `with sensorzip, MappedZip(sensorzip) as myzip`. Members that are still being read are closed along with it."""
+    _view:Optional[memoryview] = None
+    _map :Optional[mmap.mmap]  = None
+    _members:weakref.WeakSet   = weakref.WeakSet()
+
+    def __init__(self, file:Union[str, BinaryIO]):
+        super().__init__(file, 'r')
+        self._members = weakref.WeakSet() # the generators of iter_chunks() that weren't exhausted yet
+        self._view, self._map = _buffer(self.fp) if self.fp is not None else (None, None)
+
+    def close(self) -> None:
+        # NOTE(florian): A member that wasn't read to the end, e.g. because parsing raised, still holds a view of the
+        # archive, which would make releasing it raise a BufferError that hides the actual exception.
+        for member in list(self._members): member.close()
+        self._members = weakref.WeakSet()
+        if self._view is not None: self._view.release()
+        if self._map is not None: self._map.close()
+        self._view = self._map = None
+        super().close()
+
+    def raw_view(self, info:ZipInfo) -> memoryview:
+        """The compressed bytes of a member. The caller has to release() the view."""
+        offset = info.header_offset
+        signature, name_length, extra_length = _LOCAL_HEADER.unpack_from(self._view, offset)
+        if signature != _LOCAL_SIGNATURE: raise BadZipFile(f'bad local file header of {info.filename}')
+        start = offset + _LOCAL_HEADER.size + name_length + extra_length
+        return self._view[start:start + info.compress_size]
+
+    def _viewable(self, info:ZipInfo) -> bool:
+        encrypted = info.flag_bits & 0x1
+        return self._view is not None and not encrypted and info.compress_type in (ZIP_STORED, ZIP_DEFLATED)
+
+    def iter_chunks(self, name:Union[str, ZipInfo], chunk_size:int=CHUNK_SIZE) -> Iterator[bytes]:
+        """The uncompressed content of a member in chunks of at most chunk_size, so memory stays flat however large
+        the member is. The crc is checked at the end, like ZipFile does. A stored member is yielded as views of the
+        archive, which are only valid until the next chunk is requested."""
+        chunks = self._iter_chunks(name if isinstance(name, ZipInfo) else self.getinfo(name), chunk_size)
+        self._members.add(chunks)
+        return chunks
+
+    def _iter_chunks(self, info:ZipInfo, chunk_size:int) -> Iterator[bytes]:
+        if not self._viewable(info):
+            with self.open(info) as member: yield from iter(lambda: member.read(chunk_size), b'')
+            return
+        raw, crc = self.raw_view(info), 0
+        try:
+            inflater = zlib.decompressobj(-zlib.MAX_WBITS) if info.compress_type == ZIP_DEFLATED else None
+            for pos in range(0, len(raw), chunk_size):
+                with raw[pos:pos + chunk_size] as piece: # NOTE: a view that isn't released keeps the map from closing
+                    if inflater is None:
+                        crc = zlib.crc32(piece, crc)
+                        yield piece
+                        continue
+                    out = inflater.decompress(piece, chunk_size)
+                # NOTE(florian): The output is bounded, because text inflates 10-100x. Only the part of a piece that
+                # didn't fit into a chunk is ever copied, as unconsumed_tail.
+                while True:
+                    crc = zlib.crc32(out, crc)
+                    if out: yield out
+                    if not inflater.unconsumed_tail: break
+                    out = inflater.decompress(inflater.unconsumed_tail, chunk_size)
+            if inflater is not None:
+                out = inflater.flush()
+                crc = zlib.crc32(out, crc)
+                if out: yield out
+        finally: raw.release()
+        if crc != info.CRC: raise BadZipFile(f'bad crc of {info.filename}')
+
+
+#######################################
+#               MEMBERS               #
+#######################################
+def _chunks(myzip:ZipFile, name:str) -> Iterator[bytes]:
+    if isinstance(myzip, MappedZip): return myzip.iter_chunks(name)
+    def _read():
+        with myzip.open(name) as member: yield from iter(lambda: member.read(CHUNK_SIZE), b'')
+    return _read()
+
+def iter_lines(myzip:ZipFile, name:str, encoding:str='latin-1') -> Iterator[str]:
+    """Lazily decodes a member line by line, without the trailing line break. Works with any ZipFile."""
+    decoder, rest, chunks = codecs.getincrementaldecoder(encoding)(), '', _chunks(myzip, name)
+    try:
+        for chunk in chunks:
+            lines = (rest + decoder.decode(chunk)).split('\n')
+            rest = lines.pop()
+            for line in lines: yield line.rstrip('\r')
+    finally: chunks.close()
+    rest += decoder.decode(b'', final=True)
+    if rest: yield rest.rstrip('\r')
+
+def read_text(myzip:ZipFile, name:str, encoding:str='latin-1') -> str:
+    """The decoded content of a small member, e.g. the station metadata."""
+    decoder, chunks = codecs.getincrementaldecoder(encoding)(), _chunks(myzip, name)
+    try: return ''.join([decoder.decode(chunk) for chunk in chunks] + [decoder.decode(b'', final=True)])
+    finally: chunks.close()
@@ -89,6 +89,36 @@ def verify_calls(calls):
         return "1"
 
 
+def verify_mode(mode):
+    if mode in ("station", "queue", "backfill"):
+        result = mode
+    else:
+        result = "sequence"
+    return result
+
+
+def verify_incremental(incremental):
+    if incremental is not None and incremental.lower() == "true":
+        result = "true"
+    else:
+        result = "false"
+    return result
+
+
+def verify_years(years):
+    try:
+        return str(max(1, int(years)))
+    except (TypeError, ValueError):
+        return "1"
+
+
+def verify_hours(hours):
+    try:
+        return str(max(1, int(hours)))
+    except (TypeError, ValueError):
+        return "24"
+
+
 def verify_fresh(fresh):
     if fresh.lower() == "true":
         result = "true"
@@ -178,6 +208,34 @@ def logs():
     return result
 
 
+@app.route('/metrics/')
+def getMetrics():
+    """
+    Sums up the metrics that the actions recorded in the metrics collection of the MongoDB
+    :param hours how far to look back, 24 by default
+    :return: {message:<html list of where the time of each action went>, metrics:{action: aggregates}}
+    """
+    hours = verify_hours(request.args.get('hours'))
+    result = os.popen(clistart + ' action invoke handleconfig --blocking --result --param metrics {}'.format(hours)).read()
+    try:
+        summary = json.loads(result)["metrics"]
+    except (ValueError, KeyError):
+        return {"message": "<li>no metrics available</li>", "metrics": {}}
+    message = ""
+    for action, aggregates in sorted(summary.items()):
+        timings = sorted(((name[:-len("_sec")], o) for name, o in aggregates["observations"].items()
+                          if name.endswith("_sec")), key=lambda x: -x[1]["sum"])
+        message += "<li><b>{}</b>: {} invocations, {:.1f} sec<ul>".format(action, aggregates["invocations"],
+                                                                         aggregates["seconds"])
+        for name, o in timings:
+            message += "<li>{}: {:.1f} sec total, {:.3f} sec avg, {:.3f} sec max ({}x)</li>".format(
+                name, o["sum"], o["avg"], o["max"], o["count"])
+        for name, n in sorted(aggregates["counters"].items()):
+            message += "<li>{}: {}</li>".format(name, n)
+        message += "</ul></li>"
+    return {"message": message, "metrics": summary}
+
+
 @app.route('/deploy/')
 def deployActions():
     """
@@ -196,12 +254,19 @@ def importData():
     """
     Starts an import process with optional scale
     :param calls
+    :param mode <sequence|station|queue|backfill>
+    :param incremental <true|false> only import files that are new or changed since their last import
+    :param years size of the time windows of the backfill mode
     :return:
     """
     with lock:
         calls = verify_calls(request.args.get('calls'))
+        mode = verify_mode(request.args.get('mode'))
+        incremental = verify_incremental(request.args.get('incremental'))
+        years = verify_years(request.args.get('years'))
         result = os.popen(
-            clistart + 'action invoke filenamesplitteraction --blocking --result --param calls {}'.format(calls)).read()
+            clistart + 'action invoke filenamesplitteraction --blocking --result --param calls {} --param mode {} '
+                       '--param incremental {} --param years {}'.format(calls, mode, incremental, years)).read()
         action_expected = [int(s) for s in result.split() if s.isdigit()]
     return {"actionsExpected": action_expected[0]}
 
@@ -256,7 +321,8 @@ def clearMongoDB():
     :return:
     """
     with lock:
-        stats = os.popen(clistart + ' action invoke handleconfig --blocking --result --param rewrite yes').read()
+        stats = os.popen(clistart + ' action invoke handleconfig --blocking --result --param rewrite yes'
+                                    ' --param dropmappings yes').read()
 
     return {"message": stats}
 
@@ -0,0 +1,342 @@
+"""
+benchmark.py: Runs the import pipeline offline and reports its throughput, so that regressions are caught before they
+reach production. Synthetic station zips are served by a local ftp server, values are pushed to a fake osn api with
+configurable latency and 408s, and MongoDB is replaced by mongomock, or a local mongod.
+
+    python -m src.benchmark --stations 4 --years 5 --concurrency 4 --latency 0.02 --overload-rate 0.05
+
+Needs `pyftpdlib` (or --no-ftp) and `mongomock` (or --mongo mongodb://localhost:27017), which are only used here.
+"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import argparse
+import gzip
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Iterator, List, Tuple
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+
+import deployment_tmp.metrics as metrics
+import deployment_tmp.secret_manager as secretmanager
+import deployment_tmp.zipview as zipview
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+try: import mongomock
+except ImportError: mongomock = None
+
+FTP_PATH = "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/"
+FIRST_STATION = 90_000 # above all real dwd station ids, so that a local mongod with real data isn't touched
+MONGOMOCK_URL = 'mongomock://benchmark'
+
+# the content columns of the synthetic product files, after STATIONS_ID;MESS_DATUM;QN_9
+PRODUCT_COLUMNS = {'temperature': ('TT_TU', 'RF_TU'),
+                   'all'        : ('TT_TU', 'RF_TU', 'V_N', 'P', 'P0', 'F', 'D', 'R1', 'SD_SO')}
+
+
+#######################################
+#           SYNTHETIC DATA            #
+#######################################
+def _column_values(column:str, hours:np.ndarray, rng:np.random.RandomState) -> np.ndarray:
+    """Plausible values with a daily and yearly cycle, so that they compress like real data."""
+    day, year = 2 * np.pi * (hours % 24) / 24, 2 * np.pi * (hours % 8766) / 8766
+    noise = rng.normal(size=len(hours))
+    if column == 'TT_TU': return np.round(9 - 9 * np.cos(year) - 4 * np.cos(day) + noise, 1)
+    if column == 'RF_TU': return np.round(np.clip(80 + 10 * np.cos(day) + 5 * noise, 0, 100), 0)
+    if column == 'V_N'  : return rng.randint(0, 9, size=len(hours)).astype(np.float64)
+    if column in ('P', 'P0'): return np.round(1013 + 8 * noise - (40 if column == 'P0' else 0), 1)
+    if column == 'F'    : return np.round(np.abs(3 + 2 * noise), 1)
+    if column == 'D'    : return rng.randint(0, 36, size=len(hours)) * 10.
+    if column == 'R1'   : return np.round(np.where(rng.rand(len(hours)) < .1, np.abs(noise), 0.), 1)
+    if column == 'SD_SO': return np.where(np.sin(day - np.pi / 2) > 0, rng.randint(0, 61, size=len(hours)), 0.)
+    raise ValueError(f'unknown column: {column}')
+
+def product_lines(station:int, start_hour:int, nr_of_hours:int, columns:Tuple[str, ...],
+                  missing_rate:float=0.01, seed:int=0) -> Iterator[str]:
+    """The lines of a `produkt_*` file. Values are replaced by -999 (missing) with the given probability."""
+    rng = np.random.RandomState(seed + station)
+    hours = np.arange(start_hour, start_hour + nr_of_hours, dtype=np.int64)
+    dates = np.char.replace(np.char.replace(np.datetime_as_string(hours.astype('datetime64[h]'), unit='h'), '-', ''), 'T', '')
+    values = []
+    for column in columns:
+        v = _column_values(column, hours, rng)
+        v[rng.rand(len(v)) < missing_rate] = -999
+        values.append(v.tolist())
+    yield 'STATIONS_ID;MESS_DATUM;QN_9;' + ';'.join(columns) + ';eor'
+    for date, *row in zip(dates.tolist(), *values):
+        yield f'{station:>11};{date};    3;' + ';'.join(f'{x:>6}' for x in row) + ';eor'
+
+def meta_data(station:int, start_hour:int, nr_of_hours:int, periods:int=2) -> str:
+    """A `Metadaten_Geographie_*` file, where the station moved (periods - 1) times. The last period is still open."""
+    bounds = np.linspace(start_hour, start_hour + nr_of_hours, periods + 1).astype(np.int64) // 24 * 24
+    days = [str(np.datetime64(int(b), 'h').astype('datetime64[D]')).replace('-', '') for b in bounds]
+    lines = ['Stations_id;Stationshoehe;Geogr.Breite;Geogr.Laenge;von_datum;bis_datum;Stationsname']
+    for k in range(periods):
+        lines.append(f'{station:>5};  {100 + k:>3};  {50 + k / 100:.4f};   {8 + k / 100:.4f};{days[k]};'
+                     f'{days[k + 1] if k < periods - 1 else ""};Benchmark {station}')
+    return '\r\n'.join(lines) + '\r\n'
+
+def station_zip(path:str, station:int, start_hour:int, nr_of_hours:int, columns:Tuple[str, ...],
+                periods:int=2, missing_rate:float=0.01, seed:int=0) -> int:
+    """Writes a station zip like the dwd's to path. Returns its nr of product rows."""
+    with ZipFile(path, 'w', ZIP_DEFLATED) as z:
+        z.writestr(f'Metadaten_Geographie_{station:05d}.txt', meta_data(station, start_hour, nr_of_hours, periods).encode('latin-1'))
+        lines = product_lines(station, start_hour, nr_of_hours, columns, missing_rate, seed)
+        z.writestr(f'produkt_tu_stunde_{station:05d}.txt', '\r\n'.join(lines).encode('latin-1') + b'\r\n')
+    return nr_of_hours
+
+def build_stations(root:str, nr_of_stations:int, years:float, measurand:str,
+                   periods:int=2, missing_rate:float=0.01, seed:int=0) -> Dict[str, int]:
+    """Writes the station zips into root/FTP_PATH. Returns {file name: nr of product rows}."""
+    os.makedirs(os.path.join(root, FTP_PATH), exist_ok=True)
+    nr_of_hours, start_hour = int(years * 8766), int(np.datetime64('2000-01-01T00', 'h').astype(np.int64))
+    files = {}
+    for station in range(FIRST_STATION, FIRST_STATION + nr_of_stations):
+        name = f'stundenwerte_TU_{station:05d}_akt.zip'
+        files[name] = station_zip(os.path.join(root, FTP_PATH, name), station, start_hour, nr_of_hours,
+                                  PRODUCT_COLUMNS[measurand], periods, missing_rate, seed)
+    return files
+
+
+#######################################
+#            FAKE SERVERS             #
+#######################################
+def serve_ftp(root:str) -> Tuple[object, int]:
+    """An anonymous, read only ftp server for root on a free local port, running in a background thread."""
+    if ThreadedFTPServer is None: raise ImportError('the local ftp server needs pyftpdlib, or run with --no-ftp')
+    import logging
+    logger = logging.getLogger('pyftpdlib') # it logs every command otherwise
+    logger.addHandler(logging.NullHandler()); logger.propagate = False
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    handler = type('BenchmarkFTPHandler', (FTPHandler,), {'authorizer': authorizer, 'banner': 'benchmark'})
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True).start()
+    return server, server.address[1]
+
+class FakeOSN():
+    """Just enough of the opensense api for the importer. Every request takes `latency` seconds, plus
+    `latency_per_value` per pushed value. Pushes are answered with a 408 with probability `overload_rate`, and always
+    if they contain more than `max_values` values, like the real server does when it is overloaded."""
+    def __init__(self, latency:float=0., latency_per_value:float=0., overload_rate:float=0.,
+                 max_values:int=None, seed:int=0):
+        self.latency, self.latency_per_value = latency, latency_per_value
+        self.overload_rate, self.max_values = overload_rate, max_values
+        self.rng, self.lock = random.Random(seed), threading.Lock()
+        self.stats = {'requests': 0, 'pushes': 0, 'values': 0, 'overloaded': 0, 'sensors': 0}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def endpoint(self) -> str: return f'http://127.0.0.1:{self.server.server_address[1]}/api/v1.0'
+
+    def close(self) -> None: self.server.shutdown(); self.server.server_close()
+
+    def _count(self, **kwargs) -> Dict[str, int]:
+        with self.lock:
+            for key, n in kwargs.items(): self.stats[key] += n
+            return dict(self.stats)
+
+    def _overloaded(self, nr_of_values:int) -> bool:
+        if self.max_values is not None and nr_of_values > self.max_values: return True
+        with self.lock: return self.rng.random() < self.overload_rate
+
+    def _handler(self):
+        osn = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive, like the real api
+            def log_message(self, *args): pass
+            def _reply(self, status:int, body) -> None:
+                data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('content-type', 'text/plain' if isinstance(body, str) else 'application/json')
+                self.send_header('content-length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            def do_GET(self):
+                osn._count(requests=1)
+                time.sleep(osn.latency)
+                path = self.path.split('?')[0]
+                self._reply(200, {'id': 1} if path.rstrip('/').split('/')[-1].isdigit() else [{'id': 1}])
+            def do_POST(self):
+                osn._count(requests=1)
+                data = self.rfile.read(int(self.headers.get('content-length', 0)))
+                if self.headers.get('content-encoding') == 'gzip': data = gzip.decompress(data)
+                body, path = json.loads(data or b'{}'), self.path.split('?')[0]
+                if path.endswith('/users/login'):
+                    time.sleep(osn.latency); return self._reply(200, {'id': 'benchmark-token'})
+                if path.endswith('/sensors/addSensor'):
+                    time.sleep(osn.latency)
+                    return self._reply(200, {'id': FIRST_STATION * 100 + osn._count(sensors=1)['sensors']})
+                if path.endswith('/sensors/addMultipleValues'):
+                    nr_of_values = len(body.get('collapsedMessages', ()))
+                    time.sleep(osn.latency + osn.latency_per_value * nr_of_values)
+                    if osn._overloaded(nr_of_values):
+                        osn._count(overloaded=1); return self._reply(408, 'Request Timeout')
+                    osn._count(pushes=1, values=nr_of_values)
+                    return self._reply(200, 'OK')
+                self._reply(404, 'Not Found')
+        return Handler
+
+
+#######################################
+#               STAGES                #
+#######################################
+class Stages():
+    """Wall clock seconds spent per stage of the pipeline."""
+    def __init__(self): self.seconds:Dict[str, float] = {}
+
+    def add(self, stage:str, seconds:float) -> None: self.seconds[stage] = self.seconds.get(stage, 0.) + seconds
+
+    @contextmanager
+    def timed(self, stage:str):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.add(stage, time.perf_counter() - t0)
+
+    def timed_iter(self, stage:str, iterable:Iterable) -> Iterator:
+        """Only counts the time spent producing items, not the time the consumer spends with them. That way, the
+        lazy decompression of a product file is attributed to get_csv_action, even though it's driven by the parser."""
+        it = iter(iterable)
+        while True:
+            t0 = time.perf_counter()
+            try: item = next(it)
+            except StopIteration: self.add(stage, time.perf_counter() - t0); return
+            self.add(stage, time.perf_counter() - t0)
+            yield item
+
+def import_station(name:str, measurand:str, concurrency:int, stages:Stages, use_ftp:bool, root:str) -> None:
+    """What stationaction does for a file, with every action's part timed as its own stage."""
+    import src.sensor_handling.get_meta_data_action as get_meta_data
+    import src.sensor_handling.handle_meta_data_action as handle_meta_data
+    import src.value_handling.get_csv_action as get_csv
+    import src.value_handling.handle_content_data_action as content_handler
+    with stages.timed('get_csv_action'):
+        sensorzip = get_csv.download_zip(FTP_PATH + name) if use_ftp else open(os.path.join(root, FTP_PATH, name), 'rb')
+    with sensorzip, zipview.MappedZip(sensorzip) as myzip:
+        measurands = None
+        if measurand == content_handler.ALL:
+            lines = get_csv.iter_product_lines(myzip)
+            _, field_defs = content_handler.parse_header(next(lines))
+            lines.close()
+            measurands = list(content_handler.measurand_columns(field_defs))
+        with stages.timed('handle_meta_data_action'):
+            handle_meta_data.parse_metadata(get_meta_data.read_meta_data(myzip), measurand, measurands=measurands)
+        read_before = stages.seconds['get_csv_action']
+        with stages.timed('handle_content_data_action'):
+            lines = stages.timed_iter('get_csv_action', get_csv.iter_product_lines(myzip))
+            content_handler.handle_content_lines(lines, measurand=measurand, concurrency=concurrency)
+        # the parser reads the lines lazily, that time was already counted for get_csv_action
+        stages.add('handle_content_data_action', read_before - stages.seconds['get_csv_action'])
+
+
+#######################################
+#                MAIN                 #
+#######################################
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024 # bytes on macOS, KiB on linux
+
+def setup_mongo(mongo_url:str) -> None:
+    """Points the importer at a local mongod, or at mongomock. Has to run before the actions are imported,
+    because they read the url from secretmanager when they are loaded."""
+    import deployment_tmp.mongodb as mongodb
+    if mongo_url is None:
+        if mongomock is None: raise ImportError('the benchmark needs mongomock, or a local mongod via --mongo')
+        secretmanager.__MONGOURL__ = MONGOMOCK_URL
+        mongodb.use_client(MONGOMOCK_URL, mongomock.MongoClient())
+        return
+    secretmanager.__MONGOURL__ = mongo_url
+    benchmark_ids = {'local_id': {'$regex': f'^{FIRST_STATION // 10_000}\\d{{4}}-'}}
+    for conn in (mongodb.mappings_conn, mongodb.sent_conn): # values of an earlier run would already count as sent
+        with conn(mongo_url) as collection: collection.delete_many(benchmark_ids)
+
+def run(args) -> dict:
+    root = tempfile.mkdtemp(prefix='dwd_benchmark_')
+    ftp_server = osn = None
+    try:
+        t0 = time.perf_counter()
+        files = build_stations(root, args.stations, args.years, args.measurand, args.periods, args.missing_rate, args.seed)
+        print(f'built {len(files)} station zips with {sum(files.values())} rows in {time.perf_counter() - t0:.2f} sec',
+              file=sys.stderr)
+        setup_mongo(args.mongo)
+
+        import deployment_tmp.osnapi as api
+        import deployment_tmp.dwdftp as dwdftp
+        osn = FakeOSN(args.latency, args.latency_per_value, args.overload_rate, args.max_values, args.seed)
+        api.Settings.api_endpoint = osn.endpoint
+        if not args.no_ftp:
+            ftp_server, dwdftp.FTP_PORT = serve_ftp(root)
+            dwdftp.FTP_HOST = '127.0.0.1'
+
+        stages = Stages()
+        metrics.start('benchmark')
+        t0 = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+            for name in files:
+                import_station(name, args.measurand, args.concurrency, stages, not args.no_ftp, root)
+        seconds = time.perf_counter() - t0
+        return {'stations': args.stations, 'rows': sum(files.values()), 'values_pushed': osn.stats['values'],
+                'seconds': round(seconds, 3),
+                'rows_per_sec': round(sum(files.values()) / seconds, 1),
+                'values_per_sec': round(osn.stats['values'] / seconds, 1),
+                'peak_rss_mb': round(peak_rss_mb(), 1),
+                'stages': {stage: round(s, 3) for stage, s in stages.seconds.items()},
+                'osn': dict(osn.stats),
+                'metrics': metrics.current().summary()}
+    finally:
+        if osn is not None: osn.close()
+        if ftp_server is not None:
+            import deployment_tmp.dwdftp as dwdftp
+            dwdftp.close_all(); ftp_server.close_all()
+        shutil.rmtree(root, ignore_errors=True)
+
+def parse_args(argv:List[str]=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stations', type=int, default=2, help='nr of station zips')
+    parser.add_argument('--years', type=float, default=2, help='of hourly rows per station')
+    parser.add_argument('--periods', type=int, default=2, help='nr of sensors per measurand and station')
+    parser.add_argument('--measurand', choices=sorted(PRODUCT_COLUMNS), default='temperature')
+    parser.add_argument('--concurrency', type=int, default=1, help='parallel pushes per sensor')
+    parser.add_argument('--missing-rate', type=float, default=0.01, help='share of values that are -999')
+    parser.add_argument('--latency', type=float, default=0., help='seconds per osn request')
+    parser.add_argument('--latency-per-value', type=float, default=0., help='additional seconds per pushed value')
+    parser.add_argument('--overload-rate', type=float, default=0., help='share of pushes that get a 408')
+    parser.add_argument('--max-values', type=int, default=None, help='pushes with more values always get a 408')
+    parser.add_argument('--mongo', default=None, help='url of a local mongod, instead of mongomock')
+    parser.add_argument('--no-ftp', action='store_true', help='read the zips from disk, instead of a local ftp server')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='also write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the actions')
+    return parser.parse_args(argv)
+
+def main(argv:List[str]=None) -> dict:
+    args = parse_args(argv)
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.json is not None:
+        with open(args.json, 'w') as f: json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -9,9 +9,13 @@ import warnings
 
 from src.sensor_handling.get_meta_data_action import main as get_meta_data
 from src.sensor_handling.handle_meta_data_action import main as handle_meta_data
+from src.station_action import handle_station
 from src.value_handling.get_csv_action import main as get_csv_data
 from src.value_handling.get_ftp_filenames_action import main as get_file_names
 from src.value_handling.handle_content_data_action import main as handle_content_data
+import deployment_tmp.dwdftp as dwdftp
+
+FTP_PATH = "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/"
 
 
 # TODO: Implement MOCK OSNAPI and MOCK secretmanager to run functions locally and test them
@@ -25,17 +29,33 @@ def split_list(alist, wanted_parts=1):
 if not sys.warnoptions:
     warnings.simplefilter("ignore")
 
+# --station imports each file with the fused station action, instead of the four chained actions
+use_station_action = "--station" in sys.argv[1:]
+
 
 def main():
     try:
-        namelist = get_file_names({"path": "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/"})
+        namelist = get_file_names({"path": FTP_PATH})
         print(namelist)
     except Exception as e:
         print(e)
         return {"message": "fail in namelist"}
     name_list_array = namelist["filenames"].split(",")
+    prefetched = {}
+    if use_station_action:
+        # download the selected files in parallel, over a small pool of reused ftp connections
+        zip_names = [name for name in name_list_array[10:12] if name.endswith(".zip")]
+        downloads = dwdftp.download_many([FTP_PATH + name for name in zip_names])
+        prefetched = {name: downloads[FTP_PATH + name] for name in zip_names}
     for name in name_list_array[10:12]:
-        if name.endswith(".zip"):
+        if name.endswith(".zip") and use_station_action:
+            print("Handle Station from", name)
+            try:
+                handle_station(name, sensorzip=prefetched.get(name))
+            except Exception as e:
+                print("Error in station", e)
+            print(name)
+        elif name.endswith(".zip"):
             print("Handle Complete Data from", name)
             try:
                 metadata = get_meta_data({"filename": name})
@@ -10,6 +10,23 @@ try:
 except:
     import deployment_tmp.secret_manager as secretmanager
 
+try:
+    import workqueue
+except:
+    import deployment_tmp.workqueue as workqueue
+
+try:
+    import backfill
+except:
+    import deployment_tmp.backfill as backfill
+
+try:
+    import metrics
+except:
+    import deployment_tmp.metrics as metrics
+
+DEFAULT_FTP_PATH = "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/"
+
 
 def split_list(alist, wanted_parts=1):
     length = len(alist)
@@ -17,30 +34,90 @@ def split_list(alist, wanted_parts=1):
             for i in range(wanted_parts)]
 
 
+def start_queue(zip_list_array, workers, args):
+    """
+    puts all files into the work queue and starts the given nr of workers, which then claim files by themselves
+    instead of being handed a fixed list of files
+    """
+    with workqueue.queue_conn(secretmanager.__MONGOURL__) as queue:
+        queued = workqueue.enqueue(queue, zip_list_array,
+                                   ftp_url=args.get("ftp_url", DEFAULT_FTP_PATH),
+                                   measurand=args.get("measurand", "temperature"))
+    for _ in range(workers):
+        secretmanager.start_worker(args.get("budget"), args.get("lease"))
+    return {"message": "tried to start file proccesses : " + str(queued) + " with workers : " + str(workers)}
+
+
+def start_backfill(workers, args):
+    """
+    splits the archives of the historical directory into windows of "years" years, puts every window that wasn't
+    imported yet into the work queue and starts the given nr of workers. the first window of each file creates its
+    sensors, the others are then imported in parallel
+    """
+    ftp_url = args.get("ftp_url", backfill.HISTORICAL_FTP_PATH)
+    measurand = args.get("measurand", "temperature")
+    namelist = secretmanager.get_filename_list_action(path=ftp_url)
+    zip_list_array = [x for x in namelist["filenames"].split(",") if x.endswith(".zip")]
+    with backfill.checkpoint_conn(secretmanager.__MONGOURL__) as checkpoints:
+        windows = backfill.pending_windows(checkpoints, zip_list_array, measurand,
+                                           years=args.get("years", backfill.WINDOW_YEARS))
+    with workqueue.queue_conn(secretmanager.__MONGOURL__) as queue:
+        queued = workqueue.enqueue_windows(queue, windows, ftp_url=ftp_url, measurand=measurand)
+    for _ in range(workers):
+        secretmanager.start_worker(args.get("budget"), args.get("lease"))
+    return {"message": "tried to start windows : " + str(queued) + " of files : " + str(len(windows)) +
+                       " with workers : " + str(workers)}
+
+
 if not sys.warnoptions:
     warnings.simplefilter("ignore")
 
 
 def main(args):
+    metrics.start("filenamesplitteraction", store=args.get("storemetrics"))
+    try:
+        return start_import(args)
+    finally:
+        metrics.finish(secretmanager.__MONGOURL__)
+
+
+def start_import(args):
     pipeline_calls = args.get("calls", 1)
+    # "station" runs each file through the single fused stationaction instead of the completesequenceaction chain,
+    # "queue" puts all files into the work queue and starts "calls" workers
+    action = "stationaction" if args.get("mode", "sequence") == "station" else "completesequenceaction"
+    if pipeline_calls >= 1 and args.get("mode", "sequence") == "backfill":
+        # "backfill" imports the historical archives in time windows, through the work queue like "queue"
+        try:
+            return start_backfill(pipeline_calls, args)
+        except Exception as e:
+            print(e)
+            return {"message": "fail in backfill"}
+    # the directory that is listed is also the one the files are downloaded from, in every mode
+    ftp_url = args.get("ftp_url", DEFAULT_FTP_PATH)
     try:
-        namelist = secretmanager.get_filename_list_action()
+        # with "incremental", only files that are new or changed since their last import are listed
+        incremental = str(args.get("incremental", "")).lower() in ("1", "true", "yes")
+        namelist = secretmanager.get_filename_list_action(path=ftp_url, incremental=incremental)
         print("namelist len unsplitted (should be 1) {}".format(len(namelist)))
     except Exception as e:
         print(e)
         return {"message": "fail in namelist"}
     name_list_array = namelist["filenames"].split(",")
     zip_list_array = [x for x in name_list_array if x.endswith(".zip") and x is not None]
+    metrics.inc("files_listed", len(zip_list_array))
 
     print("Init call Complete Data ", len(zip_list_array))
     if pipeline_calls < 1:
         return {"message": "troll someone else"}
+    if args.get("mode", "sequence") == "queue":
+        return start_queue(zip_list_array, pipeline_calls, args)
     if pipeline_calls == 1:
         zip_list_array.append("end")
         zip_list_array.append("end")
         if len(zip_list_array) > 1:
             try:
-                response = secretmanager.complete_sequence(zip_list_array)
+                response = secretmanager.complete_sequence(zip_list_array, action=action, ftp_url=ftp_url)
                 print(response)
             except Exception as e:
                 print("send handle completedata events to URLAPIcompletesequenceaction", e)
@@ -51,7 +128,7 @@ def main(args):
             x.append("end")
             if len(x) > 1:
                 try:
-                    response = secretmanager.complete_sequence(x)
+                    response = secretmanager.complete_sequence(x, action=action, ftp_url=ftp_url)
                     print(response)
                 except Exception as e:
                     print("send handle completedata events to URLAPIcompletesequenceaction", e)
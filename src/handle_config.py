@@ -1,14 +1,31 @@
+import time
+
 from pymongo import MongoClient
 try:
     import secretmanager
 except:
     import deployment_tmp.secret_manager as secretmanager
 
+try:
+    from mongodb import read_counter
+except:
+    from deployment_tmp.mongodb import read_counter
+
+try:
+    import migrate
+except:
+    import deployment_tmp.migrate as migrate
+
 
 cluster = MongoClient(secretmanager.__MONGOURL__)
 
 db = cluster["opensense"]
-collection = db["vals"]
+# sensor mappings, and the ranges of values that were sent for their sensors (see mongodb.py)
+collection = db["mappings"]
+sent_collection = db["sent"]
+metrics_collection = db["metrics"]
+# the counters are spread over several documents each, so that parallel actions don't wait for each other
+counters_collection = db["counters"]
 
 post_value_count = {
     "_id": 2,
@@ -22,35 +39,64 @@ post_handlecontentdataaction_count = {
 }
 
 
+def read_counters():
+    """
+    sums up the shards of the value and action counters, in the shape of the documents that the monitor expects
+    """
+    values = dict(post_value_count, **read_counter(counters_collection, "values"))
+    actions = dict(post_handlecontentdataaction_count, **read_counter(counters_collection, "actions"))
+    return [values, actions]
+
+
+def summarize_metrics(hours):
+    """
+    adds up the hourly metric aggregates of the last hours per action (see metrics.py), so that the monitor can show
+    where the time goes. observations get their average next to count, sum and max
+    """
+    summary = {}
+    for bucket in metrics_collection.find({"bucket": {"$gte": time.time() - hours * 3600}}):
+        action = summary.setdefault(bucket["action"], {"invocations": 0, "seconds": 0, "counters": {}, "observations": {}})
+        action["invocations"] += bucket.get("invocations", 0)
+        action["seconds"] += bucket.get("seconds", 0)
+        for name, n in bucket.get("counters", {}).items():
+            action["counters"][name] = action["counters"].get(name, 0) + n
+        for name, o in bucket.get("observations", {}).items():
+            total = action["observations"].setdefault(name, {"count": 0, "sum": 0, "max": 0})
+            total["count"] += o.get("count", 0)
+            total["sum"] += o.get("sum", 0)
+            total["max"] = max(total["max"], o.get("max", 0))
+    for action in summary.values():
+        for o in action["observations"].values():
+            o["avg"] = o["sum"] / o["count"] if o["count"] else 0
+    return summary
+
+
 def main(args):
-    id_to_print = args.get("printID", "")
+    metrics_hours = args.get("metrics")
+    if metrics_hours is not None:
+        return {"metrics": summarize_metrics(float(metrics_hours))}
+    if args.get("migrate", "no") == "yes":
+        # moves the contents of the old vals collection into the collections above, once
+        return {"migrated": migrate.migrate(secretmanager.__MONGOURL__)}
+    id_to_print = str(args.get("printID", ""))
     update = args.get("rewrite", "no")
     clear = args.get("clear", "no")
-    if clear == "yes":
-        # have to be run one time to init db
-        collection.delete_many({})
-    if update == "yes":
-        # have to be run one time to init db
+    drop_mappings = args.get("dropmappings", "no")
+    if clear == "yes" or update == "yes":
+        # resets the counters, their shards are then created by their first increment
+        counters_collection.delete_many({})
+    if drop_mappings == "yes":
+        # deletes every sensor mapping and sent range, so the next import creates all sensors on opensense again.
+        # kept apart from rewrite and clear on purpose
         collection.delete_many({})
-        print(post_value_count)
-        collection.insert_one(post_value_count)
-
-        print(post_handlecontentdataaction_count)
-        collection.insert_one(post_handlecontentdataaction_count)
-    resultlist = []
-    try:
-        printID = int(id_to_print)
-        if printID == 10:
-            result = collection.find_one({"_id": 2})  # to find only one do find_one
-            resultlist.append(result)
-            result = collection.find_one({"_id": 5})  # to find only one do find_one
-            resultlist.append(result)
-        else:
-            result = collection.find_one({"_id": printID})  # to find only one do find_one
-            resultlist.append(result)
-    except Exception as e:
-        results = collection.find({})  # to find only one do find_one
-        for result in results:
-            resultlist.append(result)
-        return {"message": "Document count {}".format(len(resultlist))}
-    return {"message": resultlist}
+        sent_collection.delete_many({})
+    if id_to_print == "10":
+        return {"message": read_counters()}
+    if id_to_print:
+        # the mapping of a local id, e.g. "3-temperature", together with its sent ranges
+        result = collection.find_one({"local_id": id_to_print}, {"_id": 0})
+        if result is not None:
+            result["sent"] = [[r["idx"], r["start"], r["end"]]
+                              for r in sent_collection.find({"local_id": id_to_print}).sort([("idx", 1), ("start", 1)])]
+        return {"message": [result]}
+    return {"message": "Document count {}".format(collection.count_documents({}))}
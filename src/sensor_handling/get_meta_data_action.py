@@ -2,42 +2,59 @@
 
 __author__ = "Ahmet Kilic https://github.com/flamestro"
 
-import io
-from urllib.request import urlopen
-from zipfile import ZipFile
 try:
     import secretmanager
 except:
     import deployment_tmp.secret_manager as secretmanager
 
-def main(args):
+try:
+    import dwdftp
+except:
+    import deployment_tmp.dwdftp as dwdftp
+
+try:
+    import metrics
+except:
+    import deployment_tmp.metrics as metrics
+
+try:
+    import zipview
+except:
+    import deployment_tmp.zipview as zipview
+
+def find_meta_data_name(myzip):
     inner_file_name = "COULD NOT GET FILENAME"
+    for z_info in myzip.filelist:
+        substrings = z_info.filename.split("_")
+        if substrings[0] == "Stationsmetadaten" or (
+                substrings[0] == "Metadaten" and substrings[1] == "Geographie"):
+            inner_file_name = z_info.filename
+    return inner_file_name
+
+
+def read_meta_data(myzip):
+    """returns the decoded content of the meta data file inside of a station zip"""
+    return zipview.read_text(myzip, find_meta_data_name(myzip), encoding="latin-1")
+
+
+def main(args):
     file_name = args.get("filename")
     rest_names = args.get("restfilenames")
+    # handed on through the sequence, so that every action downloads from the directory the file was listed in
+    ftp_path = args.get("ftp_url") or "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/"
+    metrics.start("getmetadataaction", store=args.get("storemetrics"))
     try:
-        ftp_url = "ftp://ftp-cdc.dwd.de/" + args.get("ftp_url",
-                                                     "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/")
-
-        sensorzip = urlopen(ftp_url + file_name)
-        memfile = io.BytesIO(sensorzip.read())
-
-        with ZipFile(memfile, 'r') as myzip:
-            try:
-                for z_info in myzip.filelist:
-                    substrings = z_info.filename.split("_")
-                    if substrings[0] == "Stationsmetadaten" or (
-                            substrings[0] == "Metadaten" and substrings[1] == "Geographie"):
-                        inner_file_name = z_info.filename
-            except Exception as e:
-                print(e)
-            finally:
-                meta_data = myzip.open(inner_file_name)
-        result = {"metadata": str(meta_data.read())[2:-1],
-                  "filename": file_name,
-                  "restfilenames": rest_names}
+        with dwdftp.fetch(ftp_path + file_name) as sensorzip, zipview.MappedZip(sensorzip) as myzip:
+            result = {"metadata": read_meta_data(myzip),
+                      "filename": file_name,
+                      "restfilenames": rest_names,
+                      "ftp_url": ftp_path,
+                      "window": args.get("window")}  # handed on to the content handler, see getcsvaction
         print("send in get metadata", result)
         return result
     except Exception as e:
-        secretmanager.complete_sequence(rest_names)
+        secretmanager.complete_sequence(rest_names, ftp_url=ftp_path)
         result = {"message": "failed metadata because of unkown error - jump to next file"}
         return result
+    finally:
+        metrics.finish(secretmanager.__MONGOURL__)
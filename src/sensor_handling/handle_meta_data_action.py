@@ -2,20 +2,24 @@
 
 __author__ = "Florian Peters https://github.com/flpeters"
 
-from contextlib import contextmanager
-from typing import List
+import asyncio
+from typing import List, Dict, Optional, NamedTuple
 from datetime import datetime
-from time import time
 
 try: import osnapi as api
 except: import deployment_tmp.osnapi as api
 
 try: import secretmanager
 except: import deployment_tmp.secret_manager as secretmanager
+
+try: from mongodb import WriteBuffer, CacheStore, mongo_conn, mappings_conn
+except: from deployment_tmp.mongodb import WriteBuffer, CacheStore, mongo_conn, mappings_conn
+
+try: import metrics
+except: import deployment_tmp.metrics as metrics
     
-from pymongo import MongoClient
+from pymongo import UpdateOne
 from pymongo.collection import Collection
-from pymongo.errors import ConnectionFailure
 
 mongo_db_url = secretmanager.__MONGOURL__
 
@@ -25,41 +29,51 @@ def clean_str(line:str) -> List[str]: return ''.join(line.split()).split(';')
 
 def to_iso_date(timestamp:str, format:str) -> str: return datetime.strptime(timestamp, format).isoformat()
 
-def cache(timeout_ms=300_000):
-    class _cache:
-        def __init__(self, func):
-            self.func = func
-            self.ex_count = 0
-            self.res = None
-            self.t_last_exec = time()
-            self.timeout_sec = timeout_ms / 1000
-
-        def __call__(self, *args, **kwargs):
-            if ((time() - self.t_last_exec) > self.timeout_sec) or (self.res is None):
-                print(f'reload cache for: {self.func} count: {self.ex_count}')
-                self.res = self.func(*args, **kwargs)
-                self.t_last_exec = time()
-                self.ex_count += 1
-            return self.res
-    return _cache
-
 ################## Monkey patching api calls ##################
 def _print_failure(e):
     print(f'Failed request -> retrying\nfailure cause: ({e})')
     return True
 
 retry = api.retry_on(EX=Exception, retries=3, on_failure=_print_failure)
-cache_result = cache(timeout_ms = 300_000) # 5 minute timeout
 
 # WARNING(florian): doing this multiple times with the same function would create wrappers around wrappers, recursively. 
-api.getMeasurands = cache_result(retry(api.getMeasurands))
-api.getUnits      = cache_result(retry(api.getUnits))
-api.getLicenses   = cache_result(retry(api.getLicenses))
+# NOTE(florian): getMeasurands, getUnits and getLicenses are cached by osnapi itself, so retries only happen on a miss.
+api.getMeasurands = retry(api.getMeasurands)
+api.getUnits      = retry(api.getUnits)
+api.getLicenses   = retry(api.getLicenses)
 api.addSensor     = retry(api.addSensor)
 api.login         = retry(api.login)
 
 
 ################## Opensense ################## 
+UNITS = {'temperature'   : 'celsius', 'humidity'      : 'percent',
+         'cloudiness'    : 'level', 'air_pressure'  : 'hPa', 'air_pressure_nn': 'hPa',
+         'wind_speed'    : 'm/s', 'wind_direction': 'degrees',
+         'precipitation' : 'mm', 'sunshine'      : 'minutes'}
+# measurands whose sensors are created together with the ones of the imported measurand, from the same product file
+COMPANION_MEASURANDS = {'temperature': ('humidity',), 'air_pressure': ('air_pressure_nn',),
+                        'wind_speed': ('wind_direction',)}
+LICENSE = 'DE-GeoNutzV-1.0'
+PROVISION_CONCURRENCY = 8 # nr of sensors that are created on osn at the same time
+
+def sensor_kind(measurand:str, kinds:Dict[str, dict]) -> Optional[dict]:
+    """The unit and the osn measurand, unit and license ids of a measurand, or None if osn doesn't know one of them.
+    Resolved on the api the first time a run needs them, and then kept in `kinds` for the rest of the run."""
+    if measurand not in kinds:
+        unitString = UNITS.get(measurand, None)
+        if unitString is None: raise Exception(f'No legit unit for measurand: {measurand} -> {unitString}')
+        measurands = api.getMeasurands(name=measurand)
+        units = api.getUnits(name=unitString, measurandId=measurands[0]['id']) if measurands else None
+        licenses = api.getLicenses(shortName=LICENSE)
+        if not (measurands and units and licenses):
+            missing = [name for name, found in (('measurand', measurands), ('unit', units), ('license', licenses))
+                       if found == []] # without a measurand, its units weren't looked up
+            print(f'WARNING: osn has no {", ".join(missing)} for measurand: {measurand} -> skipping its sensors')
+            kinds[measurand] = None
+        else: kinds[measurand] = {'unit': unitString, 'measurandId': measurands[0]['id'],
+                                  'unitId': units[0]['id'], 'licenseId': licenses[0]['id']}
+    return kinds[measurand]
+
 def make_sensor(measurandId, unitId, licenseId,
                 latitude, longitude,
                 altitudeAboveGround,
@@ -80,123 +94,174 @@ def make_sensor(measurandId, unitId, licenseId,
 
 
 ################## PyMongo ##################
-def mongo_available_check(client: MongoClient):
-    try: client.admin.command('ismaster')
-    except ConnectionFailure as e:
-        print('MongoDB Server not available.')
-        raise e
-
-@contextmanager
-def mongo_conn(db_url:str, check_available:bool=True) -> Collection:
-    client = MongoClient(db_url,
-                         socketTimeoutMS=10000, # default no limit
-                         connectTimeoutMS=10000, # default 20 sec
-                         serverSelectionTimeoutMS=10000, # default 30 sec
-                         heartbeatFrequencyMS=10000, # default 10 sec
-                         appname='dwd_agent', # displayed in mongodb server logs
-                         retryWrites=True, # retry once after network failure
-                         uuidRepresentation='standard', # default 'pythonLegacy'
-                        )
-    try:
-        db = client['opensense']
-        collection = db["vals"]
-        if check_available: mongo_available_check(client)
-        yield collection
-    except Exception as e: raise e
-    finally: client.close()
+class SensorMappings():
+    """The sensor mappings touched while parsing one metadata file. They are read with a single find() by load(),
+    changes are applied in memory, and flush() writes them with a single unordered bulk_write: one $push of all added
+    sensors per mapping, which creates the new ones, and one $set per sensor whose latest_day was filled in.
+    The sent ranges of the sensors are not part of the mapping, see the sent collection in mongodb.py."""
+    def __init__(self, collection:Collection):
+        self.collection = collection
+        self.mappings:Dict[str, Optional[dict]] = {}
+        self.new:Dict[str, dict] = {}
+        self.added:Dict[str, List[dict]] = {}
+        self.writes = WriteBuffer(collection)
+
+    def load(self, local_ids:List[str]) -> None:
+        local_ids = [l for l in set(local_ids) if l not in self.mappings]
+        if not local_ids: return
+        self.mappings.update({local_id: None for local_id in local_ids})
+        with metrics.timed('mongo_find'):
+            self.mappings.update({m['local_id']: m for m in self.collection.find({'local_id': {'$in': local_ids}})})
+
+    def get(self, local_id:str) -> Optional[dict]:
+        if local_id not in self.mappings: self.mappings[local_id] = self.collection.find_one({'local_id': local_id})
+        return self.mappings[local_id]
+
+    def add_sensor(self, local_id:str, mongo_sensor:dict) -> None:
+        mapping = self.get(local_id)
+        if mapping is None:
+            self.mappings[local_id] = self.new[local_id] = {'local_id': local_id, 'sensors' : [mongo_sensor]}
+        else:
+            mapping['sensors'].append(mongo_sensor)
+            if local_id not in self.new: self.added.setdefault(local_id, []).append(mongo_sensor)
+
+    def discard_sensor(self, local_id:str, mongo_sensor:dict) -> None:
+        """Takes a sensor that was added during this run out of its mapping again."""
+        mapping = self.mappings[local_id]
+        mapping['sensors'] = [s for s in mapping['sensors'] if s is not mongo_sensor]
+        if local_id in self.new:
+            if not mapping['sensors']: del self.new[local_id]; self.mappings[local_id] = None
+        else:
+            self.added[local_id] = [s for s in self.added.get(local_id, []) if s is not mongo_sensor]
+            if not self.added[local_id]: del self.added[local_id]
+
+    def set_latest_day(self, local_id:str, sensor:dict, latest_day:str) -> None:
+        sensor['latest_day'] = latest_day
+        if local_id in self.new or sensor in self.added.get(local_id, []): return # not in mongodb yet
+        self.writes.add(UpdateOne(filter={'local_id' : local_id, 'sensors.idx' : sensor['idx']},
+                                  update={'$set': {'sensors.$.latest_day': latest_day}}),
+                        key=('latest_day', local_id, sensor['idx']))
+
+    def flush(self) -> int:
+        # NOTE(florian): New mappings are upserted instead of inserted. local_id is a unique index, so a mapping
+        # that another worker created in the meantime gets the sensors pushed, instead of failing the bulk_write.
+        for local_id, mapping in self.new.items():
+            self.writes.add(UpdateOne(filter={'local_id': local_id},
+                                      update={'$push': {'sensors': {'$each': mapping['sensors']}}}, upsert=True))
+        for local_id, sensors in self.added.items():
+            self.writes.add(UpdateOne(filter={'local_id': local_id}, update={'$push': {'sensors': {'$each': sensors}}}))
+        self.new, self.added = {}, {}
+        return self.writes.flush()
 
 
 ##################### MAIN #######################
-def createLocalAndRemoteSensor(dwd_id:str, measurand:str,
-                               fromDate:str, toDate:str,
-                               latitude:float, longitude:float) -> None:
-    with mongo_conn(mongo_db_url) as collection:
-        local_id = f'{dwd_id}-{measurand}'
-        sensor_kind_exists = False
-        sensor_exists = False
-        next_idx = 0
-
-        # search for existing sensor
-        mapping = collection.find_one({'local_id': local_id})
-        if mapping is not None:
-            sensors = mapping['sensors']
-            next_idx = len(sensors)
-            sensor_idxs  = [s['idx'] for s in sensors]
-            while next_idx in sensor_idxs: next_idx += 1
-            for sensor in sensors:
-                if ((sensor['earliest_day'] <= fromDate) and
-                   ((sensor['latest_day']   >  fromDate) or (sensor['latest_day'] == ''))):
-                    # a valid sensor exists and no new one has to be created
-                    if toDate != '' and sensor['latest_day'] == '':
-                        collection.update_one(filter={'local_id' : local_id, 'sensors.idx' : sensor['idx']},
-                                              update={'$set': {f'sensors.$.latest_day': toDate}})
-                    sensor_kind_exists = True
-                    sensor_exists = True
-                    break
-            else: # no sensor in the right range exists but earlier ones do exists
-                sensor_kind_exists = True
-                sensor_exists = False
-        else: # no sensor of this kind has been added before
-            sensor_kind_exists = False
-            sensor_exists = False
-
-        if not sensor_exists:
-            unitString = {'temperature'   : 'celsius', 'humidity'      : 'percent',
-                          'cloudiness'    : 'level', 'air_pressure'  : 'hPa',
-                          'wind_speed'    : 'm/s', 'wind_direction': 'degrees'}.get(measurand, None)
-
-            if unitString is None: raise Exception(f'Station {dwd_id} has no legit unit: {measurand} -> {unitString}')
-
-            measurandId = api.getMeasurands(name=measurand)[0]['id']
-            unitId = api.getUnits(name=unitString, measurandId=measurandId)[0]['id']
-            licenseId = api.getLicenses(shortName='DE-GeoNutzV-1.0')[0]['id']
-
-            osn_sensor = make_sensor(measurandId=measurandId, unitId=unitId, licenseId=licenseId,
-                                     latitude=latitude, longitude=longitude,
-                                     altitudeAboveGround=2, directionVertical=0, directionHorizontal=2,
-                                     accuracy=10, sensorModel='DWD station',
-                                     attributionText='Deutscher Wetterdienst (DWD)',
-                                     attributionURL='ftp://ftp-cdc.dwd.de/pub/CDC/')
-
-            osn_id = api.addSensor(osn_sensor)['id']
-
-            if not osn_id: raise Exception(f'Station {dwd_id} failed to create new sensor')
-            else:          print(f'Added Sensor with dwd_id: {dwd_id} -> osn_id: {osn_id}')
-
-            mongo_sensor = {'local_id': local_id, 'osn_id': osn_id,
-                            'measurand': measurand, 'unit': unitString,
-                            'idx' : next_idx,
-                            'earliest_day': fromDate, 'latest_day': toDate,
-                            'sent_values': []}
-
-            if not sensor_kind_exists:
-                resp = collection.insert_one(document={'local_id': local_id, 'sensors' : [mongo_sensor]})
-            else:
-                resp = collection.update_one(filter={'local_id' : local_id},
-                                             update={'$addToSet': {'sensors': mongo_sensor}})
-            assert resp.acknowledged, f'Failed to insert new Sensor into MongoDB \
-                                        (dwd_id: {dwd_id}, osn_id: {osn_id})'
-        else: print('Sensor already exists')
-
-    if measurand == "temperature":
-        createLocalAndRemoteSensor(dwd_id, "humidity",
-                                   fromDate, toDate,
-                                   latitude, longitude)
-    if measurand == "wind_speed":
-        createLocalAndRemoteSensor(dwd_id, "wind_direction",
-                                   fromDate, toDate,
-                                   latitude, longitude)
-
-def parse_metadata(content:str, measurand:str):
+class PendingSensor(NamedTuple):
+    """A sensor that is already part of its mapping, but doesn't have an osn_id yet."""
+    local_id    :str
+    mongo_sensor:dict
+    osn_sensor  :dict
+
+def createLocalSensor(dwd_id:str, measurand:str,
+                      fromDate:str, toDate:str,
+                      latitude:float, longitude:float,
+                      mappings:SensorMappings, kinds:Dict[str, dict], pending:List[PendingSensor]) -> None:
+    """Adds a sensor for the date range to the mapping, unless one exists already. The remote sensor is only described
+    and appended to `pending`, because the sensors of a whole file are created at once by createRemoteSensors().
+    Measurands that osn doesn't know are skipped, and counted as failed sensors."""
+    local_id = f'{dwd_id}-{measurand}'
+    sensor_exists = False
+    next_idx = 0
+
+    # search for existing sensor, including the pending ones of earlier lines
+    mapping = mappings.get(local_id)
+    if mapping is not None:
+        sensors = mapping['sensors']
+        next_idx = len(sensors)
+        sensor_idxs  = [s['idx'] for s in sensors]
+        while next_idx in sensor_idxs: next_idx += 1
+        for sensor in sensors:
+            if ((sensor['earliest_day'] <= fromDate) and
+               ((sensor['latest_day']   >  fromDate) or (sensor['latest_day'] == ''))):
+                # a valid sensor exists and no new one has to be created
+                if toDate != '' and sensor['latest_day'] == '': mappings.set_latest_day(local_id, sensor, toDate)
+                sensor_exists = True
+                break
+
+    if not sensor_exists:
+        kind = sensor_kind(measurand, kinds)
+        if kind is None:
+            metrics.inc('sensors_failed')
+            return
+        osn_sensor = make_sensor(measurandId=kind['measurandId'], unitId=kind['unitId'], licenseId=kind['licenseId'],
+                                 latitude=latitude, longitude=longitude,
+                                 altitudeAboveGround=2, directionVertical=0, directionHorizontal=2,
+                                 accuracy=10, sensorModel='DWD station',
+                                 attributionText='Deutscher Wetterdienst (DWD)',
+                                 attributionURL='ftp://ftp-cdc.dwd.de/pub/CDC/')
+
+        mongo_sensor = {'local_id': local_id, 'osn_id': None,
+                        'measurand': measurand, 'unit': kind['unit'],
+                        'idx' : next_idx,
+                        'earliest_day': fromDate, 'latest_day': toDate}
+        mappings.add_sensor(local_id, mongo_sensor)
+        pending.append(PendingSensor(local_id, mongo_sensor, osn_sensor))
+    else: print('Sensor already exists')
+
+def createRemoteSensors(pending:List[PendingSensor], concurrency:int=PROVISION_CONCURRENCY) -> int:
+    """Creates the pending sensors on osn, at most `concurrency` at a time, and fills in their osn_id.
+    Returns the nr of sensors that couldn't be created."""
+    async def _create(sensor:PendingSensor, slots:asyncio.Semaphore) -> bool:
+        async with slots:
+            try: osn_id = (await api.addSensorAsync(sensor.osn_sensor))['id']
+            except Exception as e: osn_id, cause = None, e
+            else: cause = 'no id'
+        if not osn_id:
+            print(f'Failed to create new sensor for {sensor.local_id} ({sensor.mongo_sensor["earliest_day"]}): {cause}')
+            return False
+        sensor.mongo_sensor['osn_id'] = osn_id
+        print(f'Added Sensor with local_id: {sensor.local_id} -> osn_id: {osn_id}')
+        return True
+    async def _create_all() -> List[bool]:
+        slots = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*[_create(sensor, slots) for sensor in pending])
+    if not pending: return 0
+    created = asyncio.run(_create_all())
+    metrics.inc('sensors_created', sum(created)); metrics.inc('sensors_failed', len(created) - sum(created))
+    return len(created) - sum(created)
+
+def parse_metadata(content:str, measurand:str, concurrency:int=PROVISION_CONCURRENCY, measurands:List[str]=None):
+    """Creates the sensors of a measurand and its companions for every line, or of the given measurands instead,
+    e.g. of all measurands found in the product file of a station."""
     date_format = '%Y%m%d'
     api.login(username=secretmanager.__OSNUSERNAME__, password=secretmanager.__OSNPASSWORD__)
+    rows = []
     for line in content.splitlines():
         line = clean_str(line)
         if len(line) < 7 or not line[0].isdigit(): continue
         stationID, heightAboveNN, latitude, longitude, fromDate, toDate, *_ = line
         fromDate = to_iso_date(timestamp=fromDate, format=date_format)
         if toDate: toDate = to_iso_date(timestamp=toDate, format=date_format)
-        createLocalAndRemoteSensor(stationID, measurand, fromDate, toDate, float(latitude), float(longitude))
+        rows.append((stationID, fromDate, toDate, float(latitude), float(longitude)))
+    if measurands is None: measurands = (measurand, *COMPANION_MEASURANDS.get(measurand, ()))
+    kinds, pending = {}, []
+    with mappings_conn(mongo_db_url) as collection, mongo_conn(mongo_db_url, name='osn_cache') as cache_collection:
+        api_cache = CacheStore(cache_collection)
+        api.load_cache(api_cache) # NOTE(florian): only hits mongodb in a cold container
+        mappings = SensorMappings(collection)
+        mappings.load([f'{row[0]}-{m}' for row in rows for m in measurands])
+        # NOTE(florian): Lines that describe the same sensor are deduplicated here, because earlier pending
+        # sensors are already part of the mapping when later lines are checked.
+        for stationID, fromDate, toDate, latitude, longitude in rows:
+            for m in measurands:
+                createLocalSensor(stationID, m, fromDate, toDate, latitude, longitude, mappings, kinds, pending)
+        try: failed = createRemoteSensors(pending, concurrency)
+        finally:
+            # sensors without an osn_id must not end up in mongodb, their lines are retried on the next import
+            for sensor in pending:
+                if sensor.mongo_sensor['osn_id'] is None: mappings.discard_sensor(sensor.local_id, sensor.mongo_sensor)
+            mappings.flush() # NOTE(florian): sensors that were already created on osn must not be forgotten
+            api.save_cache(api_cache)
+    if failed: raise Exception(f'Failed to create {failed} of {len(pending)} new sensors')
 
 
 ##################### OpenWhisk Entrypoint #######################
@@ -205,12 +270,16 @@ def main(args):
     rest_names = args.get('restfilenames')
     content = args.get('metadata')
     measurand = args.get('measurand', 'temperature')
+    ftp_url = args.get('ftp_url') # only handed on, see getmetadataaction
+    metrics.start('handlemetadataaction', store=args.get('storemetrics'))
     try:
         parse_metadata(content, measurand)
         return {'message': 'finished given metadata',
-                'filename': filename, 'restfilenames': rest_names}
+                'filename': filename, 'restfilenames': rest_names, 'ftp_url': ftp_url,
+                'window': args.get('window')} # handed on to the content handler, see get_csv_action
     except Exception as e:
-        secretmanager.complete_sequence(rest_names)
+        secretmanager.complete_sequence(rest_names, ftp_url=ftp_url)
         result = {'error': 'failed metadata because of unkown error - jump to next file'}
         print(result, e)
         return result
+    finally: metrics.finish(mongo_db_url)
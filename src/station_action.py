@@ -0,0 +1,107 @@
+"""
+station_action.py: This action imports one station zip in a single invocation, instead of chaining the
+getmetadataaction -> handlemetadataaction -> getcsvaction -> handlecontentdataaction sequence
+"""
+
+__author__ = "Ahmet Kilic https://github.com/flamestro"
+
+try:
+    import secretmanager
+except:
+    import deployment_tmp.secret_manager as secretmanager
+
+try:
+    import backfill
+except:
+    import deployment_tmp.backfill as backfill
+
+try:
+    import metrics
+except:
+    import deployment_tmp.metrics as metrics
+
+try:
+    import osnapi as api
+except:
+    import deployment_tmp.osnapi as api
+
+try:
+    import zipview
+except:
+    import deployment_tmp.zipview as zipview
+
+try:
+    import get_meta_data_action as get_meta_data
+    import handle_meta_data_action as handle_meta_data
+    import get_csv_action as get_csv
+    import handle_content_data_action as content_handler
+except:
+    import src.sensor_handling.get_meta_data_action as get_meta_data
+    import src.sensor_handling.handle_meta_data_action as handle_meta_data
+    import src.value_handling.get_csv_action as get_csv
+    import src.value_handling.handle_content_data_action as content_handler
+
+STATION_ACTION = "stationaction"
+DEFAULT_FTP_PATH = "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/"
+
+
+def handle_station(file_name, ftp_path=DEFAULT_FTP_PATH, measurand="temperature", concurrency=1, sensorzip=None,
+                   window=None):
+    """
+    downloads a station zip once, then creates its sensors and pushes its values from the same archive.
+    an already downloaded zip can be passed as sensorzip, it is closed afterwards.
+    with a window [start, end) of hours, only the values inside of it are pushed, and the window is checkpointed
+    for the station once it is done (see backfill.py)
+    """
+    if window is not None:
+        window = tuple(window)
+        with backfill.checkpoint_conn(secretmanager.__MONGOURL__) as checkpoints:
+            if backfill.is_done(checkpoints, file_name, measurand, window):
+                print("window {} of {} is already done".format(window, file_name))
+                return
+    if sensorzip is None:
+        sensorzip = get_csv.download_zip(ftp_path + file_name)
+    with sensorzip, zipview.MappedZip(sensorzip) as myzip:
+        measurands = None
+        if measurand == content_handler.ALL:
+            # create sensors for every measurand the product file has a column for, the values are then pushed from
+            # a single pass over the file
+            lines = get_csv.iter_product_lines(myzip)
+            _, field_defs = content_handler.parse_header(next(lines))
+            lines.close()
+            measurands = list(content_handler.measurand_columns(field_defs))
+        handle_meta_data.parse_metadata(get_meta_data.read_meta_data(myzip), measurand, measurands=measurands)
+        get_csv.stream_to_content_handler(myzip, measurand, concurrency, window=window)
+    if window is not None:
+        with backfill.checkpoint_conn(secretmanager.__MONGOURL__) as checkpoints:
+            backfill.mark_done(checkpoints, file_name, measurand, window)
+        return
+    # lets incremental listings skip this file, until it changes on the ftp server
+    get_csv.mark_imported(ftp_path, file_name)
+
+
+def main(args):
+    file_name = args.get("filename")
+    rest_names = args.get("restfilenames")
+    if file_name is None:
+        return {"error": "seuquence should be stopped"}
+    ftp_path = args.get("ftp_url", DEFAULT_FTP_PATH)
+    metrics.start(STATION_ACTION, store=args.get("storemetrics"))
+    # compress the pushed values, if the opensense api accepts 'content-encoding: gzip'
+    api.Settings.gzip_bodies = str(args.get("gzip", "")).lower() in ("1", "true", "yes")
+    try:
+        handle_station(file_name,
+                       ftp_path=ftp_path,
+                       measurand=args.get("measurand", "temperature"),
+                       concurrency=args.get("concurrency", 1),
+                       window=args.get("window"))
+        result = {"message": "finished station " + file_name}
+        metrics.inc("files_done")
+    except Exception as e:
+        result = {"error": "failed station because of unkown error - jump to next file"}
+        metrics.inc("files_failed")
+        print(result, e)
+    finally:
+        metrics.finish(secretmanager.__MONGOURL__)
+        secretmanager.complete_sequence(rest_names, action=STATION_ACTION, ftp_url=ftp_path)
+    return result
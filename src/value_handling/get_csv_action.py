@@ -2,43 +2,108 @@
 
 __author__ = "Ahmet Kilic https://github.com/flamestro"
 
-import io
-from urllib.request import urlopen
-from zipfile import ZipFile
-
 try:
     import secretmanager
 except:
     import deployment_tmp.secret_manager as secretmanager
 
+try:
+    import dwdftp
+except:
+    import deployment_tmp.dwdftp as dwdftp
+
+try:
+    import metrics
+except:
+    import deployment_tmp.metrics as metrics
+
+try:
+    import zipview
+except:
+    import deployment_tmp.zipview as zipview
+
+
+def download_zip(path):
+    """
+    downloads a zip from the dwd ftp server into a temporary file. the ftp connection is pooled, so warm
+    containers don't log in again for every file
+    """
+    return dwdftp.fetch(path)
+
+
+def find_product_name(myzip):
+    inner_file_name = "COULD NOT GET FILENAME"
+    for z_info in myzip.filelist:
+        if z_info.filename.startswith("produkt"):
+            inner_file_name = z_info.filename
+    return inner_file_name
+
+
+def iter_product_lines(myzip):
+    """
+    lazily decodes the produkt member of a station zip line by line, without reading it into memory. a MappedZip
+    inflates it straight from the mapped archive
+    """
+    return zipview.iter_lines(myzip, find_product_name(myzip), encoding="latin-1")
+
+
+def stream_to_content_handler(myzip, measurand, concurrency=1, window=None):
+    """
+    feeds the produkt lines directly into the content handler, instead of returning them as an action result.
+    with a window, only the values inside of it are pushed
+    """
+    try:
+        import handle_content_data_action as content_handler
+    except:
+        import src.value_handling.handle_content_data_action as content_handler
+    content_handler.handle_content_lines(iter_product_lines(myzip), measurand=measurand, concurrency=concurrency,
+                                         window=window)
+
+
+def mark_imported(ftp_path, file_name):
+    """
+    lets incremental listings skip this file, until it changes on the ftp server
+    """
+    with dwdftp.files_conn(secretmanager.__MONGOURL__) as collection:
+        dwdftp.mark_imported(collection, ftp_path, file_name)
+
 
 def main(args):
     file_name = args.get("filename")
     rest_names = args.get("restfilenames")
+    stream = args.get("stream", False)
+    # [start, end) in hours since the epoch, e.g. from a backfill job. only the values inside of it are pushed
+    window = args.get("window")
     if file_name is None:
         return {"error": "seuquence should be stopped"}
+    ftp_path = args.get("ftp_url") or "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/"
+    metrics.start("getcsvaction", store=args.get("storemetrics"))
     try:
-        ftp_url = "ftp://ftp-cdc.dwd.de/" + args.get("ftp_url",
-                                                     "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/")
-        inner_file_name = "COULD NOT GET FILENAME"
-        sensorzip = urlopen(ftp_url + file_name)
-        memfile = io.BytesIO(sensorzip.read())
-
-        with ZipFile(memfile, 'r') as myzip:
-            try:
-                for z_info in myzip.filelist:
-                    if z_info.filename.startswith("produkt"):
-                        inner_file_name = z_info.filename
-            except Exception as e:
-                print(e)
-            finally:
-                csv_file_value_data = myzip.open(inner_file_name)
-        result = {"csv": str(csv_file_value_data.read())[2:-1],
-                  "restfilenames": rest_names}
+        with download_zip(ftp_path + file_name) as sensorzip, zipview.MappedZip(sensorzip) as myzip:
+            if stream:
+                stream_to_content_handler(myzip, args.get("measurand", "temperature"), args.get("concurrency", 1),
+                                          window=None if window is None else tuple(window))
+                if window is None:
+                    mark_imported(ftp_path, file_name)
+            else:
+                # the window is handed on to handlecontentdataaction, which drops the rows outside of it. it also
+                # records the file as imported, so it needs its name and directory
+                result = {"csv": "\n".join(iter_product_lines(myzip)),
+                          "filename": file_name,
+                          "restfilenames": rest_names,
+                          "ftp_url": ftp_path,
+                          "window": window}
+        if stream:
+            # the content handler has already been run, so jump to the next file directly
+            secretmanager.complete_sequence(rest_names, ftp_url=ftp_path)
+            print("streamed csv in get csv")
+            return {"message": "finished"}
         print("send in get csv")
         return result
     except Exception as e:
-        secretmanager.complete_sequence(rest_names)
+        secretmanager.complete_sequence(rest_names, ftp_url=ftp_path)
         result = {"error": "failed metadata because of unkown error - jump to next file"}
         print(result, e)
         return result
+    finally:
+        metrics.finish(secretmanager.__MONGOURL__)
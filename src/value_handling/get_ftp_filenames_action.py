@@ -4,22 +4,44 @@ get_ftp_filenames_action.py: This action loads the filenames inside an FTP dir,
 
 __author__ = "Ahmet Kilic https://github.com/flamestro"
 
-from ftplib import FTP
+try:
+    import secretmanager
+except:
+    import deployment_tmp.secret_manager as secretmanager
+
+try:
+    import dwdftp
+except:
+    import deployment_tmp.dwdftp as dwdftp
+
+try:
+    import metrics
+except:
+    import deployment_tmp.metrics as metrics
+
+
+def list_changed_files(ftp, path):
+    """lists the directory with fingerprints and only returns the files that are new or changed since their last import"""
+    files = dwdftp.list_dir(ftp, path)
+    with dwdftp.files_conn(secretmanager.__MONGOURL__) as collection:
+        changed = dwdftp.changed_files(files, path, collection)
+    print("{} of {} files are new or changed".format(len(changed), len(files)))
+    return changed
 
 
 # GET RELEVANT ZIP FILE NAMES
 def main(args):
     path = args.get("path", "climate_environment/CDC/observations_germany/climate/hourly/air_temperature/recent/")
-    ftp = FTP('ftp-cdc.dwd.de')
-    ftp.login()
-    files = ftp.nlst(path)
-    filenames = ""
-
-    for f in files:
-        name = f.split('/')[-1]
-        if filenames != "":
-            filenames += "," + name
-        else:
-            filenames += name
-    ftp.quit()
-    return {"filenames": filenames}
+    # params from the cli arrive as strings, so "false" must not count as set
+    incremental = str(args.get("incremental", "")).lower() in ("1", "true", "yes")
+    metrics.start("getfilenamesaction", store=args.get("storemetrics"))
+    try:
+        with dwdftp.connection() as conn, metrics.timed("ftp_list"):
+            if incremental:
+                names = list_changed_files(conn.ftp, path)
+            else:
+                names = [f.split('/')[-1] for f in conn.ftp.nlst(path)]
+        metrics.inc("files_listed", len(names))
+    finally:
+        metrics.finish(secretmanager.__MONGOURL__)
+    return {"filenames": ",".join(names)}
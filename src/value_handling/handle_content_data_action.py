@@ -1,11 +1,17 @@
-"""osnapi.py: This module is a wrapper for opensense.network's API"""
+"""handle_content_data_action.py: This action parses the rows of a DWD `produkt_*` file and pushes their values to
+opensense.network"""
 
 __author__ = "Florian Peters https://github.com/flpeters"
 
+import asyncio
 import time
-from contextlib import contextmanager
+from collections import defaultdict
 from datetime import datetime
-from typing import List, Callable
+from functools import lru_cache
+from itertools import islice
+from typing import List, Tuple, Dict, Union, Iterable, Iterator, NamedTuple, Callable
+
+import numpy as np
 
 try: import osnapi as api
 except: import deployment_tmp.osnapi as api
@@ -13,9 +19,20 @@ except: import deployment_tmp.osnapi as api
 try: import secretmanager
 except: import deployment_tmp.secret_manager as secretmanager
 
-from pymongo import MongoClient
+try: from intervals import IntervalSet
+except: from deployment_tmp.intervals import IntervalSet
+
+try: from mongodb import WriteBuffer, Counters, mappings_conn, sent_conn, counters_conn, sent_range_id
+except: from deployment_tmp.mongodb import WriteBuffer, Counters, mappings_conn, sent_conn, counters_conn, sent_range_id
+
+try: import metrics
+except: import deployment_tmp.metrics as metrics
+
+try: import dwdftp
+except: import deployment_tmp.dwdftp as dwdftp
+
+from pymongo import UpdateOne, DeleteOne
 from pymongo.collection import Collection
-from pymongo.errors import ConnectionFailure
 
 mongo_db_url = secretmanager.__MONGOURL__
 
@@ -34,25 +51,42 @@ def to_int_or_none(x:str) -> int:
         print(f'ValueError: {e}')
         return None
     
-def batchify(a:int, b:int, bs:int) -> List[tuple]:
-    """Convert a index range [a:b] into multiple batches, each no larger than bs."""
-    return [(i, min(b, i+bs)) for i in range(a, b, bs)]
-
 def to_iso_date(timestamp:str, format:str) -> str: return datetime.strptime(timestamp, format).isoformat()
 
-def iso_to_int(iso_date:str):
-    """convert a ISO 8601 string to a unique int"""
-    year = iso_date[0:4]
-    month = iso_date[5:7]
-    day = iso_date[8:10]
-    hour = iso_date[11:13]
-    minute = iso_date[14:16]
-    second = iso_date[17:19]
-    return int(f'{year}{month}{day}{hour}{minute}{second}')
+
+################## Timestamps ##################
+# NOTE(florian): Timestamps are kept as int64 hours since 1970-01-01T00:00 from parsing until they are pushed.
+# ISO 8601 strings are only produced at the borders, i.e. when talking to mongodb or the osn api.
+OPEN_END = int(np.iinfo(np.int64).max) # latest_day of a sensor that is still active
+
+def yyyymmddhh_to_hours(dates:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert YYYYMMDDHH ints to hours since the epoch. Also returns a mask of which dates are valid."""
+    years, rest  = np.divmod(dates, 1_000_000)
+    months, rest = np.divmod(rest, 10_000)
+    days, hours  = np.divmod(rest, 100)
+    month_starts = ((years - 1970) * 12 + np.clip(months, 1, 12) - 1).astype('datetime64[M]')
+    first_days   = month_starts.astype('datetime64[D]')
+    month_lengths = ((month_starts + 1).astype('datetime64[D]') - first_days).astype(np.int64)
+    valid = (1 <= months) & (months <= 12) & (1 <= days) & (days <= month_lengths) & (hours < 24)
+    return (first_days.astype(np.int64) + days - 1) * 24 + hours, valid
+
+def hours_to_iso(hours:np.ndarray) -> np.ndarray:
+    """Vectorized conversion of hours since the epoch to ISO 8601 strings, e.g. '2019-01-01T13:00:00'"""
+    return np.datetime_as_string(hours.astype('datetime64[h]'), unit='s')
+
+@lru_cache(maxsize=4096)
+def hour_to_iso(hour:int) -> str: return str(np.datetime64(int(hour), 'h').astype('datetime64[s]'))
+
+@lru_cache(maxsize=4096)
+def iso_to_hour(iso_date:str) -> int:
+    """Convert a ISO 8601 string to hours since the epoch. An empty string marks an open end."""
+    if iso_date == '': return OPEN_END
+    return int(np.datetime64(iso_date).astype('datetime64[h]').astype(np.int64))
 
 
 ################## Monkey patching api calls ##################
 def _print_failure(e):
+    if isinstance(e, api.Overloaded): return False # retrying the same request won't help, AdaptiveBatchSize shrinks it
     print(f'Failed request -> retrying\nfailure cause: ({e})')
     return True
 retry = api.retry_on(EX=Exception, retries=3, on_failure=_print_failure)
@@ -62,56 +96,92 @@ api.login             = retry(api.login)
 
 
 ################## Opensense ##################
-def osn_push_valuebulk(valuebulk:dict) -> bool:
-    try: return api.addMultipleValues(body=valuebulk) == 'OK'
-    except: return False
+PUSHED, OVERLOADED, FAILED = 'pushed', 'overloaded', 'failed'
+MAX_OVERLOADS = 5 # smaller retries of a range whose pushes keep overloading the server, before the import is aborted
+# sharded counters (see mongodb.Counters), which handle_config sums up for the monitorapp
+VALUES_COUNTER, ACTIONS_COUNTER = 'values', 'actions'
+
+def osn_push_valuebulk(valuebulk:dict) -> str:
+    try: return PUSHED if api.addMultipleValues(body=valuebulk) == 'OK' else FAILED
+    except api.Overloaded: return OVERLOADED
+    except: return FAILED
+
+async def osn_push_valuebulk_async(valuebulk:dict) -> str:
+    try: return PUSHED if await api.addMultipleValuesAsync(body=valuebulk) == 'OK' else FAILED
+    except api.Overloaded: return OVERLOADED
+    except: return FAILED
+
+class AdaptiveBatchSize:
+    """Grows the nr of values per addMultipleValues call while pushes take less than target_sec,
+    and halves it whenever the server is overloaded (408 or timeout)."""
+    # NOTE(florian): the last size is kept on the class, so warm containers don't have to find it again.
+    learned_size = 2000
+
+    def __init__(self, min_size:int=250, max_size:int=20_000, target_sec:float=2.0, growth:float=1.25):
+        self.min_size, self.max_size = min_size, max_size
+        self.target_sec, self.growth = target_sec, growth
+        self.size = min(max(AdaptiveBatchSize.learned_size, min_size), max_size)
+        self.ceiling = max_size # lowered to just below a size that overloaded the server, then slowly raised again
+
+    def update(self, outcome:str, seconds:float, nr_of_rows:int) -> int:
+        if outcome == OVERLOADED:
+            self.ceiling = max(self.min_size, int(min(self.ceiling, nr_of_rows) * 0.9))
+            # concurrent batches that were built before the last halving, i.e. are larger than it, don't halve it again
+            if nr_of_rows <= self.size: self.size = max(self.min_size, nr_of_rows // 2)
+            self.size = min(self.size, self.ceiling) # a short tail batch has to shrink the next try as well
+        elif outcome == PUSHED and nr_of_rows >= self.size: # only full batches say something about the size
+            if seconds < self.target_sec:
+                self.ceiling = min(self.max_size, self.ceiling + self.min_size // 10)
+                self.size = min(self.ceiling, int(self.size * self.growth))
+            elif seconds > 2 * self.target_sec:
+                self.size = max(self.min_size, int(self.size / self.growth))
+        AdaptiveBatchSize.learned_size = self.size
+        return self.size
 
 
 ################## PyMongo ##################
-def mongo_available_check(client: MongoClient):
-    try: client.admin.command('ismaster')
-    except ConnectionFailure as e:
-        print('MongoDB Server not available.')
-        raise e
-
-@contextmanager
-def mongo_conn(db_url:str, check_available:bool=True) -> Collection:
-    client = MongoClient(db_url,
-                         socketTimeoutMS=10000, # default no limit
-                         connectTimeoutMS=10000, # default 20 sec
-                         serverSelectionTimeoutMS=10000, # default 30 sec
-                         heartbeatFrequencyMS=10000, # default 10 sec
-                         appname='dwd_agent', # displayed in mongodb server logs
-                         retryWrites=True, # retry once after network failure
-                         uuidRepresentation='standard', # default 'pythonLegacy'
-                        )
-    try:
-        db = client['opensense']
-        collection = db["vals"]
-        if check_available: mongo_available_check(client)
-        yield collection
-    except Exception as e: raise e
-    finally: client.close()
-        
-# NOTE(florian): merge_already_sent() is defined down below
-def mongo_merge_all_already_sent(local_id:str, time_class:str, collection:Collection):
-    """merges all sent_values by date"""
-    for sensor in collection.find_one(filter={'local_id' : local_id})['sensors']:
-        collection.update_one(filter={'local_id' : local_id, 'sensors.idx' : sensor['idx']},
-                              update={'$set':
-                                      {f'sensors.$.sent_values': merge_already_sent(sensor['sent_values'], time_class)}})
-        
-def mongo_sensors_by_local_id_merged_already_sent(local_id:str, time_class:str, collection:Collection):
-    """returns all sensors of a particular local_id, but also merges all sent_values by date, before returning."""
-    mapping = collection.find_one(filter={'local_id': local_id})
-    if mapping is not None:
-        sensors = mapping['sensors']
+def mongo_record_sent(local_id:str, idx:int, removed:List[Tuple[int]], merged:Tuple[int], writes:WriteBuffer) -> None:
+    """Writes the delta of an IntervalSet.add() to the sent ranges of a sensor on the next flush: the merged interval
+    is upserted, the intervals it swallowed are deleted. Earlier writes of the same interval are dropped."""
+    start, end = merged
+    for s, _ in removed:
+        if s != start: writes.add(DeleteOne({'_id': sent_range_id(local_id, idx, s)}), key=('sent', local_id, idx, s))
+    writes.add(UpdateOne(filter={'_id': sent_range_id(local_id, idx, start)},
+                         update={'$setOnInsert': {'local_id': local_id, 'idx': idx, 'start': start},
+                                 '$max': {'end': end}}, upsert=True),
+               key=('sent', local_id, idx, start))
+
+def mongo_coalesce_sent(local_id:str, idx:int, stored:List[Tuple[int]], sent_values:IntervalSet,
+                        writes:WriteBuffer) -> None:
+    """Replaces stored ranges that overlap, or lie within the gap of each other, by their coalesced intervals."""
+    starts = {s for s, _ in sent_values}
+    for interval in sent_values:
+        if interval not in stored: mongo_record_sent(local_id, idx, [], interval, writes)
+    for s, _ in stored:
+        if s not in starts: writes.add(DeleteOne({'_id': sent_range_id(local_id, idx, s)}), key=('sent', local_id, idx, s))
+
+def mongo_sensors_by_local_ids(local_ids:List[str], time_class:str, mapping_collection:Collection,
+                               sent_collection:Collection, writes:WriteBuffer, coalesce:bool=True) -> Dict[str, list]:
+    """returns the sensors of all given local_ids that have a mapping, with one query for the mappings and one for
+    their sent ranges, which every sensor gets as an IntervalSet in sent_values. Ranges that weren't coalesced yet,
+    e.g. those of backfill windows, are written back once, unless coalesce is False.
+    Every sensor also gets an empty IntervalSet of the values that are sent during this run, as new_values."""
+    gap = gap_by_time_class(time_class)
+    sensors_by_local_id, stored = {}, defaultdict(list)
+    with metrics.timed('mongo_find'):
+        mappings = list(mapping_collection.find(filter={'local_id': {'$in': local_ids}}))
+        for r in sent_collection.find(filter={'local_id': {'$in': [m['local_id'] for m in mappings]}},
+                                      projection={'_id': 0, 'local_id': 1, 'idx': 1, 'start': 1, 'end': 1}):
+            stored[r['local_id'], r['idx']].append((r['start'], r['end']))
+    for mapping in mappings:
+        local_id, sensors = mapping['local_id'], mapping['sensors']
         for sensor in sensors:
-            sensor['sent_values'] = merge_already_sent(sensor['sent_values'], time_class)
-            collection.update_one(filter={'local_id' : local_id, 'sensors.idx' : sensor['idx']},
-                                  update={'$set': {f'sensors.$.sent_values': sensor['sent_values']}})
-    else: raise Exception(f'No sensor mapping found for local id: {local_id}')
-    return sorted(sensors, key=lambda x: x['earliest_day'])
+            ranges = sorted(stored[local_id, sensor['idx']])
+            sensor['sent_values'], sensor['new_values'] = IntervalSet(ranges, gap=gap), IntervalSet(gap=gap)
+            if coalesce and list(sensor['sent_values']) != ranges:
+                mongo_coalesce_sent(local_id, sensor['idx'], ranges, sensor['sent_values'], writes)
+        sensors_by_local_id[local_id] = sorted(sensors, key=lambda x: x['earliest_day'])
+    return sensors_by_local_id
 
         
 ################## Specialized Helpers ##################
@@ -146,237 +216,324 @@ def get_indices(fieldDefs:list) -> tuple:
             sunshineMinsPerHourIndex,
             windSpeedIndex, windDirectionIndex)
 
-def belongs_to_sensor(a:str, ts:str, b:str) -> bool:
-    """checks if ts is between a and b"""
-    return (a <= ts and (ts <= b or b == ''))
-
-def find_transition(start:int, end:int, List:list, condition:Callable) -> int:
-    """Uses a Binary Search approach to find the index of the first element where condition is no longer true."""
-    # NOTE(florian): The reason for using the first "wrong" element, is that slicing "[i:j]" excludes the j'th value.
-    pivot = (start + end) // 2
-    while end - start > 1:
-        if condition(List[pivot]):
-            if not condition(List[pivot + 1]): return pivot + 1
-            else: start, pivot = pivot, (pivot + end) // 2 # move to the right
-        else:
-            if condition(List[pivot - 1]): return pivot
-            else: end, pivot = pivot, (start + pivot) // 2 # move to the left
-
-def seperate_by_sensor(dates:list, sensors:list) -> dict:
-    """Splits a list of timestamped values into chunks depending on what sensor the value was recorded by"""
-    chunks, start, ld = {}, 0, len(dates)
-    for i, sensor in enumerate(sensors):
-        a, b  = sensor['earliest_day'], sensor['latest_day']
-        ts    = dates[start]
-        if belongs_to_sensor(a, ts, b):
-            ts = dates[-1]
-            if ts <= b or b == '': # fast path, entire remaining list belongs to this sensor
-                chunks[i] = (start, ld)
-                break
-            else: # find the end of this sensors interval, and continue with the next sensor
-                pivot = find_transition(start, ld - 1, dates, lambda x: belongs_to_sensor(a, x, b))
-                chunks[i] = (start, pivot)
-                start = pivot
-                continue
-        else: # the current position does not belong to this sensor
-            if ts < a: # either check whether to skip over some values, or skip this sensors interval
-                ts = dates[-1]
-                if a < ts: # check if some values later on still belong to this sensor
-                    if belongs_to_sensor(a, ts, b): # from some point onwards, the remaining list belongs to this senso
-                        pivot = find_transition(start, ld - 1, dates, lambda x: not belongs_to_sensor(a, x, b))
-                        chunks[i] = (pivot, ld)
-                        break
-                    else: # end of the list is not part of this sensor, there might be a subsection though
-                        for j, ts in enumerate(dates[start:]):
-                            if b < ts: # end of potential interval reached, skip to next sensor
-                                start = start + j
-                                break
-                            else:
-                                if belongs_to_sensor(a, ts, b): # start of this sensors interval found
-                                    pivot = find_transition(start, ld - 1, dates,
-                                                            lambda x: belongs_to_sensor(a, x, b))
-                                    chunks[i] = (start + j, pivot)
-                                    start = pivot
-                                    break
-                else: break # the last element in the list is still before this sensors interval
-            else: continue  # the current list position is after this sensors interval
-    return chunks
-
-def _lies_within_strict(f, x, t): return f <= x <= t # example
-def _lies_within_plus_one(f, x, t): return f <= x <= t + 1 # example
-def _lies_within_iso_str(f:str, x:str, t:str) -> bool:
-    fi, xi, ti = iso_to_int(f), iso_to_int(x), iso_to_int(t)
-    return fi <= xi and ((xi-ti) % 760000) <= 10000 # one hour mod rollover for one day
-
-def matcher_by_time_class(time_class:str) -> Callable: # TODO(florian): Add more time_classes
-    return {'hourly' : _lies_within_iso_str}.get(time_class, None)
-# NOTE(florian): Using _lies_within_strict as a default wont lead to wrong results, but it'll slow things down over time,
-# because more and more timestamps will accumulate in mongodb
 
-# TODO(florian): refactor this
-def merge_already_sent(sub_chunks:List[Tuple[Union[str, int]]],
-                       time_class:str=None) -> list:
-    _lies_within = matcher_by_time_class(time_class)
-    if _lies_within is None: # TODO(florian): should this crash, instead of a warning?
+ALL = 'all' # push every measurand that a file has a column for
+# the measurands that are pushed for each kind of product file, e.g. a temperature file also has a humidity column
+PRODUCT_MEASURANDS = {'temperature'  : ('temperature', 'humidity'),
+                      'cloudiness'   : ('cloudiness',),
+                      'air_pressure' : ('air_pressure', 'air_pressure_nn'),
+                      'wind_speed'   : ('wind_speed', 'wind_direction'),
+                      'precipitation': ('precipitation',),
+                      'sunshine'     : ('sunshine',)}
+
+def measurand_columns(field_defs:tuple) -> Dict[str, int]:
+    """Every measurand that can be pushed from a file, mapped to the field index of its column."""
+    _, _, _, _, \
+    air_temperature_idx , humidity_idx, cloudiness_idx, \
+    _, precipitation_amount_idx, _, \
+    air_pressure_nn_idx , air_pressure_idx, \
+    sunshine_mins_per_hour_idx, wind_speed_idx, wind_direction_idx = field_defs
+    columns = {'temperature'  : air_temperature_idx     , 'humidity'       : humidity_idx       ,
+               'cloudiness'   : cloudiness_idx          ,
+               'air_pressure' : air_pressure_idx        , 'air_pressure_nn': air_pressure_nn_idx,
+               'wind_speed'   : wind_speed_idx          , 'wind_direction' : wind_direction_idx ,
+               'precipitation': precipitation_amount_idx, 'sunshine'       : sunshine_mins_per_hour_idx}
+    return {measurand: idx for measurand, idx in columns.items() if idx is not None}
+
+def measurands_to_push(measurand:str, field_defs:tuple) -> Dict[str, int]:
+    """The measurands (and their columns) that are pushed for a file of the given kind, or all of them for ALL."""
+    columns = measurand_columns(field_defs)
+    if measurand == ALL: return columns
+    return {m: columns[m] for m in PRODUCT_MEASURANDS.get(measurand, ()) if m in columns}
+
+
+################## Columnar Parsing ##################
+PARSE_BATCH_SIZE = 20_000 # lines per batch, bounds the memory used by intermediate strings
+
+class Product(NamedTuple):
+    """A parsed `produkt_*` file. All arrays are sorted by date and have the same length."""
+    dwd_id    : str
+    dates     : np.ndarray # int64, MESS_DATUM as hours since the epoch
+    columns   : Dict[int, np.ndarray] # field index -> float64, NaN marks a missing value
+    field_defs: tuple
+
+def _column_as_float(column:np.ndarray) -> np.ndarray:
+    """Convert a column of numeric strings to float64. Entries that can't be parsed become NaN."""
+    try: return column.astype(np.float64)
+    except ValueError: pass
+    values, bad = np.empty(len(column), dtype=np.float64), []
+    for i, x in enumerate(column.tolist()):
+        try: values[i] = float(x)
+        except ValueError: values[i] = np.nan; bad.append(x)
+    if bad: # NOTE(florian): logged once per column instead of once per value, a broken file can have thousands of them
+        print(f'ValueError: {len(bad)} of {len(column)} entries are no numbers, e.g. {bad[0]!r}')
+        metrics.inc('values_unparsable', len(bad))
+    return values
+
+def clean_float_column(values:np.ndarray) -> np.ndarray:
+    values[values == -999.0] = np.nan # -999 is the dwd's marker for a missing value
+    return values
+
+def clean_cloudiness_column(values:np.ndarray) -> np.ndarray:
+    """Values between 1 and 7 are mapped to a float between 0 and 1, everything else is missing."""
+    with np.errstate(invalid='ignore'):
+        valid = (0 < values) & (values < 8) & (values == np.floor(values))
+    return np.where(valid, values * 0.125, np.nan) # 1/8 = 0.125
+
+def column_cleaners(field_defs:tuple) -> Dict[int, Callable]:
+    """Map the field index of every content column in a file to the function that cleans its values."""
+    return {idx: clean_cloudiness_column if measurand == 'cloudiness' else clean_float_column
+            for measurand, idx in measurand_columns(field_defs).items()}
+
+def parse_product_batch(lines:Iterable[str], nr_of_fields:int,
+                        dwd_id_idx:int, date_idx:int, cleaners:Dict[int, Callable]) -> Tuple[np.ndarray]:
+    """Parse a batch of lines into a station id column, a date column and one float column per cleaner.
+    Lines with an unexpected number of fields, or without a valid station id or date are dropped."""
+    nr_of_seperators = nr_of_fields - 1
+    lines = [line for line in lines if line and line.count(';') == nr_of_seperators]
+    fields = np.array(';'.join(lines).split(';') if lines else [], dtype=str).reshape(len(lines), nr_of_fields)
+    ids, dates = _column_as_float(fields[:, dwd_id_idx]), _column_as_float(fields[:, date_idx])
+    valid = ~(np.isnan(ids) | np.isnan(dates))
+    columns = {idx: clean(_column_as_float(fields[valid, idx])) for idx, clean in cleaners.items()}
+    return ids[valid].astype(np.int64), dates[valid].astype(np.int64), columns
+
+def _batches(lines:Iterable[str], batch_size:int) -> Iterator[List[str]]:
+    lines = iter(lines)
+    while True:
+        with metrics.timed('read_lines'): batch = list(islice(lines, batch_size)) # e.g. decompressing a zip member
+        if not batch: return
+        yield batch
+
+def parse_header(first_line:str) -> Tuple[int, tuple]:
+    """Returns the number of fields and the field indices of the first line of a `produkt_*` file."""
+    first_line = clean_str(first_line)
+    nr_of_fields = len(first_line)
+    field_defs = get_indices(first_line)
+
+    if nr_of_fields < 5: raise Exception(f'Nr of fields is lower than expected: {first_line}')
+    dwd_id_idx, date_idx = field_defs[:2]
+    if dwd_id_idx is None: raise Exception(f'File does not contain a dwd_id index: {field_defs}')
+    if date_idx is None: raise Exception(f'File does not contain a Timestamp index: {field_defs}')
+    return nr_of_fields, field_defs
+
+def iter_product_batches(lines:Iterable[str], nr_of_fields:int, field_defs:tuple,
+                         batch_size:int=PARSE_BATCH_SIZE) -> Iterator[Tuple[np.ndarray]]:
+    """Lazily parses lines into batches of typed columns (see parse_product_batch()).
+    Only batch_size lines are held in memory at once, so lines can be streamed straight out of a zip file."""
+    dwd_id_idx, date_idx = field_defs[:2]
+    cleaners = column_cleaners(field_defs)
+    for batch in _batches(lines, batch_size):
+        metrics.inc('rows_read', len(batch))
+        with metrics.timed('parse'): columns = parse_product_batch(batch, nr_of_fields, dwd_id_idx, date_idx, cleaners)
+        yield columns
+
+def parse_product(first_line:str, lines:Iterable[str], batch_size:int=PARSE_BATCH_SIZE,
+                  window:Tuple[int, int]=None) -> Product:
+    """Parse the content of a `produkt_*` file into typed columns, keeping only rows of the files station.
+    With a window [start, end) of hours, only rows inside of it are kept. Rows are dropped batch by batch, so that
+    the memory used for an archive that spans decades is bounded by the size of the window."""
+    nr_of_fields, field_defs = parse_header(first_line)
+    cleaners = column_cleaners(field_defs)
+    dwd_id, nr_of_rows, kept = None, 0, []
+    for ids, dates, columns in iter_product_batches(lines, nr_of_fields, field_defs, batch_size):
+        if dwd_id is None and len(ids): dwd_id = ids[0]
+        nr_of_rows += len(ids)
+        dates, valid_dates = yyyymmddhh_to_hours(dates)
+        keep = (ids == dwd_id) & valid_dates
+        if window is not None: keep &= (window[0] <= dates) & (dates < window[1])
+        keep = np.flatnonzero(keep)
+        kept.append((dates[keep], {idx: column[keep] for idx, column in columns.items()}))
+    print(f'nr of lines with a valid id and date: {nr_of_rows}')
+    if dwd_id is None: raise Exception('Could not find a valid dwd_id')
+
+    dates = np.concatenate([b[0] for b in kept])
+    order = np.argsort(dates, kind='stable')
+    columns = {idx: np.concatenate([b[1][idx] for b in kept])[order] for idx in cleaners}
+    print(f'nr of lines after removing invalids{"" if window is None else " and rows outside of the window"}: {len(order)}')
+    metrics.inc('rows_valid', nr_of_rows); metrics.inc('rows_kept', len(order))
+    return Product(dwd_id=str(dwd_id), dates=dates[order], columns=columns, field_defs=field_defs)
+
+
+def sensor_bounds(sensor:dict) -> Tuple[int, int]:
+    """the first and last hour recorded by a sensor. A sensor without a latest_day is still active."""
+    return iso_to_hour(sensor['earliest_day']), iso_to_hour(sensor['latest_day'])
+
+def seperate_by_sensor(dates:np.ndarray, sensors:list) -> Dict[int, Tuple[int, int]]:
+    """Splits the sorted timestamps into chunks depending on what sensor the value was recorded by.
+    Returns {position of the sensor in sensors: (start, end)}, only for sensors that recorded any value.
+    sensors have to be sorted by their earliest_day. If the ranges of two sensors overlap, values belong to the first."""
+    if not len(dates) or not sensors: return {}
+    bounds = np.array([sensor_bounds(sensor) for sensor in sensors], dtype=np.int64)
+    starts = np.searchsorted(dates, bounds[:, 0], 'left')
+    ends   = np.searchsorted(dates, bounds[:, 1], 'right') # NOTE(florian): end is exclusive, like in slicing "[i:j]"
+    # every sensor can only start where all the previous ones have ended
+    starts = np.maximum(starts, np.maximum.accumulate(np.concatenate(([0], ends[:-1]))))
+    return {i: (int(start), int(end)) for i, (start, end) in enumerate(zip(starts, ends)) if start < end}
+
+def gap_by_time_class(time_class:str) -> int: # TODO(florian): Add more time_classes
+    """The distance between two consecutive timestamps, so that touching sent ranges can be coalesced."""
+    gap = {'hourly' : 1}.get(time_class, None) # timestamps are in hours
+    if gap is None: # TODO(florian): should this crash, instead of a warning?
         print(f'WARNING: Using the default strict comparison for merging already sent values because time_class is not recognised: {time_class}')
-        _lies_within = _lies_within_strict
-    if len(sub_chunks) > 1:
-        sub_chunks = sorted(sub_chunks, key=lambda x: x[0])
-        out_chunks = []
-        f, t = sub_chunks[0]
-        for _f, _t in sub_chunks[1:]:
-            if _lies_within(f, _f, t): t = max(t, _t)
-            else:
-                out_chunks.append((f, t))
-                f, t = _f, _t
-        out_chunks.append((f, t))
-        return out_chunks
-    else: return sub_chunks
-    
-def split_by_already_sent(start:int, end:int, timestamps:List[str], already_sent:List[Tuple[str]]) -> List[int]:
+        gap = 0
+    return gap
+# NOTE(florian): Using a gap of 0 as a default wont lead to wrong results, but it'll slow things down over time,
+# because more and more timestamps will accumulate in mongodb
+
+def split_by_already_sent(start:int, end:int, timestamps:np.ndarray, already_sent:IntervalSet) -> List[Tuple[int]]:
     """Check which of the timestamps lie outside the ranges of the already_sent timestamps, and return them."""
     # NOTE(florian): (end - 1) is used, because end is the first element that is NO LONGER PART OF the data, so we don't include it.
-    if len(already_sent) > 0:
-        yet_to_sent = []
-        for a, b in already_sent:
-            if timestamps[start] < a: # is start before the start of the already_sent interval?
-                if a < timestamps[end - 1]: # is end after the start of the already_sent interval?
-                    # since both are true, there has to be a transition.
-                    yet_to_sent.append((start, find_transition(start, end - 1, timestamps, lambda x: x < a)))
-                else:
-                    yet_to_sent.append((start, end)) # no part of the data has been sent yet
-                    break
-            else: pass # start has already been sent
-            
-            if timestamps[start] < b < timestamps[end - 1]:
-                # there is still data after this already_sent interval
-                start = find_transition(start, end - 1, timestamps, lambda x: x <= b)
-            else:
-                if b < timestamps[end - 1]: continue # this already_sent interval is entirely before the data
-                else: break # subsequent already_sent intervals all come after this one chronologically
-        else: # the loop has run to completion, without hitting a break. check if there is still data left
-            if start < end: yet_to_sent.append((start, end))
-        return yet_to_sent
-    else: return [(start, end)]
+    if start >= end: return []
+    yet_to_sent, timestamps = [], timestamps[start:end]
+    for a, b in already_sent.missing(int(timestamps[0]), int(timestamps[-1])):
+        i, j = np.searchsorted(timestamps, a, 'left'), np.searchsorted(timestamps, b, 'right')
+        if i < j: yet_to_sent.append((start + int(i), start + int(j)))
+    return yet_to_sent
 
 ##################### MAIN #######################
 def handle_content_data(first_line:str,
                         lines     :List[str],
-                        measurand :str='temperature', # TODO(florian): pass these from somewhere
-                        data_class:str='recent',
-                        time_class:str='hourly'):
+                        measurand :str='temperature',
+                        data_class:str='recent', # TODO(florian): pass these from somewhere
+                        time_class:str='hourly',
+                        concurrency:int=1,
+                        window:Tuple[int, int]=None):
+    """Pushes the measurands of a file of the given kind, or with measurand=ALL every measurand the file has a column
+    for, from a single parse. With a concurrency > 1, up to that many batches per sensor are pushed to the osn api
+    at once. With a window [start, end) of hours, only the values inside of it are pushed (see backfill.py)."""
     logged_action = False # NOTE(florian): needed?
-    first_line = clean_str(first_line)
-    len_first_line = len(first_line)
-    field_defs = get_indices(first_line)
+    batch_size = AdaptiveBatchSize()
+    dwd_id, dates, columns, field_defs = parse_product(first_line, lines, window=window)
     print(field_defs)
 
-    if len_first_line < 5: raise Exception(f'Nr of fields is lower than expected: {first_line}')
+    dwd_id_idx, date_idx, quality_idx , structure_version_idx, *_ = field_defs
 
-    dwd_id_idx, date_idx, quality_idx , structure_version_idx, \
-    air_temperature_idx , humidity_idx, cloudiness_idx, \
-    precipitation_yes_no_idx, precipitation_amount_idx, precipitation_type_idx, \
-    air_pressure_nn_idx     , air_pressure_idx, \
-    sunshine_mins_per_hour_idx, wind_speed_idx, wind_direction_idx = field_defs
-
-    if dwd_id_idx is None: raise Exception(f'File does not contain a dwd_id index: {field_defs}')
-    if date_idx is None: raise Exception(f'File does not contain a Timestamp index: {field_defs}')
     if quality_idx is None: pass # Not Implemented yet and not essential
     if structure_version_idx is None: pass # Not Implemented yet and not essential
-
-    print(f'nr of lines at start: {len(lines)}')
-    lines = [clean_str(x) for x in lines if not(x is None or x == '')]
-
-    dwd_id = lines[0][dwd_id_idx]
-    if not dwd_id.isdigit() or dwd_id is None:
-        dwd_id = lines[1][dwd_id_idx]
-        if not dwd_id.isdigit() or dwd_id is None: raise Exception(f'Could not find a valid dwd_id: {dwd_id}')
     print(f'dwd_id: {dwd_id}')
 
-    lines = sorted(lines, key=lambda x: x[date_idx])
-    lines = [line for line in lines if (len(line) == len_first_line and
-                                        line[dwd_id_idx] == dwd_id)]
-    print(f'nr of lines after removing invalids: {len(lines)}')
-
-    lines = list(zip(*lines)) # transpose
-
-    # https://docs.python.org/3/library/datetime.html#strftime-strptime-behavior
-    iso_dates = [to_iso_date(timestamp=ts, format='%Y%m%d%H') for ts in lines[date_idx]]
-
     print('-'*80)
 
-    valuebulk = {'collapsedMessages': []}
-    messages = valuebulk['collapsedMessages']
-
-    def _add_float_values(i:int, j:int,
-                          idx:int, osn_id:int):
-        for iso_date, value in zip(iso_dates[i:j], lines[idx][i:j]):
-            value = to_float_or_none(value)
-            if value is not None and value != -999.0:
-                messages.append({'sensorId': osn_id,
-                                 'timestamp': iso_date,
-                                 'numberValue': value})
-
-    def _add_cloudiness_values(i:int, j:int,
-                               idx:int, osn_id:int):
-        for iso_date, value in zip(iso_dates[i:j], lines[idx][i:j]):
-            value = to_int_or_none(value)
-            if value is not None and 0 < value < 8:
-                value *= 0.125 # 1/8 = 0.125 -> map to float between 0 and 1
-                messages.append({'sensorId': osn_id,
-                                 'timestamp': iso_date,
-                                 'numberValue': value})
-                
-    def _process_chunks(idx:int, chunks:tuple, sensors:dict, local_id:str, _add_values:Callable, collection:Collection):
-        nonlocal valuebulk, messages, logged_action
+    def _make_valuebulk(i:int, j:int, idx:int, osn_id:int) -> dict:
+        values = columns[idx][i:j]
+        present = ~np.isnan(values)
+        return {'collapsedMessages': [{'sensorId': osn_id, 'timestamp': iso_date, 'numberValue': value}
+                                      for iso_date, value in zip(hours_to_iso(dates[i:j][present]).tolist(),
+                                                                 values[present].tolist())]}
+
+    def _record_push(i:int, j:int, nr_of_values:int, t0:float, sensor:dict, local_id:str, writes:WriteBuffer):
+        print(f'Pushed {nr_of_values} values to osn_id {sensor["osn_id"]}. took: {round(time.time() - t0, 5)} sec')
+        delta = sensor['sent_values'].add(int(dates[i]), int(dates[j - 1]))
+        new_delta = sensor['new_values'].add(int(dates[i]), int(dates[j - 1]))
+        # NOTE(florian): Other windows of the same sensor may be pushed at the same time, so a window only writes the
+        # ranges it sent itself, and leaves coalescing them with the stored ones to the next run without a window.
+        mongo_record_sent(local_id, sensor['idx'], *(delta if window is None else new_delta), writes)
+        counters.inc(VALUES_COUNTER, 'valueCount', nr_of_values)
+
+    def _push_once(i:int, j:int, outcome:str, t0:float, nr_of_values:int,
+                   sensor:dict, local_id:str, writes:WriteBuffer):
+        batch_size.update(outcome, time.time() - t0, j - i)
+        metrics.observe('osn_push_sec', time.time() - t0)
+        metrics.inc(f'pushes_{outcome}')
+        if outcome == PUSHED:
+            metrics.observe('push_values', nr_of_values)
+            _record_push(i, j, nr_of_values, t0, sensor, local_id, writes)
+        elif outcome == OVERLOADED: print(f'Server overloaded by {nr_of_values} values -> batch size {batch_size.size}')
+
+    def _check_overloads(i:int, j:int, overloads:int):
+        if overloads >= MAX_OVERLOADS: # NOTE(florian): the range isn't recorded as sent, so a later run retries it
+            raise api.Overloaded(f'Gave up on rows [{i}, {j}) after the server was overloaded {overloads} times in a row')
+
+    def _push_ranges(ranges:List[tuple], idx:int, sensor:dict, local_id:str, writes:WriteBuffer):
+        for a, b in ranges:
+            i, overloads = a, 0
+            while i < b:
+                j = min(b, i + batch_size.size)
+                valuebulk = _make_valuebulk(i=i, j=j, idx=idx, osn_id=sensor['osn_id'])
+                nr_of_values = len(valuebulk['collapsedMessages'])
+                t0 = time.time()
+                counters.inc(VALUES_COUNTER, 'aimedValueCount', nr_of_values)
+                outcome = osn_push_valuebulk(valuebulk)
+                _push_once(i, j, outcome, t0, nr_of_values, sensor, local_id, writes)
+                if outcome == OVERLOADED and j - i > batch_size.min_size: # retry with the smaller size
+                    overloads += 1
+                    _check_overloads(i, j, overloads)
+                    continue
+                i, overloads = j, 0
+
+    async def _push_ranges_async(ranges:List[tuple], idx:int, sensor:dict, local_id:str, writes:WriteBuffer):
+        # NOTE(florian): A batch is only built once it gets a slot, so at most `concurrency` valuebulks exist at once.
+        slots = asyncio.Semaphore(concurrency)
+        async def _push(i:int, j:int, overloads:int):
+            outcome = FAILED
+            try:
+                valuebulk = _make_valuebulk(i=i, j=j, idx=idx, osn_id=sensor['osn_id'])
+                nr_of_values = len(valuebulk['collapsedMessages'])
+                t0 = time.time()
+                counters.inc(VALUES_COUNTER, 'aimedValueCount', nr_of_values)
+                outcome = await osn_push_valuebulk_async(valuebulk) # the range is only recorded once it is acknowledged
+                _push_once(i, j, outcome, t0, nr_of_values, sensor, local_id, writes)
+            finally: slots.release()
+            if outcome == OVERLOADED and j - i > batch_size.min_size: # retry in smaller pieces
+                _check_overloads(i, j, overloads + 1)
+                await _schedule([(i, j)], overloads + 1)
+        async def _schedule(ranges:List[tuple], overloads:int=0):
+            tasks = []
+            for a, b in ranges:
+                i = a
+                while i < b:
+                    await slots.acquire()
+                    j = min(b, i + batch_size.size)
+                    tasks.append(asyncio.ensure_future(_push(i, j, overloads)))
+                    i = j
+            await asyncio.gather(*tasks)
+        await _schedule(ranges)
+
+    def _process_chunks(idx:int, chunks:tuple, sensors:dict, local_id:str, writes:WriteBuffer):
+        nonlocal logged_action
         if not logged_action:
-            collection.update({"_id": 5}, {"$inc": {"actionCount": 1}}) # NOTE(florian): needed?
+            counters.inc(ACTIONS_COUNTER, 'actionCount')
             logged_action = True
         print(chunks)
         for sensor_id in chunks:
-            sensor       = sensors[sensor_id]
-            osn_id       = sensor['osn_id']
-            sensor_idx   = sensor['idx']
-            already_sent = sensor['sent_values']
-            for yet_to_be_sent in split_by_already_sent(*chunks[sensor_id], iso_dates, already_sent):
-                for i, j in batchify(*yet_to_be_sent, max_batch_size=2000): # TODO(florian): Make max_batch_size global?
-                    _add_values(i=i, j=j, idx=idx, osn_id=osn_id)
-                    t0 = time.time()
-                    collection.update({"_id": 2}, {"$inc": {"aimedValueCount": len(messages)}}) # NOTE(florian): needed?
-                    if osn_push_valuebulk(valuebulk):
-                        print(f'Pushed {len(messages)} values to osn_id {osn_id}. took: {round(time.time() - t0, 5)} sec')
-                        resp = collection.update_one(filter={'local_id' : local_id, 'sensors.idx' : sensor_idx},
-                                              update={'$addToSet':
-                                                      {f'sensors.$.sent_values': (iso_dates[i], iso_dates[j - 1])}})
-                        if not resp.acknowledged:
-                            print(f'WARNING: Failed to record successful push on mongodb! {local_id} {sensor_idx} {iso_dates[i]}')
-                        collection.update({"_id": 2}, {"$inc": {"valueCount": len(messages)}}) # NOTE(florian): needed?
-                        valuebulk['collapsedMessages'] = []
-                        messages = valuebulk['collapsedMessages']
-                    else:
-                        valuebulk['collapsedMessages'] = []
-                        messages = valuebulk['collapsedMessages']
-                        continue
-        mongo_merge_all_already_sent(local_id, time_class, collection)
-
-    def _update(_measurand:str, _idx:int, _func:Callable):
+            sensor = sensors[sensor_id]
+            ranges = split_by_already_sent(*chunks[sensor_id], dates, sensor['sent_values'])
+            metrics.inc('values_already_sent', (chunks[sensor_id][1] - chunks[sensor_id][0]) - sum(b - a for a, b in ranges))
+            if concurrency > 1:
+                asyncio.run(_push_ranges_async(ranges, idx, sensor, local_id, writes))
+            else:
+                _push_ranges(ranges, idx, sensor, local_id, writes)
+            print(f'Batch size for osn_id {sensor["osn_id"]} ({local_id}): {batch_size.size}')
+
+    chunks_by_bounds = {} # NOTE(florian): sensors of companion measurands are usually created with the same ranges
+    def _update(_measurand:str, _idx:int, sensors:list, writes:WriteBuffer):
         local_id = f'{dwd_id}-{_measurand}'
-        with mongo_conn(mongo_db_url) as collection:
-            sensors = mongo_sensors_by_local_id_merged_already_sent(local_id, time_class, collection)
-            chunks = seperate_by_sensor(iso_dates, sensors)
-            _process_chunks(_idx, chunks, sensors, local_id, _func, collection)
-
-    if measurand == 'temperature':
-        if air_temperature_idx is not None: _update('temperature'    , air_temperature_idx, _add_float_values)
-        if humidity_idx        is not None: _update('humidity'       , humidity_idx       , _add_float_values)
-    elif measurand == 'cloudiness':
-        if cloudiness_idx      is not None: _update('cloudiness'     , cloudiness_idx     , _add_cloudiness_values)
-    elif measurand == 'air_pressure':
-        if air_pressure_idx    is not None: _update('air_pressure'   , air_pressure_idx   , _add_float_values)
-        if air_pressure_nn_idx is not None: _update('air_pressure_nn', air_pressure_nn_idx, _add_float_values)
-    elif measurand == 'wind_speed':
-        if wind_speed_idx      is not None: _update('wind_speed'     , wind_speed_idx     , _add_float_values)
-        if wind_direction_idx  is not None: _update('wind_direction' , wind_direction_idx , _add_float_values)
+        bounds = tuple(sensor_bounds(sensor) for sensor in sensors)
+        if bounds not in chunks_by_bounds: chunks_by_bounds[bounds] = seperate_by_sensor(dates, sensors)
+        _process_chunks(_idx, chunks_by_bounds[bounds], sensors, local_id, writes)
+
+    to_push = measurands_to_push(measurand, field_defs)
+    print(f'measurands: {list(to_push)}')
+    # NOTE(florian): All writes of a file go out as one bulk_write when the buffer is closed, which also happens if a
+    # push fails, so that the values that did get through are still recorded. The same goes for the counters.
+    with mappings_conn(mongo_db_url) as mapping_collection, sent_conn(mongo_db_url) as sent_collection, \
+         WriteBuffer(sent_collection) as writes, \
+         counters_conn(mongo_db_url) as counter_collection, Counters(counter_collection) as counters:
+        sensors_by_local_id = mongo_sensors_by_local_ids([f'{dwd_id}-{m}' for m in to_push], time_class,
+                                                         mapping_collection, sent_collection, writes,
+                                                         coalesce=window is None)
+        for _measurand, _idx in to_push.items():
+            sensors = sensors_by_local_id.get(f'{dwd_id}-{_measurand}')
+            if sensors is not None: _update(_measurand, _idx, sensors, writes)
+            elif measurand == ALL: print(f'No sensor mapping found for local id: {dwd_id}-{_measurand} -> skipped')
+            else: raise Exception(f'No sensor mapping found for local id: {dwd_id}-{_measurand}')
+
+def handle_content_lines(lines:Iterable[str], measurand:str='temperature', concurrency:int=1,
+                         window:Tuple[int, int]=None):
+    """Entry point for callers that stream the lines of a `produkt_*` file in-process, e.g. get_csv_action."""
+    api.login(username=secretmanager.__OSNUSERNAME__, password=secretmanager.__OSNPASSWORD__)
+    lines = iter(lines)
+    handle_content_data(first_line=next(lines), lines=lines, measurand=measurand, concurrency=concurrency, window=window)
     
 ##################### OpenWhisk Entrypoint #######################
 def main(args):
@@ -384,11 +541,22 @@ def main(args):
     rest_names = args.get("restfilenames")
     measurand = args.get("measurand", 'temperature')
     if csv is None: return {"error": "seuquence should be stopped"}
+    metrics.start('handlecontentdataaction', store=args.get('storemetrics'))
+    # only worth it if the api accepts 'content-encoding: gzip'. Set on Settings, so the pooled session is kept
+    api.Settings.gzip_bodies = str(args.get('gzip', '')).lower() in ('1', 'true', 'yes')
     try:
         api.login(username=secretmanager.__OSNUSERNAME__, password=secretmanager.__OSNPASSWORD__)
         lines = csv.splitlines()
         first_line, lines = lines[0], lines[1:]
-        handle_content_data(first_line=first_line, lines=lines)
+        window = args.get("window") # [start, end) in hours since the epoch, e.g. from a backfill job
+        handle_content_data(first_line=first_line, lines=lines, measurand=measurand,
+                            concurrency=args.get("concurrency", 1), window=None if window is None else tuple(window))
+        if window is None and args.get("filename") and args.get("ftp_url"):
+            # lets incremental listings skip the file, until it changes on the ftp server (see getfilenamesaction)
+            with dwdftp.files_conn(mongo_db_url) as collection:
+                dwdftp.mark_imported(collection, args["ftp_url"], args["filename"])
     except Exception as e: print("Exception {}".format(e))
-    finally: secretmanager.complete_sequence(rest_names)
+    finally:
+        metrics.finish(mongo_db_url)
+        secretmanager.complete_sequence(rest_names, ftp_url=args.get("ftp_url"))
     return {"message": "finished"}
\ No newline at end of file
@@ -0,0 +1,85 @@
+"""
+worker_action.py: This action claims station files from the work queue and imports them, until the queue is empty or
+its time budget runs out
+"""
+
+__author__ = "Ahmet Kilic https://github.com/flamestro"
+
+import os
+import time
+import uuid
+
+try:
+    import secretmanager
+except:
+    import deployment_tmp.secret_manager as secretmanager
+
+try:
+    import workqueue
+except:
+    import deployment_tmp.workqueue as workqueue
+
+try:
+    import metrics
+except:
+    import deployment_tmp.metrics as metrics
+
+try:
+    import osnapi as api
+except:
+    import deployment_tmp.osnapi as api
+
+try:
+    import station_action
+except:
+    import src.station_action as station_action
+
+# stop claiming new files after this many seconds, so that the current file can finish before the action timeout
+WORKER_BUDGET_SEC = 240
+
+
+def work(queue, worker, budget_sec=WORKER_BUDGET_SEC, lease_sec=workqueue.LEASE_SEC):
+    """claims and imports files until the queue is drained or the budget is used up, returns the nr of handled files"""
+    deadline = time.time() + budget_sec
+    handled = 0
+    while time.time() < deadline:
+        job = workqueue.claim(queue, worker, lease_sec=lease_sec)
+        if job is None:
+            # files that other workers still hold are not waited for, their leases are retried by whichever worker
+            # or splitter run finds them expired
+            break
+        try:
+            # backfill jobs are a time window of a file, see workqueue.enqueue_windows
+            station_action.handle_station(job.get("filename", job["_id"]), ftp_path=job["ftp_url"],
+                                          measurand=job["measurand"], window=job.get("window"))
+            workqueue.complete(queue, job)
+            metrics.inc("files_done")
+        except Exception as e:
+            print("failed file {} attempt {} because of {}".format(job["_id"], job["attempts"], e))
+            workqueue.release(queue, job, error=str(e))
+            metrics.inc("files_failed")
+        handled += 1
+    return handled
+
+
+def main(args):
+    worker = os.environ.get("__OW_ACTIVATION_ID", uuid.uuid4().hex)
+    budget_sec = args.get("budget", WORKER_BUDGET_SEC)
+    lease_sec = args.get("lease", workqueue.LEASE_SEC)
+    metrics.start("workeraction", store=args.get("storemetrics"))
+    # compress the pushed values, if the opensense api accepts 'content-encoding: gzip'
+    api.Settings.gzip_bodies = str(args.get("gzip", "")).lower() in ("1", "true", "yes")
+    try:
+        with workqueue.queue_conn(secretmanager.__MONGOURL__) as queue:
+            handled = work(queue, worker, budget_sec=budget_sec, lease_sec=lease_sec)
+            if workqueue.has_claimable(queue):
+                # hand over to a fresh worker, so that the number of running workers stays the same. expired leases
+                # are claimable, so this also retries the files of workers that crashed
+                secretmanager.start_worker(budget_sec, lease_sec)
+            state = workqueue.counts(queue)
+    except Exception as e:
+        print("worker failed", e)
+        return {"error": "worker failed because of unkown error"}
+    finally:
+        metrics.finish(secretmanager.__MONGOURL__)
+    return {"message": "worker {} handled {} files".format(worker, handled), "queue": state}
@@ -0,0 +1,22 @@
+"""Tests of parsing the columns of a produkt file as floats"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import numpy as np
+
+import deployment_tmp.metrics as metrics
+import src.value_handling.handle_content_data_action as h
+
+
+def test_numbers_are_parsed_quietly(capsys):
+    metrics.start('tests')
+    np.testing.assert_array_equal(h._column_as_float(np.array(['1.5', ' -999', '3'])), [1.5, -999., 3.])
+    assert capsys.readouterr().out == '' and 'values_unparsable' not in metrics.current().counters
+
+def test_bad_entries_become_nan_and_are_logged_once(capsys):
+    metrics.start('tests')
+    column = np.array(['1.5', 'eor', '2', ''] + ['x'] * 1000)
+    values = h._column_as_float(column)
+    assert values[0] == 1.5 and values[2] == 2. and np.isnan(values[[1, 3]]).all() and np.isnan(values[4:]).all()
+    assert capsys.readouterr().out.count('ValueError') == 1
+    assert metrics.current().counters['values_unparsable'] == 1002
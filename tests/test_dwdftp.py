@@ -0,0 +1,143 @@
+"""Tests of the pooled, resumable downloads, the download cache and the listings of dwdftp against a local ftp server"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import io
+import logging
+import os
+import threading
+
+import pytest
+
+pytest.importorskip('pyftpdlib') # only used by the tests and the benchmark
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+import deployment_tmp.dwdftp as dwdftp
+import deployment_tmp.metrics as metrics
+
+PATH = 'hourly/air_temperature/recent/'
+FILES = {'stundenwerte_TU_00003_akt.zip': os.urandom(300_000), 'stundenwerte_TU_00044_akt.zip': os.urandom(1000),
+         'empty_akt.zip': b'', 'readme.txt': b'not a zip'}
+
+
+#######################################
+#               SERVER                #
+#######################################
+def serve(root:str, mlsd:bool=True) -> ThreadedFTPServer:
+    """An anonymous ftp server for root. Without mlsd, it doesn't know MLSD and MLST, like some older servers."""
+    logger = logging.getLogger('pyftpdlib')
+    logger.addHandler(logging.NullHandler()); logger.propagate = False
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    proto_cmds = {cmd: info for cmd, info in FTPHandler.proto_cmds.items() if mlsd or cmd not in ('MLSD', 'MLST')}
+    handler = type('TestFTPHandler', (FTPHandler,), {'authorizer': authorizer, 'proto_cmds': proto_cmds})
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True).start()
+    return server
+
+@pytest.fixture(params=[True, False], ids=['mlsd', 'no-mlsd'])
+def ftp_server(request, tmp_path, monkeypatch):
+    root = tmp_path / 'ftp'
+    (root / PATH).mkdir(parents=True)
+    for name, data in FILES.items(): (root / PATH / name).write_bytes(data)
+    server = serve(str(root), mlsd=request.param)
+    monkeypatch.setattr(dwdftp, 'FTP_HOST', '127.0.0.1')
+    monkeypatch.setattr(dwdftp, 'FTP_PORT', server.address[1])
+    metrics.start('tests')
+    yield root
+    dwdftp.close_all()
+    dwdftp.configure_cache(None)
+    server.close_all()
+
+class DroppingFile(io.BytesIO):
+    """Breaks the transfer once, after `drop_after` bytes have arrived, like a connection that was reset."""
+    def __init__(self, drop_after:int):
+        super().__init__()
+        self.drop_after, self.dropped = drop_after, False
+
+    def write(self, data:bytes) -> int:
+        if not self.dropped and self.tell() + len(data) > self.drop_after:
+            self.dropped = True
+            super().write(data[:self.drop_after - self.tell()])
+            raise ConnectionResetError('connection reset by peer')
+        return super().write(data)
+
+
+#######################################
+#              DOWNLOADS              #
+#######################################
+def test_fetch(ftp_server):
+    name = 'stundenwerte_TU_00003_akt.zip'
+    with dwdftp.fetch(PATH + name) as f: assert f.read() == FILES[name]
+
+def test_connections_are_reused(ftp_server):
+    for name in FILES:
+        with dwdftp.fetch(PATH + name) as f: assert f.read() == FILES[name]
+    assert metrics.current().observations['ftp_login_sec'][0] == 1
+
+def test_dropped_transfer_is_resumed(ftp_server):
+    name = 'stundenwerte_TU_00003_akt.zip'
+    out = DroppingFile(drop_after=100_000)
+    assert dwdftp.download(PATH + name, out) == len(FILES[name])
+    # the second attempt continued with REST where the first one broke off, a restart from 0 would have appended the
+    # beginning of the file a second time
+    assert out.dropped and out.getvalue() == FILES[name]
+    assert metrics.current().counters['ftp_retries'] == 1
+
+def test_missing_file_is_not_retried(ftp_server):
+    with pytest.raises(dwdftp.error_perm): dwdftp.fetch(PATH + 'missing.zip')
+    assert metrics.current().counters['ftp_retries'] == 0
+
+def test_download_many(ftp_server):
+    files = dwdftp.download_many([PATH + name for name in FILES], workers=2)
+    for path, f in files.items():
+        with f: assert f.read() == FILES[path[len(PATH):]]
+
+
+#######################################
+#            DOWNLOAD CACHE           #
+#######################################
+def test_cache_hit_and_miss(ftp_server, tmp_path):
+    dwdftp.configure_cache(str(tmp_path / 'cache'), max_bytes=10**6)
+    name = 'stundenwerte_TU_00003_akt.zip'
+    for _ in range(2):
+        with dwdftp.fetch(PATH + name) as f: assert f.read() == FILES[name]
+    counters = metrics.current().counters
+    assert counters['download_cache_misses'] == 1 and counters['download_cache_hits'] == 1
+    # a file that changed on the server is a miss
+    changed = os.urandom(1000)
+    (ftp_server / PATH / name).write_bytes(changed)
+    with dwdftp.fetch(PATH + name) as f: assert f.read() == changed
+    assert counters['download_cache_misses'] == 2
+
+def test_cache_is_evicted(ftp_server, tmp_path):
+    cache = dwdftp.configure_cache(str(tmp_path / 'cache'), max_bytes=100_000)
+    for name in ('stundenwerte_TU_00044_akt.zip', 'stundenwerte_TU_00003_akt.zip'):
+        with dwdftp.fetch(PATH + name): pass
+    # the large file is kept even though it doesn't fit, the least recently used one is evicted for it
+    assert [size for _, size, _ in cache.entries()] == [300_000]
+
+def test_empty_file_in_cache(ftp_server, tmp_path):
+    dwdftp.configure_cache(str(tmp_path / 'cache'), max_bytes=10**6)
+    for _ in range(2):
+        with dwdftp.fetch(PATH + 'empty_akt.zip') as f: assert f.read() == b''
+
+
+#######################################
+#               LISTING               #
+#######################################
+def test_list_dir(ftp_server, request, monkeypatch):
+    nlst_calls = []
+    def _list_nlst(*args):
+        nlst_calls.append(args)
+        return list_nlst(*args)
+    list_nlst = dwdftp._list_nlst
+    monkeypatch.setattr(dwdftp, '_list_nlst', _list_nlst)
+    with dwdftp.connection() as conn: files = dwdftp.list_dir(conn.ftp, PATH)
+    assert len(nlst_calls) == (0 if request.node.callspec.params['ftp_server'] else 1) # the fallback without MLSD
+    assert sorted(files) == sorted(name for name in FILES if name.endswith('.zip'))
+    for name, (size, modify) in files.items():
+        assert size == len(FILES[name]) and len(modify) >= 14 and modify[:14].isdigit()
+        with dwdftp.connection() as conn: assert conn.fingerprint(PATH + name) == (size, modify)
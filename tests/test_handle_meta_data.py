@@ -0,0 +1,80 @@
+"""Tests of creating the sensors of a metadata file on a fake osn api, with MongoDB replaced by mongomock"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import time
+
+import numpy as np
+import pytest
+
+mongomock = pytest.importorskip('mongomock') # only used by the tests and the benchmark
+
+import deployment_tmp.metrics as metrics
+import deployment_tmp.mongodb as mongodb
+import deployment_tmp.osnapi as api
+import src.sensor_handling.handle_meta_data_action as h
+from src.benchmark import FakeOSN, meta_data
+
+MONGO_URL = 'mongomock://tests'
+STATION, START = 90_000, int(np.datetime64('2019-01-01T00', 'h').astype(np.int64))
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    client = mongomock.MongoClient()
+    mongodb.use_client(MONGO_URL, client)
+    monkeypatch.setattr(h, 'mongo_db_url', MONGO_URL)
+    yield client['opensense']
+    mongodb.close_client()
+
+@pytest.fixture
+def osn(monkeypatch):
+    osn = FakeOSN(latency=0.1)
+    monkeypatch.setattr(api.Settings, 'api_endpoint', osn.endpoint)
+    api.clear_cache()
+    yield osn
+    osn.close()
+    api.clear_cache()
+
+def pending_sensors(n:int) -> list:
+    return [h.PendingSensor(f'{STATION}-temperature', {'idx': k, 'osn_id': None, 'earliest_day': ''}, {'k': k})
+            for k in range(n)]
+
+def test_creates_sensors_concurrently(osn):
+    pending = pending_sensors(8)
+    t0 = time.time()
+    assert h.createRemoteSensors(pending, concurrency=8) == 0
+    assert time.time() - t0 < 8 * osn.latency / 2 # one request after the other would take 0.8 sec
+    assert sorted(s.mongo_sensor['osn_id'] for s in pending) == [STATION * 100 + k for k in range(1, 9)]
+
+def test_concurrency_bounds_the_requests_in_flight(osn):
+    t0 = time.time()
+    assert h.createRemoteSensors(pending_sensors(4), concurrency=1) == 0
+    assert time.time() - t0 >= 4 * osn.latency
+
+def test_unreachable_api_fails_every_sensor(monkeypatch):
+    osn = FakeOSN()
+    monkeypatch.setattr(api.Settings, 'api_endpoint', osn.endpoint)
+    osn.close() # nothing listens on the port anymore
+    pending = pending_sensors(3)
+    assert h.createRemoteSensors(pending, concurrency=3) == 3
+    assert all(s.mongo_sensor['osn_id'] is None for s in pending)
+
+def test_parse_metadata_creates_a_sensor_per_period(mongo, osn):
+    h.parse_metadata(meta_data(STATION, START, 2000, periods=3), 'temperature')
+    mappings = {m['local_id']: m['sensors'] for m in mongo[mongodb.MAPPINGS].find()}
+    assert sorted(mappings) == [f'{STATION}-humidity', f'{STATION}-temperature']
+    for sensors in mappings.values():
+        assert [s['idx'] for s in sensors] == [0, 1, 2] and all(s['osn_id'] for s in sensors)
+        assert sensors[-1]['latest_day'] == ''
+    created = osn.stats['sensors']
+    h.parse_metadata(meta_data(STATION, START, 2000, periods=3), 'temperature') # existing sensors aren't created again
+    assert osn.stats['sensors'] == created == 6
+
+def test_measurand_unknown_to_osn_is_skipped(mongo, osn, monkeypatch):
+    getMeasurands = api.getMeasurands
+    monkeypatch.setattr(api, 'getMeasurands', lambda name=None: [] if name == 'humidity' else getMeasurands(name=name))
+    metrics.start('tests')
+    h.parse_metadata(meta_data(STATION, START, 2000, periods=3), 'temperature')
+    assert [m['local_id'] for m in mongo[mongodb.MAPPINGS].find()] == [f'{STATION}-temperature']
+    assert osn.stats['sensors'] == 3 and metrics.current().counters['sensors_failed'] == 3
@@ -0,0 +1,86 @@
+"""Tests of IntervalSet, including randomized ones against coalescing all added intervals at once"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+from typing import List, Set, Tuple
+
+import numpy as np
+import pytest
+
+from deployment_tmp.intervals import IntervalSet
+
+SEEDS = range(200)
+
+
+def covered(intervals) -> Set[int]: return {x for s, e in intervals for x in range(s, e + 1)}
+
+def coalesce(intervals:List[Tuple[int, int]], gap:int) -> List[Tuple[int, int]]:
+    """Merges sorted intervals with a single sweep, wherever the next one starts at most gap after the current end."""
+    out = []
+    for start, end in sorted(intervals):
+        if out and start - out[-1][1] <= gap: out[-1][1] = max(out[-1][1], end)
+        else: out.append([start, end])
+    return [tuple(i) for i in out]
+
+
+#######################################
+#                 ADD                 #
+#######################################
+def test_add_returns_the_delta():
+    intervals = IntervalSet([(0, 2), (5, 6), (10, 12)])
+    assert intervals.add(20, 21) == ([], (20, 21))
+    assert intervals.add(1, 5) == ([(0, 2), (5, 6)], (0, 6))
+    assert intervals.add(11, 11) == ([(10, 12)], (10, 12)) # already covered
+    assert list(intervals) == [(0, 6), (10, 12), (20, 21)]
+
+def test_adjacent_intervals_are_coalesced_within_the_gap():
+    intervals = IntervalSet([(0, 2)], gap=1)
+    assert intervals.add(3, 4) == ([(0, 2)], (0, 4))
+    assert intervals.add(6, 7) == ([], (6, 7)) # 5 is missing, so it's two apart
+    assert list(intervals) == [(0, 4), (6, 7)]
+    strict = IntervalSet([(0, 2)], gap=0)
+    assert strict.add(3, 4) == ([], (3, 4))
+
+def test_constructor_coalesces_unsorted_input():
+    assert list(IntervalSet([(5, 6), (0, 2), (1, 5)])) == [(0, 6)]
+
+def test_invalid_intervals():
+    with pytest.raises(AssertionError): IntervalSet().add(3, 2)
+    with pytest.raises(AssertionError): IntervalSet(gap=-1)
+
+
+#######################################
+#               MISSING               #
+#######################################
+def test_missing():
+    intervals = IntervalSet([(2, 3), (6, 8)])
+    assert intervals.missing(0, 10) == [(0, 1), (4, 5), (9, 10)]
+    assert intervals.missing(2, 8) == [(4, 5)]
+    assert intervals.missing(6, 7) == []
+    assert IntervalSet().missing(4, 5) == [(4, 5)]
+
+def test_contains():
+    intervals = IntervalSet([(2, 3), (6, 8)])
+    assert [x for x in range(10) if x in intervals] == [2, 3, 6, 7, 8]
+
+
+#######################################
+#             RANDOMIZED              #
+#######################################
+@pytest.mark.parametrize('seed', SEEDS)
+def test_matches_coalescing_at_once(seed:int):
+    rng = np.random.default_rng(seed)
+    gap = int(rng.choice([0, 1, 3]))
+    intervals, added = IntervalSet(gap=gap), []
+    for _ in range(rng.integers(1, 30)):
+        start = int(rng.integers(0, 200))
+        end = start + int(rng.integers(0, 10))
+        before = list(intervals)
+        removed, merged = intervals.add(start, end)
+        added.append((start, end))
+        assert list(intervals) == coalesce(added, gap)
+        # the delta turns the intervals before the add into the ones after it
+        assert sorted(set(before) - set(removed) | {merged}) == list(intervals)
+        assert all(r in before for r in removed)
+    lo, hi = sorted(int(x) for x in rng.integers(-10, 220, size=2))
+    assert covered(intervals.missing(lo, hi)) == set(range(lo, hi + 1)) - covered(intervals)
@@ -0,0 +1,27 @@
+"""Tests of storing the metrics summaries of an invocation, with MongoDB replaced by mongomock"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock') # only used by the tests and the benchmark
+
+import deployment_tmp.metrics as metrics
+import deployment_tmp.mongodb as mongodb
+
+MONGO_URL = 'mongomock://tests'
+
+
+@pytest.fixture
+def mongo():
+    client = mongomock.MongoClient()
+    mongodb.use_client(MONGO_URL, client)
+    yield client['opensense']
+    mongodb.close_client()
+
+@pytest.mark.parametrize('store,stored', [(None, 0), ('false', 0), ('no', 0), ('yes', 1), ('true', 1), (True, 1)])
+def test_summaries_are_only_stored_when_enabled(mongo, store, stored:int):
+    metrics.start('tests', store=store)
+    metrics.inc('rows_read', 3)
+    assert metrics.finish(MONGO_URL)['counters'] == {'rows_read': 3}
+    assert mongo['metrics'].count_documents({}) == stored
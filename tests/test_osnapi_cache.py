@@ -0,0 +1,70 @@
+"""Tests of the lookup cache of osnapi"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import pytest
+
+import deployment_tmp.osnapi as api
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    api.clear_cache()
+    yield
+    api.clear_cache()
+
+@pytest.fixture
+def lookup():
+    """A cached function that records the arguments of every call that wasn't answered by the cache."""
+    calls = []
+    @api.cached
+    def getThings(name:str=None, measurandId:int=None) -> list:
+        calls.append((name, measurandId))
+        return [{'name': name, 'measurandId': measurandId}]
+    getThings.calls = calls
+    return getThings
+
+class DictStore():
+    def __init__(self): self.entries = {}
+    def load(self) -> dict: return dict(self.entries)
+    def save(self, entries:dict) -> None: self.entries = dict(entries)
+
+
+def test_positional_and_keyword_args_share_a_key(lookup):
+    assert lookup('x') == lookup(name='x') == lookup('x', None) == lookup(measurandId=None, name='x')
+    assert lookup.calls == [('x', None)]
+
+def test_different_args_are_different_keys(lookup):
+    lookup('x'); lookup('y'); lookup('x', 1)
+    assert lookup.calls == [('x', None), ('y', None), ('x', 1)]
+
+def test_entries_expire_after_the_ttl(lookup, monkeypatch):
+    monkeypatch.setattr(api.Settings, 'cache_ttl', 0)
+    lookup('x'); lookup('x')
+    assert len(lookup.calls) == 2
+
+def test_least_recently_used_entry_is_evicted(lookup, monkeypatch):
+    monkeypatch.setattr(api.Settings, 'cache_maxsize', 2)
+    lookup('a'); lookup('b')
+    lookup('a') # now b is the least recently used one
+    lookup('c')
+    lookup('a'); lookup('b')
+    assert lookup.calls == [('a', None), ('b', None), ('c', None), ('b', None)]
+
+def test_store_warms_a_cold_cache(lookup, monkeypatch):
+    store = DictStore()
+    lookup('x')
+    assert api.save_cache(store) and not api.save_cache(store) # nothing new to save the second time
+    api.clear_cache()
+    monkeypatch.setattr(api, '_cache_loaded', False)
+    assert api.load_cache(store) == 1 and api.load_cache(store) == 0 # only loaded once per process
+    lookup(name='x')
+    assert lookup.calls == [('x', None)]
+
+def test_expired_entries_are_not_loaded(lookup, monkeypatch):
+    store = DictStore()
+    monkeypatch.setattr(api.Settings, 'cache_ttl', -1)
+    lookup('x')
+    api.save_cache(store)
+    api.clear_cache()
+    assert api.load_cache(store, force=True) == 0
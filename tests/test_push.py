@@ -0,0 +1,165 @@
+"""Tests of the push loops of the content handler, with MongoDB replaced by mongomock"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import asyncio
+import threading
+from typing import List
+
+import numpy as np
+import pytest
+
+mongomock = pytest.importorskip('mongomock') # only used by the tests and the benchmark
+
+import deployment_tmp.mongodb as mongodb
+import deployment_tmp.osnapi as api
+import src.value_handling.handle_content_data_action as h
+from src.benchmark import FakeOSN, product_lines
+
+MONGO_URL = 'mongomock://tests'
+STATION, START = 90_000, int(np.datetime64('2019-01-01T00', 'h').astype(np.int64))
+
+
+#######################################
+#               HELPERS               #
+#######################################
+@pytest.fixture
+def mongo(monkeypatch):
+    """A fresh mongomock client as the shared one, with a single open ended temperature sensor for STATION."""
+    client = mongomock.MongoClient()
+    mongodb.use_client(MONGO_URL, client)
+    monkeypatch.setattr(h, 'mongo_db_url', MONGO_URL)
+    db = client['opensense']
+    db[mongodb.MAPPINGS].insert_one({'local_id': f'{STATION}-temperature',
+                                     'sensors': [{'idx': 0, 'osn_id': 1, 'earliest_day': h.hour_to_iso(START),
+                                                  'latest_day': ''}]})
+    yield db
+    mongodb.close_client()
+
+def lines(nr_of_hours:int) -> List[str]:
+    return list(product_lines(STATION, START, nr_of_hours, ('TT_TU',), missing_rate=0.))
+
+def push(nr_of_hours:int, concurrency:int=1) -> None:
+    first_line, *rest = lines(nr_of_hours)
+    h.handle_content_data(first_line=first_line, lines=rest, measurand='temperature', concurrency=concurrency)
+
+def sent_ranges(db) -> list:
+    return sorted((r['start'], r['end']) for r in db[mongodb.SENT].find({'local_id': f'{STATION}-temperature'}))
+
+
+#######################################
+#          ADAPTIVE BATCHES           #
+#######################################
+def test_overloaded_tail_batch_shrinks_the_next_try():
+    batch_size = h.AdaptiveBatchSize(min_size=100)
+    batch_size.size = 2000
+    batch_size.update(h.OVERLOADED, 1., 300)
+    assert batch_size.size == 150 and batch_size.ceiling == 270
+
+def test_stale_batch_does_not_halve_again():
+    batch_size = h.AdaptiveBatchSize(min_size=100)
+    batch_size.size = 1000
+    batch_size.update(h.OVERLOADED, 1., 2000) # built before the size was halved to 1000
+    assert batch_size.size == 1000
+
+@pytest.fixture
+def always_overloaded(monkeypatch) -> List[int]:
+    """Every push is answered with a 408. Returns the nr of values of every push."""
+    pushes = []
+    def _overloaded(valuebulk:dict) -> str:
+        pushes.append(len(valuebulk['collapsedMessages']))
+        return h.OVERLOADED
+    async def _overloaded_async(valuebulk:dict) -> str: return _overloaded(valuebulk)
+    monkeypatch.setattr(h, 'osn_push_valuebulk', _overloaded)
+    monkeypatch.setattr(h, 'osn_push_valuebulk_async', _overloaded_async)
+    monkeypatch.setattr(h.AdaptiveBatchSize, 'learned_size', 2000)
+    return pushes
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_overloaded_tail_batch_terminates(mongo, always_overloaded, concurrency:int):
+    push(300, concurrency) # a single batch below half the size
+    assert always_overloaded[:2] == [300, 250] and len(always_overloaded) == 3
+    assert sent_ranges(mongo) == []
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_always_overloaded_gives_up(mongo, always_overloaded, monkeypatch, concurrency:int):
+    monkeypatch.setattr(h, 'MAX_OVERLOADS', 2)
+    with pytest.raises(api.Overloaded): push(2000, concurrency)
+    assert always_overloaded[:2] == [2000, 1000] and len(always_overloaded) <= 3 # both halves may be in flight
+    assert sent_ranges(mongo) == []
+
+
+#######################################
+#              FAKE OSN               #
+#######################################
+@pytest.fixture
+def fake_osn(monkeypatch):
+    """Starts a FakeOSN with the given settings, and points osnapi at it."""
+    servers = []
+    def _start(**kwargs) -> FakeOSN:
+        servers.append(FakeOSN(**kwargs))
+        monkeypatch.setattr(api.Settings, 'api_endpoint', servers[-1].endpoint)
+        return servers[-1]
+    yield _start
+    for osn in servers: osn.close()
+
+def covered(ranges:list) -> int: return sum(end - start + 1 for start, end in ranges)
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_pushes_every_value(mongo, fake_osn, concurrency:int):
+    osn = fake_osn(latency=0.002)
+    push(3000, concurrency)
+    assert osn.stats['values'] == 3000 and osn.stats['overloaded'] == 0
+    assert sent_ranges(mongo) == [(START, START + 2999)]
+    push(3000, concurrency) # already sent values aren't pushed again
+    assert osn.stats['values'] == 3000
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_408_shrinks_the_batches(mongo, fake_osn, monkeypatch, concurrency:int):
+    monkeypatch.setattr(h.AdaptiveBatchSize, 'learned_size', 2000)
+    osn = fake_osn(max_values=600) # every larger push gets a 408
+    push(3000, concurrency)
+    assert osn.stats['overloaded'] > 0 and osn.stats['values'] == 3000
+    assert sent_ranges(mongo) == [(START, START + 2999)]
+    assert h.AdaptiveBatchSize.learned_size <= 600
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_random_408s_record_what_was_pushed(mongo, fake_osn, concurrency:int):
+    osn = fake_osn(overload_rate=0.3, seed=1)
+    push(3000, concurrency)
+    # batches of the minimum size that get a 408 are left to the next run, everything else is pushed exactly once
+    assert osn.stats['values'] == covered(sent_ranges(mongo))
+    push(3000, concurrency)
+    assert osn.stats['values'] <= 3000
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_slow_pushes_time_out_as_overloaded(mongo, fake_osn, monkeypatch, concurrency:int):
+    monkeypatch.setattr(api.Settings, 'timeout', 0.5)
+    monkeypatch.setattr(h.AdaptiveBatchSize, 'learned_size', 2000)
+    osn = fake_osn(latency_per_value=0.0005) # 2000 values take 1 sec, longer than the timeout
+    push(2000, concurrency)
+    assert h.AdaptiveBatchSize.learned_size < 1000
+    # the server still stores the values of a push that timed out, but only acknowledged ones are recorded as sent
+    assert sent_ranges(mongo) == [(START, START + 1999)]
+
+@pytest.mark.parametrize('gzip,compressed', [(None, False), ('no', False), ('yes', True)])
+def test_gzip_param_compresses_the_pushes(mongo, fake_osn, monkeypatch, gzip, compressed:bool):
+    osn = fake_osn()
+    monkeypatch.setattr(api.Settings, 'gzip_min_size', 0)
+    monkeypatch.setattr(api.Settings, 'gzip_bodies', api.Settings.gzip_bodies) # undone after the test
+    monkeypatch.setattr(h.secretmanager, 'complete_sequence', lambda *args, **kwargs: None)
+    compress, calls = api.gzip.compress, []
+    monkeypatch.setattr(api.gzip, 'compress', lambda data, **kwargs: calls.append(len(data)) or compress(data, **kwargs))
+    args = {'csv': '\n'.join(lines(500))}
+    if gzip is not None: args['gzip'] = gzip
+    assert h.main(args) == {'message': 'finished'}
+    assert osn.stats['values'] == 500 and bool(calls) == compressed
+
+def test_async_push_runs_the_patched_function_on_the_pool(monkeypatch):
+    calls = []
+    def _addMultipleValues(body:dict) -> str:
+        calls.append(threading.current_thread().name)
+        return 'OK'
+    monkeypatch.setattr(api, 'addMultipleValues', _addMultipleValues) # like the retry wrapper of the content handler
+    assert asyncio.run(api.addMultipleValuesAsync({'collapsedMessages': []})) == 'OK'
+    assert len(calls) == 1 and calls[0].startswith('osnapi')
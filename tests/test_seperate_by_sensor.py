@@ -0,0 +1,153 @@
+"""Randomized property tests of seperate_by_sensor, against the find_transition based implementation it replaced
+and against a row by row assignment"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pytest
+
+import src.value_handling.handle_content_data_action as h
+
+SEEDS = range(500)
+
+
+#######################################
+#              REFERENCE              #
+#######################################
+# NOTE(florian): The implementation before the searchsorted one, kept as a reference. It raises on empty input, and
+# returns None bounds or misses rows in some corner cases, see reference() and test_matches_reference().
+def belongs_to_sensor(a:int, ts:int, b:int) -> bool:
+    """checks if ts is between a and b"""
+    return a <= ts <= b
+
+def find_transition(start:int, end:int, List:list, condition:Callable) -> int:
+    """Uses a Binary Search approach to find the index of the first element where condition is no longer true."""
+    pivot = (start + end) // 2
+    while end - start > 1:
+        if condition(List[pivot]):
+            if not condition(List[pivot + 1]): return pivot + 1
+            else: start, pivot = pivot, (pivot + end) // 2 # move to the right
+        else:
+            if condition(List[pivot - 1]): return pivot
+            else: end, pivot = pivot, (start + pivot) // 2 # move to the left
+
+def reference_seperate_by_sensor(dates:np.ndarray, sensors:list) -> dict:
+    """Splits a list of timestamped values into chunks depending on what sensor the value was recorded by"""
+    chunks, start, ld = {}, 0, len(dates)
+    for i, sensor in enumerate(sensors):
+        a, b  = h.sensor_bounds(sensor)
+        ts    = dates[start]
+        if belongs_to_sensor(a, ts, b):
+            ts = dates[-1]
+            if ts <= b: # fast path, entire remaining list belongs to this sensor
+                chunks[i] = (start, ld)
+                break
+            else: # find the end of this sensors interval, and continue with the next sensor
+                pivot = find_transition(start, ld - 1, dates, lambda x: belongs_to_sensor(a, x, b))
+                chunks[i] = (start, pivot)
+                start = pivot
+                continue
+        else: # the current position does not belong to this sensor
+            if ts < a: # either check whether to skip over some values, or skip this sensors interval
+                ts = dates[-1]
+                if a < ts: # check if some values later on still belong to this sensor
+                    if belongs_to_sensor(a, ts, b): # from some point onwards, the remaining list belongs to this senso
+                        pivot = find_transition(start, ld - 1, dates, lambda x: not belongs_to_sensor(a, x, b))
+                        chunks[i] = (pivot, ld)
+                        break
+                    else: # end of the list is not part of this sensor, there might be a subsection though
+                        for j, ts in enumerate(dates[start:]):
+                            if b < ts: # end of potential interval reached, skip to next sensor
+                                start = start + j
+                                break
+                            else:
+                                if belongs_to_sensor(a, ts, b): # start of this sensors interval found
+                                    pivot = find_transition(start, ld - 1, dates,
+                                                            lambda x: belongs_to_sensor(a, x, b))
+                                    chunks[i] = (start + j, pivot)
+                                    start = pivot
+                                    break
+                else: break # the last element in the list is still before this sensors interval
+            else: continue  # the current list position is after this sensors interval
+    return chunks
+
+def row_by_row(dates:np.ndarray, sensors:list) -> Dict[int, Tuple[int, int]]:
+    """Every row belongs to the first sensor whose [earliest_day, latest_day] contains it."""
+    bounds, rows = [h.sensor_bounds(sensor) for sensor in sensors], {}
+    for k, ts in enumerate(dates):
+        owner = next((i for i, (a, b) in enumerate(bounds) if a <= ts <= b), None)
+        if owner is not None: rows.setdefault(owner, []).append(k)
+    return {i: (ks[0], ks[-1] + 1) for i, ks in rows.items()}
+
+
+#######################################
+#             GENERATORS              #
+#######################################
+def random_dates(rng:np.random.Generator) -> np.ndarray:
+    """Sorted, unique hours with random gaps. Sometimes empty, or a single row."""
+    n = rng.choice([0, 1, 2, rng.integers(3, 400)])
+    return np.cumsum(rng.integers(1, rng.choice([2, 5, 50]), size=n), dtype=np.int64) + 200_000
+
+def random_sensors(rng:np.random.Generator, dates:np.ndarray) -> List[dict]:
+    """Sensors sorted by earliest_day, that leave gaps, overlap, start before or end after the dates, and sometimes
+    have an open end."""
+    lo, hi = (int(dates[0]), int(dates[-1])) if len(dates) else (200_000, 200_100)
+    sensors = []
+    for _ in range(rng.integers(1, 6)):
+        a = int(rng.integers(lo - 20, hi + 20))
+        b = a + int(rng.integers(0, max(2, hi - lo)))
+        open_end = rng.random() < 0.2
+        sensors.append({'earliest_day': h.hour_to_iso(a), 'latest_day': '' if open_end else h.hour_to_iso(b)})
+    return sorted(sensors, key=lambda x: x['earliest_day'])
+
+def case(seed:int) -> Tuple[np.ndarray, List[dict]]:
+    rng = np.random.default_rng(seed)
+    dates = random_dates(rng)
+    return dates, random_sensors(rng, dates)
+
+def reference(dates:np.ndarray, sensors:list) -> Optional[dict]:
+    """The result of the old implementation, or None where it raised or returned None bounds."""
+    try: chunks = reference_seperate_by_sensor(dates, sensors)
+    except Exception: return None
+    if any(start is None or end is None for start, end in chunks.values()): return None
+    return chunks
+
+
+#######################################
+#                TESTS                #
+#######################################
+@pytest.mark.parametrize('seed', SEEDS)
+def test_matches_row_by_row(seed:int):
+    dates, sensors = case(seed)
+    assert h.seperate_by_sensor(dates, sensors) == row_by_row(dates, sensors)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_matches_reference(seed:int):
+    dates, sensors = case(seed)
+    expected = reference(dates, sensors)
+    if expected is None: pytest.skip('the old implementation fails on this input')
+    chunks = h.seperate_by_sensor(dates, sensors)
+    # the old implementation misses the range of a sensor that starts at the last of two remaining rows, the new one
+    # may only add such ranges, which are checked by test_matches_row_by_row
+    assert {i: chunks.get(i) for i in expected} == expected
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_ranges_are_compact_and_disjoint(seed:int):
+    dates, sensors = case(seed)
+    chunks = h.seperate_by_sensor(dates, sensors)
+    ranges = [chunks[i] for i in sorted(chunks)]
+    assert all(0 <= start < end <= len(dates) for start, end in ranges)
+    assert all(prev_end <= start for (_, prev_end), (start, _) in zip(ranges, ranges[1:]))
+
+def test_empty_input():
+    sensor = {'earliest_day': '2000-01-01T00:00:00', 'latest_day': ''}
+    assert h.seperate_by_sensor(np.array([], dtype=np.int64), [sensor]) == {}
+    assert h.seperate_by_sensor(np.arange(5, dtype=np.int64), []) == {}
+
+def test_open_end_takes_the_rest():
+    dates = np.arange(h.iso_to_hour('2000-01-01T00:00:00'), h.iso_to_hour('2000-01-03T00:00:00'), dtype=np.int64)
+    sensors = [{'earliest_day': '1999-01-01T00:00:00', 'latest_day': '2000-01-01T23:00:00'},
+               {'earliest_day': '2000-01-02T00:00:00', 'latest_day': ''}]
+    assert h.seperate_by_sensor(dates, sensors) == {0: (0, 24), 1: (24, 48)}
@@ -0,0 +1,116 @@
+"""Tests of the state machine of the work queue, with MongoDB replaced by mongomock"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock') # only used by the tests and the benchmark
+
+import deployment_tmp.workqueue as workqueue
+from deployment_tmp.workqueue import PENDING, LEASED, DONE, FAILED, BLOCKED
+
+FILE = 'stundenwerte_TU_00003_19500401_19521231_hist.zip'
+WINDOWS = {FILE: [(0, 10), (10, 20), (20, 30)]}
+
+
+@pytest.fixture
+def queue():
+    return mongomock.MongoClient()['opensense']['queue']
+
+def states(queue) -> dict: return {job['_id']: job['state'] for job in queue.find()}
+
+def fail(queue, max_attempts:int=workqueue.MAX_ATTEMPTS) -> dict:
+    """Claims the next job and releases it with an error, until it failed for good."""
+    for _ in range(max_attempts):
+        job = workqueue.claim(queue, 'worker', max_attempts=max_attempts)
+        workqueue.release(queue, job, error='boom', max_attempts=max_attempts)
+    return job
+
+
+#######################################
+#               LEASES                #
+#######################################
+def test_claim_complete(queue):
+    assert workqueue.enqueue(queue, ['a.zip', 'b.zip'], ftp_url='recent/', measurand='temperature') == 2
+    first, second = workqueue.claim(queue, 'w1'), workqueue.claim(queue, 'w2')
+    assert {first['_id'], second['_id']} == {'a.zip', 'b.zip'}
+    assert first['state'] == LEASED and first['attempts'] == 1 and first['worker'] == 'w1'
+    assert workqueue.claim(queue, 'w3') is None and not workqueue.has_claimable(queue)
+    workqueue.complete(queue, first); workqueue.complete(queue, second)
+    assert workqueue.counts(queue) == {DONE: 2}
+
+def test_release_retries_until_max_attempts(queue):
+    workqueue.enqueue(queue, ['a.zip'], ftp_url='recent/', measurand='temperature')
+    for attempt in range(1, workqueue.MAX_ATTEMPTS + 1):
+        job = workqueue.claim(queue, 'worker')
+        assert job['attempts'] == attempt
+        workqueue.release(queue, job, error='boom')
+    assert states(queue) == {'a.zip': FAILED} and queue.find_one()['error'] == 'boom'
+    assert workqueue.claim(queue, 'worker') is None
+
+def test_expired_lease_is_claimed_again(queue):
+    workqueue.enqueue(queue, ['a.zip'], ftp_url='recent/', measurand='temperature')
+    crashed = workqueue.claim(queue, 'w1', lease_sec=-1) # the worker died, its lease has run out
+    assert workqueue.has_claimable(queue)
+    job = workqueue.claim(queue, 'w2')
+    assert job['_id'] == 'a.zip' and job['attempts'] == 2
+    workqueue.complete(queue, crashed) # a late complete of the first worker doesn't match anymore
+    assert states(queue) == {'a.zip': LEASED}
+    workqueue.complete(queue, job)
+    assert states(queue) == {'a.zip': DONE}
+
+def test_last_expired_lease_fails_the_job(queue):
+    workqueue.enqueue(queue, ['a.zip'], ftp_url='recent/', measurand='temperature')
+    for _ in range(workqueue.MAX_ATTEMPTS): workqueue.claim(queue, 'worker', lease_sec=-1)
+    assert workqueue.claim(queue, 'worker') is None
+    assert workqueue.counts(queue) == {FAILED: 1}
+    assert queue.find_one()['error'] == f'lease expired in attempt {workqueue.MAX_ATTEMPTS}'
+
+def test_enqueue_resets_all_but_leased_jobs(queue):
+    workqueue.enqueue(queue, ['a.zip', 'b.zip', 'c.zip'], ftp_url='recent/', measurand='temperature')
+    done, leased = workqueue.claim(queue, 'w1'), workqueue.claim(queue, 'w2')
+    workqueue.complete(queue, done)
+    workqueue.enqueue(queue, ['a.zip', 'b.zip', 'c.zip'], ftp_url='recent/', measurand='temperature')
+    assert states(queue) == {done['_id']: PENDING, leased['_id']: LEASED, 'c.zip': PENDING}
+    workqueue.complete(queue, leased) # the running worker can still finish its file
+    assert states(queue)[leased['_id']] == DONE
+
+
+#######################################
+#              BACKFILL               #
+#######################################
+def test_only_the_first_window_is_pending(queue):
+    assert workqueue.enqueue_windows(queue, WINDOWS, ftp_url='hist/', measurand='temperature') == 3
+    assert sorted(states(queue).values()) == [BLOCKED, BLOCKED, PENDING]
+    assert workqueue.claim(queue, 'worker')['window'] == [0, 10]
+    assert workqueue.claim(queue, 'other') is None # the others stay blocked while the first one is leased
+
+def test_done_first_window_unblocks_the_others(queue):
+    workqueue.enqueue_windows(queue, WINDOWS, ftp_url='hist/', measurand='temperature')
+    workqueue.complete(queue, workqueue.claim(queue, 'worker'))
+    assert sorted(states(queue).values()) == [DONE, PENDING, PENDING]
+    assert workqueue.counts(queue) == {DONE: 1, PENDING: 2}
+
+def test_failed_first_window_fails_the_others(queue):
+    workqueue.enqueue_windows(queue, WINDOWS, ftp_url='hist/', measurand='temperature')
+    assert fail(queue)['window'] == [0, 10]
+    assert workqueue.counts(queue) == {FAILED: 3}
+    assert workqueue.claim(queue, 'worker') is None
+
+def test_stale_failures_dont_fail_a_new_run(queue):
+    workqueue.enqueue_windows(queue, WINDOWS, ftp_url='hist/', measurand='temperature')
+    fail(queue)
+    # the next run uses windows of two years, whose ids differ from the failed ones
+    workqueue.enqueue_windows(queue, {FILE: [(0, 20), (20, 30)]}, ftp_url='hist/', measurand='temperature')
+    assert workqueue.counts(queue) == {FAILED: 2, PENDING: 1, BLOCKED: 1} # (20, 30) was queued again
+    job = workqueue.claim(queue, 'worker')
+    assert job['window'] == [0, 20]
+    assert workqueue.counts(queue) == {FAILED: 2, LEASED: 1, BLOCKED: 1}
+    workqueue.complete(queue, job)
+    assert workqueue.claim(queue, 'worker')['window'] == [20, 30]
+
+def test_a_new_run_retries_failed_windows(queue):
+    workqueue.enqueue_windows(queue, WINDOWS, ftp_url='hist/', measurand='temperature')
+    fail(queue)
+    workqueue.enqueue_windows(queue, WINDOWS, ftp_url='hist/', measurand='temperature')
+    assert workqueue.counts(queue) == {PENDING: 1, BLOCKED: 2}
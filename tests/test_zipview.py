@@ -0,0 +1,47 @@
+"""Tests of reading zip members from the kinds of files that dwdftp.fetch() returns"""
+
+__author__ = "Florian Peters https://github.com/flpeters"
+
+import io
+import tempfile
+from zipfile import ZipFile, ZIP_BZIP2, ZIP_DEFLATED, ZIP_STORED
+
+import pytest
+
+import deployment_tmp.dwdftp as dwdftp
+import deployment_tmp.zipview as zipview
+
+LINES = [f'{i};2019010100;{i / 10}' for i in range(5000)]
+MEMBERS = {'stored.txt': ZIP_STORED, 'deflated.txt': ZIP_DEFLATED, 'bzip2.txt': ZIP_BZIP2} # bzip2 isn't viewable
+
+
+@pytest.fixture
+def archive(tmp_path) -> str:
+    path = str(tmp_path / 'station.zip')
+    with ZipFile(path, 'w') as z:
+        for name, compression in MEMBERS.items(): z.writestr(name, '\r\n'.join(LINES), compress_type=compression)
+    return path
+
+def temporary_file(path:str):
+    out = tempfile.TemporaryFile()
+    with open(path, 'rb') as f: out.write(f.read())
+    out.seek(0)
+    return out
+
+def bytes_io(path:str):
+    with open(path, 'rb') as f: return io.BytesIO(f.read())
+
+@pytest.mark.parametrize('open_file', [temporary_file, bytes_io, dwdftp.MappedFile])
+@pytest.mark.parametrize('name', list(MEMBERS))
+def test_iter_lines(archive:str, open_file, name:str):
+    with open_file(archive) as f, zipview.MappedZip(f) as myzip:
+        assert list(zipview.iter_lines(myzip, name)) == LINES
+    with open_file(archive) as f, ZipFile(f) as myzip:
+        assert list(zipview.iter_lines(myzip, name)) == LINES
+
+@pytest.mark.parametrize('open_file', [temporary_file, bytes_io, dwdftp.MappedFile])
+def test_close_with_unfinished_members(archive:str, open_file):
+    with open_file(archive) as f, zipview.MappedZip(f) as myzip:
+        lines = [zipview.iter_lines(myzip, name) for name in MEMBERS]
+        for member in lines: next(member)
+    assert myzip._view is None
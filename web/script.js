@@ -120,6 +120,7 @@ $(document).ready(function() {
     getLogs()
     getActions()
     importState()
+    getMetrics()
 
     // get new logs every 15 seconds
     setInterval(getLogs, 15000);
@@ -128,6 +129,9 @@ $(document).ready(function() {
     setInterval(getActions, 5000);
     setInterval(importState, 5000)
 
+    // the metrics are aggregated per hour, so once a minute is enough
+    setInterval(getMetrics, 60000)
+
     // load start_time from local storage
     $("#startTime").html(localStorage.getItem('start_time'))
 });
@@ -290,4 +294,26 @@ function getActions() {
     } else {
         $("#actionListLogs").html("ActionList updates paused")
     }
-}
\ No newline at end of file
+}
+
+
+function getMetrics() {
+    /* time triggered function
+     * calls the server on /metrics/ endpoint when pauseLogs checkbox is not checked
+     * to get the time spent per action and stage, as html <li> tags, which are handled server side
+     */
+    if ($("#pauseLogs:checked").val() !== "on") {
+        $.ajax({
+            url: "http://localhost:5000/metrics/",
+            type: 'GET',
+            contentType: "application/json",
+            timeout: 15000,
+            success: function(data) {
+                let jsonAsObj = JSON.parse((JSON.stringify(data)))
+                $("#metricsList").html(jsonAsObj.message)
+            }
+        }).fail(function(jqXHR, textStatus, errorThrown) {
+            $("#metricsList").html("<li>Cant reach server</li>")
+        });
+    }
+}